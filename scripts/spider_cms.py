@@ -12,6 +12,7 @@ import argparse
 import multiprocessing
 
 import htcondor_es
+import htcondor_es.encoding
 import htcondor_es.history
 import htcondor_es.queues
 from htcondor_es.utils import (
@@ -20,6 +21,7 @@ from htcondor_es.utils import (
     set_up_logging,
 )
 from htcondor_es.utils import collect_metadata, TIMEOUT_MINS
+from htcondor_es.convert_to_json import task_info_cache
 
 
 def main_driver(args):
@@ -38,7 +40,22 @@ def main_driver(args):
         schedd_ads = get_schedds(args, collectors=args.collectors)
     logging.warning("&&& There are %d schedds to query.", len(schedd_ads))
 
-    pool = multiprocessing.Pool(processes=args.query_pool_size)
+    # Load before forking the workers, so that all of them start warm
+    if args.task_cache:
+        task_info_cache.load()
+    logging.info(
+        "JSON backend: %s", htcondor_es.encoding.set_backend(args.json_backend)
+    )
+
+    # The queue docs go from the query pool processes to the listener of
+    # process_queues, through a queue they inherit when they start
+    doc_queue = multiprocessing.Queue() if args.process_queue else None
+    htcondor_es.queues.set_doc_queue(doc_queue)
+    pool = multiprocessing.Pool(
+        processes=args.query_pool_size,
+        initializer=htcondor_es.queues.set_doc_queue,
+        initargs=(doc_queue,),
+    )
 
     metadata = collect_metadata()
 
@@ -64,6 +81,10 @@ def main_driver(args):
     pool.close()
     pool.join()
 
+    # With the entries the workers added
+    if args.task_cache:
+        task_info_cache.save()
+
     logging.warning(
         "@@@ Total processing time: %.2f mins", ((time.time() - starttime) / 60.0)
     )
@@ -173,6 +194,78 @@ def main():
         help="If no checkpoint provided, query max N minutes from now of completed job results in history shcedds. "
              "It gives elasticity to test jobs. [default: %(default)d]",
     )
+    parser.add_argument(
+        "--attribute_projection", default="full", choices=["full", "projected"], dest="attribute_projection",
+        help="Fetch all job attributes from the schedds, or only the ones used in the documents. "
+             "Not a drop-in replacement: the ChirpCMSSW*/MachineAttr* attributes not learned yet "
+             "(see --learn_projection_attrs) are not fetched, and the expressions referring to "
+             "attributes outside the projection evaluate differently [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--learn_projection_attrs", action="store_true", dest="learn_projection_attrs",
+        help="In full mode, record the ChirpCMSSW*/MachineAttr* attribute names of the job ads "
+             "for the projected mode of the next runs (walks the keys of every ad)",
+    )
+    parser.add_argument(
+        "--materialize_ads", action="store_true", dest="materialize_ads",
+        help="Evaluate each job ClassAd into a python dict once before converting it",
+    )
+    parser.add_argument(
+        "--task_cache", action="store_true", dest="task_cache",
+        help="Keep the request/task level classification cache in the workdir between runs",
+    )
+    parser.add_argument(
+        "--json_backend", default="json", type=str, dest="json_backend",
+        choices=htcondor_es.encoding.BACKENDS,
+        help="JSON encoder of the ES documents, 'auto' uses orjson if it is installed [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--stage_timing", action="store_true", dest="stage_timing",
+        help="Log the time spent in each document conversion stage, per schedd",
+    )
+    parser.add_argument(
+        "--history_split_ads", default=0, type=int, dest="history_split_ads",
+        help="Split the history window of a schedd expected to return more ads than this, according to "
+             "its previous crawl, in sub-windows queried in parallel. Each sub-window is a history query "
+             "scanning the schedd history from its newest record, down to the --history_since bound or "
+             "through all its history files: N sub-windows cost the schedd about N scans. "
+             "0 disables it [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--upload_queue_size", default=4, type=int, dest="upload_queue_size",
+        help="Bunches of history docs queued for the background uploader of each query process, "
+             "so that the schedds are read during the uploads. 0 uploads synchronously [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--history_progress_secs", default=0, type=int, dest="history_progress_secs",
+        help="Crawl the history of a schedd in ascending sub-windows of this length (longer ones beyond "
+             "%d sub-windows), checkpointed as soon as each one is uploaded, so that a timed out crawl "
+             "resumes from its progress. Each sub-window is a history query scanning the schedd history "
+             "from its newest record: use it with --history_since, without it every sub-window scans all "
+             "the history files. 0 crawls the whole window at once [default: %%(default)d]"
+             % htcondor_es.history.MAX_PROGRESS_WINDOWS,
+    )
+    parser.add_argument(
+        "--skip_shipped", action="store_true", dest="skip_shipped",
+        help="Record the jobs shipped in the history overlap re-queried by the next run "
+             "(the last 12 minutes before the checkpoint) and skip them before their conversion",
+    )
+    parser.add_argument(
+        "--history_since", action="store_true", dest="history_since",
+        help="Bound the history queries of a schedd by the most recent record seen by its last complete "
+             "crawl, so that the schedd stops scanning its history files there",
+    )
+    parser.add_argument(
+        "--poll_queues", action="store_true", dest="poll_queues",
+        help="Query the queues of all the schedds at once from one thread, multiplexed with "
+             "htcondor.poll, the query pool only converting the ads",
+    )
+    parser.add_argument(
+        "--es_delivery", default="all", choices=["all", "quorum"], dest="es_delivery",
+        help="Bulks are sent to all the ES/OpenSearch clusters concurrently. 'all' waits for every cluster, "
+             "'quorum' goes on once a majority acknowledged and awaits (retries) the others in the "
+             "background, flushed before the checkpoint of each schedd [default: %(default)s]",
+    )
     parser.add_argument(
         "--mock_cern_domain", action="store_true", dest="mock_cern_domain",
         help="ElasticsearchInterface forces to be in CERN domain. In dev tests, mock that using this var",
@@ -24,7 +24,7 @@ source "$SPIDER_WORKDIR/venv3_9/bin/activate"
 
 # Clean test run, remove affiliation and checkpoint files before test run.
 #rm -f $SPIDER_WORKDIR/.affiliation_dir.json
-#rm -f $SPIDER_WORKDIR/checkpoint.json
+#rm -f $SPIDER_WORKDIR/checkpoint.json $SPIDER_WORKDIR/checkpoint.db*
 
 # Create affiliations json first, otherwise convert_to_json.py will fail
 # ./scripts/cronAffiliation.sh
@@ -0,0 +1,186 @@
+"""
+Checkpoint of the history crawls: the completion date of the last job
+processed on each schedd.
+
+The checkpoint is kept in a SQLite database of the workdir, each schedd is
+updated in its own transaction, directly from the worker that processed it,
+so a crash can not leave a truncated checkpoint behind. A checkpoint.json
+left by the previous versions is imported on first use, and a copy of the
+checkpoint is still written there (atomically) at the end of each history
+run, for rollbacks and for humans. The runs fall back to that copy when the
+database is not readable.
+
+Along with the checkpoint, the keys of the jobs shipped within the overlap
+re-queried by the next run can be recorded, in the same transaction, so that
+they are not converted and uploaded twice (see history.shipped_key), and
+the id of the most recent history record scanned by a complete crawl, the
+since bound of the next one.
+"""
+
+import os
+import json
+import time
+import logging
+import sqlite3
+
+_WORKDIR = os.getenv("SPIDER_WORKDIR", "/home/cmsjobmon/cms-htcondor-es")
+_CHECKPOINT_DB = os.path.join(_WORKDIR, "checkpoint.db")
+_CHECKPOINT_JSON = os.path.join(_WORKDIR, "checkpoint.json")
+
+
+def _connect():
+    """
+    Open a new connection, they are not shared between the processes.
+    isolation_level=None leaves the transactions to the explicit BEGIN/COMMIT.
+    """
+    conn = sqlite3.connect(_CHECKPOINT_DB, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS checkpoint ("
+        " name TEXT PRIMARY KEY,"
+        " last_completion NUMERIC NOT NULL,"
+        " updated REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS shipped ("
+        " name TEXT NOT NULL,"
+        " key INTEGER NOT NULL,"
+        " date NUMERIC NOT NULL,"
+        " PRIMARY KEY (name, key)) WITHOUT ROWID"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS since ("
+        " name TEXT PRIMARY KEY,"
+        " job_id TEXT NOT NULL)"
+    )
+    return conn
+
+
+def _read_json():
+    """Return the content of checkpoint.json, None if it is not readable"""
+    try:
+        with open(_CHECKPOINT_JSON) as fd:
+            return json.load(fd)
+    except Exception as e:
+        logging.warning("!!! checkpoint.json is not found or not readable. " + str(e))
+        return None
+
+
+def _import_json(conn):
+    """Import the checkpoint.json of the previous versions into an empty database"""
+    checkpoint = _read_json()
+    if checkpoint is None:
+        return
+    now = time.time()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT COUNT(*) FROM checkpoint").fetchone()[0]:
+            return
+        conn.executemany(
+            "INSERT INTO checkpoint (name, last_completion, updated) VALUES (?, ?, ?)",
+            [(name, last_completion, now) for name, last_completion in checkpoint.items()],
+        )
+    logging.warning("Imported the checkpoint of %d schedds from checkpoint.json", len(checkpoint))
+
+
+def _load_db():
+    """Return the checkpoint of the database, raises sqlite3.Error"""
+    conn = _connect()
+    try:
+        if not conn.execute("SELECT COUNT(*) FROM checkpoint").fetchone()[0]:
+            _import_json(conn)
+        return dict(conn.execute("SELECT name, last_completion FROM checkpoint"))
+    finally:
+        conn.close()
+
+
+def load():
+    """
+    Return the checkpoint as a {schedd name: last completion date} dict, the
+    copy of checkpoint.json if the database is not readable
+    """
+    try:
+        return _load_db()
+    except sqlite3.Error as e:
+        logging.error(
+            "!!! checkpoint database %s is not readable, using checkpoint.json. %s", _CHECKPOINT_DB, e
+        )
+    return _read_json() or {}
+
+
+def update(name, last_completion, shipped=(), expire_before=None, since=None):
+    """
+    Set the checkpoint of a schedd, committed before returning.
+
+    shipped is an iterable of (key, date) of the jobs uploaded, the ones dated
+    from expire_before on are recorded, the older records are dropped.
+    since, if given, replaces the job id the history queries start after.
+    """
+    conn = _connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO checkpoint (name, last_completion, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET "
+                "last_completion = excluded.last_completion, updated = excluded.updated",
+                (name, last_completion, time.time()),
+            )
+            if expire_before is not None:
+                conn.execute("DELETE FROM shipped WHERE name = ? AND date < ?", (name, expire_before))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO shipped (name, key, date) VALUES (?, ?, ?)",
+                    [(name, key, date) for key, date in shipped if date >= expire_before],
+                )
+            if since is not None:
+                conn.execute("INSERT OR REPLACE INTO since (name, job_id) VALUES (?, ?)", (name, since))
+    finally:
+        conn.close()
+
+
+def load_since():
+    """Return the {schedd name: job id} since bounds of the history queries"""
+    try:
+        conn = _connect()
+        try:
+            return dict(conn.execute("SELECT name, job_id FROM since"))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error("!!! checkpoint database %s is not readable. %s", _CHECKPOINT_DB, e)
+        return {}
+
+
+def load_shipped(name):
+    """
+    Return the set of the keys of the jobs of a schedd recorded by update,
+    an empty set if the database is not readable: nothing is skipped then
+    """
+    try:
+        conn = _connect()
+        try:
+            return {key for key, in conn.execute("SELECT key FROM shipped WHERE name = ?", (name,))}
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.error("!!! checkpoint database %s is not readable, no shipped jobs of %s skipped. %s",
+                      _CHECKPOINT_DB, name, e)
+        return set()
+
+
+def export_json():
+    """Write a copy of the checkpoint to checkpoint.json, replaced atomically"""
+    try:
+        checkpoint = _load_db()
+    except sqlite3.Error as e:
+        logging.error("!!! checkpoint database %s is not readable, checkpoint.json not updated. %s", _CHECKPOINT_DB, e)
+        return
+    tmp_file = _CHECKPOINT_JSON + ".tmp"
+    try:
+        with open(tmp_file, "w") as fd:
+            json.dump(checkpoint, fd)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(tmp_file, _CHECKPOINT_JSON)
+    except OSError as e:
+        logging.warning("Failed to write checkpoint.json: " + str(e))
@@ -0,0 +1,126 @@
+"""
+Rule based classification of jobs into campaigns, workflows and task types.
+
+The rules live in classification_rules.json as an ordered list of
+patterns per output field. Each list is compiled into one regular expression
+with a named group per rule, so classifying a job is a single match call
+no matter how many campaign families are defined. As with re.match, a
+pattern has to match at the start of the subject, and the first matching
+rule wins.
+
+A rule looks like:
+
+    {"pattern": "...", "value": "{1}Reprocessing", "require": {"Attr": "substring"}}
+
+"value" may refer to the groups of the pattern with str.format syntax, {0}
+being the whole match and {1} the first group. A rule whose value refers to
+anything else is rejected when the rules are loaded. "require" lists
+substrings that other job attributes must contain for the rule to apply.
+"""
+
+import json
+import logging
+import os
+import re
+import string
+
+_RULES_JSON = os.path.join(os.path.dirname(__file__), "classification_rules.json")
+
+
+class RuleMatcher(object):
+    """Ordered list of rules for one output field compiled into one regex"""
+
+    def __init__(self, field, rules, default=None):
+        self.field = field
+        self.default = default
+        self.rules = []
+        alternatives = []
+        for i, rule in enumerate(rules):
+            pattern = re.compile(rule["pattern"])
+            check_template(field, i, rule["value"], pattern.groups)
+            self.rules.append(
+                (
+                    pattern,
+                    rule["value"],
+                    tuple((rule.get("require") or {}).items()),
+                )
+            )
+            alternatives.append("(?P<r%d>%s)" % (i, rule["pattern"]))
+        self._regex = re.compile("|".join(alternatives)) if alternatives else None
+        # The rule's own group closes last, so match.lastindex identifies the
+        # rule. Index the rules by that group number in the combined regex.
+        self._by_group = [None] * ((self._regex.groups + 1) if self._regex else 0)
+        for i, (pattern, value, require) in enumerate(self.rules):
+            group = self._regex.groupindex["r%d" % i]
+            templated = "{" in value
+            self._by_group[group] = (i, group, pattern.groups, value, templated, require)
+
+    def classify(self, subject, ad=None):
+        """Returns the value of the first rule matching subject, or the default"""
+        if self._regex is None or subject is None:
+            return self.default
+        match = self._regex.match(subject)
+        if match is None:
+            return self.default
+        index, group, n_groups, value, templated, require = self._by_group[
+            match.lastindex
+        ]
+        if require and not self._requirements_met(require, ad):
+            # Rare case, try the remaining rules one by one
+            return self._classify_from(index + 1, subject, ad)
+        if not templated:
+            return value
+        if not n_groups:
+            # match.group() of a single group returns the string, not a tuple
+            return value.format(match.group(group))
+        return value.format(*match.group(*range(group, group + n_groups + 1)))
+
+    def _classify_from(self, start, subject, ad):
+        for pattern, value, require in self.rules[start:]:
+            match = pattern.match(subject)
+            if match and self._requirements_met(require, ad):
+                return value.format(match.group(0), *match.groups())
+        return self.default
+
+    @staticmethod
+    def _requirements_met(require, ad):
+        for attr, substring in require:
+            try:
+                if substring not in ad.get(attr, ""):
+                    return False
+            except (AttributeError, TypeError):
+                return False
+        return True
+
+
+def check_template(field, index, value, n_groups):
+    """
+    Raise ValueError if the value of a rule refers to anything else than the
+    whole match {0} or the groups {1}..{n_groups} of its pattern
+    """
+    try:
+        placeholders = [name for _, name, _, _ in string.Formatter().parse(value) if name is not None]
+    except ValueError as e:
+        raise ValueError("Rule %d of %s: malformed value %r: %s" % (index, field, value, e))
+    for name in placeholders:
+        if not name.isdigit() or int(name) > n_groups:
+            raise ValueError(
+                "Rule %d of %s: value %r refers to {%s}, the pattern has %d groups"
+                % (index, field, value, name, n_groups)
+            )
+
+
+def load_rules(path=_RULES_JSON):
+    """Returns a dict of output field -> RuleMatcher"""
+    with open(path) as fd:
+        config = json.load(fd)
+    matchers = {}
+    for field, spec in config.items():
+        matchers[field] = RuleMatcher(
+            field, spec.get("rules", []), default=spec.get("default")
+        )
+    logging.debug("Loaded classification rules for %s", ", ".join(matchers))
+    return matchers
+
+
+matchers = load_rules()
@@ -10,6 +10,11 @@ import logging
 import datetime
 import zlib
 import base64
+import collections
+import functools
+
+from htcondor_es import classification
+from htcondor_es import encoding
 from htcondor_es.AffiliationManager import (
     AffiliationManager,
     AffiliationManagerException,
@@ -609,36 +614,279 @@ def get_creation_time_from_taskname(ad):
     CRAB task names includes the creation time in format %y%m%d_%H%M%S:
     190309_085131:adeiorio_crab_80xV2_ST_t-channel_top_4f_scaleup_inclusiveDecays_13TeV-powhegV2-madspin-pythia8
     """
+    # fallback to recordtime if there is not a CRAB_Workflow value
+    # or if it hasn't the expected format.
+    creation_time = _parse_taskname_creation_time(ad.get("CRAB_Workflow"))
+    if creation_time is None:
+        return recordTime(ad)
+    return creation_time
+
+
+def _parse_taskname_creation_time(crab_workflow):
     try:
-        _str_date = ad["CRAB_Workflow"].split(":")[0]
+        _str_date = crab_workflow.split(":")[0]
         _naive_date = datetime.datetime.strptime(_str_date, "%y%m%d_%H%M%S")
         return int(calendar.timegm(_naive_date.timetuple()))
-    except (KeyError, TypeError, ValueError):
-        # fallback to recordtime if there is not a CRAB_Workflow value
-        # or if it hasn't the expected format.
-        return recordTime(ad)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class TaskInfoCache(object):
+    """
+    Bounded LRU cache of the fields derived from request/task level attributes.
+
+    Thousands of jobs share the same request, task and CRAB workflow, so
+    the campaign/workflow/task type guessing only has to run once for them.
+    The cache can be saved to and loaded from a json file, so that a new
+    spider run starts with the tasks seen by the previous one. The workers
+    hand the entries they added to the main process (see pop_new_entries and
+    merge), which saves the file once.
+    """
+
+    def __init__(self, maxsize=50000, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        # Entries put since the last pop_new_entries()
+        self._new = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.merge([(key, value)])
+        self._new[key] = value
+        if len(self._new) > self.maxsize:
+            self._new.popitem(last=False)
+
+    def merge(self, entries):
+        """Add the (key, value) entries of pop_new_entries"""
+        for key, value in entries:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop_new_entries(self):
+        """Return the (key, value) entries put since the last call and forget them"""
+        entries = list(self._new.items())
+        self._new.clear()
+        return entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self, path=None):
+        path = path or self.path
+        try:
+            with open(path) as fd:
+                entries = json.load(fd)
+        except (IOError, ValueError) as e:
+            logging.warning("Task info cache %s not loaded: %s", path, str(e))
+            return
+        for key, value in entries[-self.maxsize:]:
+            value[6] = tuple(value[6])
+            self._entries[tuple(key)] = tuple(value)
+        logging.info("Loaded %d task info cache entries from %s", len(entries), path)
+
+    def save(self, path=None):
+        """Write the cache, replacing the file atomically. Called by the main process only."""
+        path = path or self.path
+        tmp_file = path + ".tmp"
+        try:
+            with open(tmp_file, "w") as fd:
+                json.dump(list(self._entries.items()), fd)
+            os.replace(tmp_file, path)
+        except (IOError, OSError) as e:
+            logging.warning("Task info cache %s not saved: %s", path, str(e))
+
+
+task_info_cache = TaskInfoCache(
+    path=os.path.join(
+        os.getenv("SPIDER_WORKDIR", "/home/cmsjobmon/cms-htcondor-es"),
+        "task_info_cache.json",
+    )
+)
+
+_task_info_key_types = (str, bool, type(None))
+
+
+def get_task_info(ad, analysis, result):
+    """
+    Returns the fields that only depend on the request/task of a job:
+    (WMAgent_TaskType, CMS_CampaignType, Campaign, guessed TaskType, Workflow,
+     CRAB task creation time or None, (primary dataset, processed dataset, tier))
+    """
+    key = (
+        analysis,
+        ad.get("WMAgent_RequestName"),
+        ad.get("WMAgent_SubTaskName"),
+        ad.get("CRAB_Workflow"),
+        ad.get("CMS_JobType"),
+        ad.get("CRAB_UserHN"),
+        ad.get("CMS_CampaignName"),
+        result.get("DESIRED_CMSDataset"),
+    )
+    cacheable = all(type(value) in _task_info_key_types for value in key)
+    if cacheable:
+        task_info = task_info_cache.get(key)
+        if task_info is not None:
+            return task_info
+
+    dataset = ("Unknown", "Unknown", "Unknown")
+    if "DESIRED_CMSDataset" in result:
+        info = str(result["DESIRED_CMSDataset"]).split("/")
+        if len(info) > 3:
+            dataset = (info[1], info[2], info[-1])
+    campaign_type = guess_campaign_type(ad, analysis)
+    task_info = (
+        ad.get("WMAgent_SubTaskName", "/UNKNOWN").rsplit("/", 1)[-1],
+        campaign_type,
+        guessCampaign(ad, analysis, campaign_type),
+        guessTaskType(ad),
+        guessWorkflow(ad, analysis),
+        _parse_taskname_creation_time(ad.get("CRAB_Workflow")),
+        dataset,
+    )
+    if cacheable:
+        task_info_cache.put(key, task_info)
+    return task_info
 
 
 _cream_re = re.compile(r"CPUNumber = (\d+)")
 _nordugrid_re = re.compile(r"\(count=(\d+)\)")
-_camp_re = re.compile(r"[A-Za-z0-9_]+_[A-Z0-9]+-([A-Za-z0-9]+)-")
-_prep_re = re.compile(r"[A-Za-z0-9_]+_([A-Z]+-([A-Za-z0-9]+)-[0-9]+)")
-_rval_re = re.compile(r"[A-Za-z0-9]+_(RVCMSSW_[0-9]+_[0-9]+_[0-9]+)")
-_prep_prompt_re = re.compile(r"(PromptReco|Repack|Express)_[A-Za-z0-9]+_([A-Za-z0-9]+)")
 # Executable error messages in WMCore
 _wmcore_exe_exmsg = re.compile(r"^Chirp_WMCore_[A-Za-z0-9]+_Exception_Message$")
-# 2016 reRECO; of the form cerminar_Run2016B-v2-JetHT-23Sep2016_8020_160923_164036_4747
-_rereco_re = re.compile(r"[A-Za-z0-9_]+_Run20[A-Za-z0-9-_]+-([A-Za-z0-9]+)")
 _generic_site = re.compile(r"^[A-Za-z0-9]+_[A-Za-z0-9]+_(.*)_")
 _cms_site = re.compile(r"CMS[A-Za-z]*_(.*)_")
 _cmssw_version = re.compile(r"CMSSW_((\d*)_(\d*)_.*)")
+_chirp_iosite = re.compile(r"ChirpCMSSW(.*?)IOSite_(.*)_(ReadBytes|ReadTimeMS)")
+
+# Expressions evaluated against every ClassAd, parsed once
+_has_singularity_expr = classad.ExprTree("MachineAttrHAS_SINGULARITY0 is true")
+_has_dirac_benchmark_expr = classad.ExprTree("MachineAttrDIRACBenchmark0 isnt undefined")
+
+
+class MaterializedAd(dict):
+    """
+    Plain dict snapshot of a job ClassAd with every attribute already evaluated.
+
+    eval() mimics ClassAd.eval() so the conversion helpers work unchanged.
+    Like on a ClassAd, attribute lookups are case insensitive: the schedds
+    send some attributes in their own casing (DESIRED_SITES), while the
+    helpers look them up as DESIRED_Sites. The keys keep the original names.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MaterializedAd, self).__init__(*args, **kwargs)
+        # Lower-cased name -> original name
+        self._names = {key.lower(): key for key in self}
+
+    def __missing__(self, key):
+        name = self._names.get(key.lower())
+        if name is None:
+            raise KeyError(key)
+        return dict.__getitem__(self, name)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key.lower() in self._names
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, self._names.setdefault(key.lower(), key), value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, self._names.pop(key.lower(), key))
+
+    def get(self, key, default=None):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        name = self._names.get(key.lower())
+        return default if name is None else dict.__getitem__(self, name)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def eval(self, key):
+        return self[key]
+
+    def __reduce__(self):
+        return (MaterializedAd, (dict(self),))
+
+
+def materialize_ad(ad):
+    """
+    Evaluate a ClassAd into a MaterializedAd in a single pass.
+
+    Literal attributes are copied as they are; only expressions are evaluated,
+    and attributes failing evaluation are kept as classad.Value.Error.
+    """
+    values = {}
+    for key, value in ad.items():
+        if isinstance(value, classad.ExprTree):
+            try:
+                value = ad.eval(key)
+            except Exception:
+                value = classad.Value.Error
+        values[key] = value
+    return MaterializedAd(values)
+
+
+def has_singularity(ad):
+    if isinstance(ad, MaterializedAd):
+        return ad.get("MachineAttrHAS_SINGULARITY0") is True
+    return _has_singularity_expr.eval(ad)
+
+
+def has_dirac_benchmark(ad):
+    if isinstance(ad, MaterializedAd):
+        return (
+            ad.get("MachineAttrDIRACBenchmark0", classad.Value.Undefined)
+            is not classad.Value.Undefined
+        )
+    return _has_dirac_benchmark_expr.eval(ad)
 
 
 def convert_to_json(
-    ad, cms=True, return_dict=False, reduce_data=False, pool_name="Unknown"
+    ad,
+    cms=True,
+    return_dict=False,
+    reduce_data=False,
+    pool_name="Unknown",
+    materialize=False,
 ):
+    """
+    Convert a job ClassAd to an ES/AMQ document.
+
+    With materialize=True the ClassAd is first evaluated into a plain dict
+    (see materialize_ad) and all the helpers work on that dict.
+    """
     if ad.get("TaskType") == "ROOT":
         return None
+    if materialize:
+        ad = materialize_ad(ad)
+    result = convert_base_fields(ad, cms=cms, pool_name=pool_name)
+    compute_derived_metrics(ad, result)
+    return finalize_document(result, return_dict=return_dict, reduce_data=reduce_data)
+
+
+def convert_base_fields(ad, cms=True, pool_name="Unknown"):
+    """
+    First conversion stage: copy and classify the job attributes.
+
+    Everything but the numeric metrics of compute_derived_metrics is filled in.
+    Note that ad is updated in place (RequestCpus, RemoteWallClockTime, ...).
+    """
     result = {}
     result["RecordTime"] = recordTime(ad)
     result["DataCollection"] = ad.get("CompletionDate", 0) or _launch_time
@@ -665,32 +913,25 @@ def convert_to_json(
 
     bulk_convert_ad_data(ad, result)
 
-    # Classify failed jobs
-    result["JobFailed"] = jobFailed(ad)
-    result["ErrorType"] = errorType(ad)
-    result["ErrorClass"] = errorClass(result)
-    result["ExitCode"] = commonExitCode(ad)
-    if "ExitCode" in ad:
-        result["CondorExitCode"] = ad["ExitCode"]
+    classify_exit_code(ad, result)
 
+    task_info = get_task_info(ad, analysis, result)
     if cms:
         result["task"] = ad.get("WMAgent_SubTaskName")  # add "task" field to unify with WMArchive
         result["CMS_JobType"] = str(
             ad.get("CMS_JobType", "Analysis" if analysis else "Unknown")
         )
         result["CRAB_AsyncDest"] = str(ad.get("CRAB_AsyncDest", "Unknown"))
-        result["WMAgent_TaskType"] = ad.get("WMAgent_SubTaskName", "/UNKNOWN").rsplit(
-            "/", 1
-        )[-1]
-        result["CMS_CampaignType"] = guess_campaign_type(ad, analysis)
-        result["Campaign"] = guessCampaign(ad, analysis, result["CMS_CampaignType"])
+        result["WMAgent_TaskType"] = task_info[0]
+        result["CMS_CampaignType"] = task_info[1]
+        result["Campaign"] = task_info[2]
         task_type = result.get("CMS_extendedJobType")
         if task_type == "UNKNOWN" or task_type is None:
             task_type = result.get(
-                "CMS_TaskType", result["CMS_JobType"] if analysis else guessTaskType(ad)
+                "CMS_TaskType", result["CMS_JobType"] if analysis else task_info[3]
             )
         result["TaskType"] = task_type
-        result["Workflow"] = guessWorkflow(ad, analysis)
+        result["Workflow"] = task_info[4]
     now = time.time()
     if ad.get("JobStatus") == 2 and (ad.get("EnteredCurrentStatus", now + 1) < now):
         ad["RemoteWallClockTime"] = int(now - ad["EnteredCurrentStatus"])
@@ -730,16 +971,6 @@ def convert_to_json(
         ad["RequestCpus"] = 1.0
     result["RequestCpus"] = ad["RequestCpus"]
 
-    result["CoreHr"] = (
-        ad.get("RequestCpus", 1.0) * int(ad.get("RemoteWallClockTime", 0)) / 3600.0
-    )
-    result["CommittedCoreHr"] = (
-        ad.get("RequestCpus", 1.0) * ad.get("CommittedTime", 0) / 3600.0
-    )
-    result["CommittedWallClockHr"] = ad.get("CommittedTime", 0) / 3600.0
-    result["CpuTimeHr"] = (
-                              ad.get("RemoteSysCpu", 0) + ad.get("RemoteUserCpu", 0)
-                          ) / 3600.0
     result["DiskUsageGB"] = ad.get("DiskUsage_RAW", 0) / 1000000.0
     result["MemoryMB"] = ad.get("ResidentSetSize_RAW", 0) / 1024.0
     result["DataLocations"] = make_list_from_string_field(
@@ -751,17 +982,15 @@ def convert_to_json(
     )
     result["DesiredSiteCount"] = len(result["DESIRED_Sites"])
     result["DataLocationsCount"] = len(result["DataLocations"])
-    result["CRAB_TaskCreationDate"] = get_creation_time_from_taskname(ad)
+    result["CRAB_TaskCreationDate"] = task_info[5]
+    if task_info[5] is None:
+        result["CRAB_TaskCreationDate"] = recordTime(ad)
 
-    result["CMSPrimaryPrimaryDataset"] = "Unknown"
-    result["CMSPrimaryProcessedDataset"] = "Unknown"
-    result["CMSPrimaryDataTier"] = "Unknown"
-    if "DESIRED_CMSDataset" in result:
-        info = str(result["DESIRED_CMSDataset"]).split("/")
-        if len(info) > 3:
-            result["CMSPrimaryPrimaryDataset"] = info[1]
-            result["CMSPrimaryProcessedDataset"] = info[2]
-            result["CMSPrimaryDataTier"] = info[-1]
+    (
+        result["CMSPrimaryPrimaryDataset"],
+        result["CMSPrimaryProcessedDataset"],
+        result["CMSPrimaryDataTier"],
+    ) = task_info[6]
 
     if cms and analysis:
         result["OutputFiles"] = (
@@ -822,23 +1051,8 @@ def convert_to_json(
                     result["OverflowType"] = "IgnoreLocality"
             else:
                 result["OverflowType"] = "Unified"
-    if result["WallClockHr"] == 0:
-        result["CpuEff"] = 0
-    else:
-        result["CpuEff"] = (
-            100
-            * result["CpuTimeHr"]
-            / result["WallClockHr"]
-            / float(ad.get("RequestCpus", 1.0))
-        )
     result["Status"] = status.get(ad.get("JobStatus"), "Unknown")
     result["Universe"] = universe.get(ad.get("JobUniverse"), "Unknown")
-    result["QueueHrs"] = (
-                             ad.get("JobCurrentStartDate", time.time()) - ad["QDate"]
-                         ) / 3600.0
-    result["Badput"] = max(result["CoreHr"] - result["CommittedCoreHr"], 0.0)
-    result["CpuBadput"] = max(result["CoreHr"] - result["CpuTimeHr"], 0.0)
-
     handle_chirp_info(ad, result)
 
     # Parse CRAB3 information on CMSSW version
@@ -853,60 +1067,9 @@ def convert_to_json(
             result["CMSSWMajorVersion"] = "%d_X_X" % subv
             result["CMSSWReleaseSeries"] = "%d_%d_X" % (subv, ssubv)
 
-    # Parse new machine statistics.
-    try:
-        cpus = float(result["GLIDEIN_Cpus"])
-        result["BenchmarkJobHS06"] = float(ad["MachineAttrMJF_JOB_HS06_JOB0"]) / cpus
-        if result.get("EventRate", 0) > 0:
-            result["HS06EventRate"] = result["EventRate"] / result["BenchmarkJobHS06"]
-        if result.get("CpuEventRate", 0) > 0:
-            result["HS06CpuEventRate"] = (
-                result["CpuEventRate"] / result["BenchmarkJobHS06"]
-            )
-        if result.get("CpuTimePerEvent", 0) > 0:
-            result["HS06CpuTimePerEvent"] = (
-                result["CpuTimePerEvent"] * result["BenchmarkJobHS06"]
-            )
-        if result.get("TimePerEvent", 0) > 0:
-            result["HS06TimePerEvent"] = (
-                result["TimePerEvent"] * result["BenchmarkJobHS06"]
-            )
-        result["HS06CoreHr"] = result["CoreHr"] * result["BenchmarkJobHS06"]
-        result["HS06CommittedCoreHr"] = (
-            result["CommittedCoreHr"] * result["BenchmarkJobHS06"]
-        )
-        result["HS06CpuTimeHr"] = result["CpuTimeHr"] * result["BenchmarkJobHS06"]
-    except:
-        result.pop("MachineAttrMJF_JOB_HS06_JOB0", None)
-    if ("MachineAttrDIRACBenchmark0" in ad) and classad.ExprTree(
-        "MachineAttrDIRACBenchmark0 isnt undefined"
-    ).eval(ad):
-        result["BenchmarkJobDB12"] = float(ad["MachineAttrDIRACBenchmark0"])
-        if result.get("EventRate", 0) > 0:
-            result["DB12EventRate"] = result["EventRate"] / result["BenchmarkJobDB12"]
-        if result.get("CpuEventRate", 0) > 0:
-            result["DB12CpuEventRate"] = (
-                result["CpuEventRate"] / result["BenchmarkJobDB12"]
-            )
-        if result.get("CpuTimePerEvent", 0) > 0:
-            result["DB12CpuTimePerEvent"] = (
-                result["CpuTimePerEvent"] * result["BenchmarkJobDB12"]
-            )
-        if result.get("TimePerEvent", 0) > 0:
-            result["DB12TimePerEvent"] = (
-                result["TimePerEvent"] * result["BenchmarkJobDB12"]
-            )
-        result["DB12CoreHr"] = result["CoreHr"] * result["BenchmarkJobDB12"]
-        result["DB12CommittedCoreHr"] = (
-            result["CommittedCoreHr"] * result["BenchmarkJobDB12"]
-        )
-        result["DB12CpuTimeHr"] = result["CpuTimeHr"] * result["BenchmarkJobDB12"]
-
-    result["HasSingularity"] = classad.ExprTree(
-        "MachineAttrHAS_SINGULARITY0 is true"
-    ).eval(ad)
+    result["HasSingularity"] = has_singularity(ad)
     if "ChirpCMSSWCPUModels" in ad and not isinstance(
-        ad["ChirpCMSSWCPUModels"], classad.ExprTree
+        ad["ChirpCMSSWCPUModels"], (classad.ExprTree, classad.Value)
     ):
         result["CPUModel"] = str(ad["ChirpCMSSWCPUModels"])
         result["CPUModelName"] = str(ad["ChirpCMSSWCPUModels"])
@@ -916,17 +1079,7 @@ def convert_to_json(
         result["CPUModelName"] = str(ad["MachineAttrCPUModel0"])
         result["Processor"] = str(ad["MachineAttrCPUModel0"])
 
-    # Affiliation data:
-    if aff_mgr:
-        _aff = None
-        if "CRAB_UserHN" in result:
-            _aff = aff_mgr.getAffiliation(login=result["CRAB_UserHN"])
-        elif "x509userproxysubject" in result:
-            _aff = aff_mgr.getAffiliation(dn=result["x509userproxysubject"])
-
-        if _aff is not None:
-            result["AffiliationInstitute"] = _aff["institute"]
-            result["AffiliationCountry"] = _aff["country"]
+    add_affiliation(result)
 
     # We will use the CRAB_PostJobStatus as the actual status.
     # If is an analysis task and is not completed
@@ -965,7 +1118,104 @@ def convert_to_json(
         else "User",
     )
     result["CMS_WMTool"] = "User" if _wmtool.lower() == "user" else _wmtool
+    return result
+
 
+def compute_derived_metrics(ad, result):
+    """
+    Second conversion stage: CPU/wall time, efficiency and event rate metrics,
+    and their HS06/DB12 normalized versions.
+    """
+    compute_time_metrics(ad, result)
+    normalize_benchmarks(ad, result)
+
+
+def compute_time_metrics(ad, result):
+    """CPU/wall time, efficiency and event rate metrics"""
+    result["CoreHr"] = (
+        ad.get("RequestCpus", 1.0) * int(ad.get("RemoteWallClockTime", 0)) / 3600.0
+    )
+    result["CommittedCoreHr"] = (
+        ad.get("RequestCpus", 1.0) * ad.get("CommittedTime", 0) / 3600.0
+    )
+    result["CommittedWallClockHr"] = ad.get("CommittedTime", 0) / 3600.0
+    result["CpuTimeHr"] = (
+                              ad.get("RemoteSysCpu", 0) + ad.get("RemoteUserCpu", 0)
+                          ) / 3600.0
+    if result["WallClockHr"] == 0:
+        result["CpuEff"] = 0
+    else:
+        result["CpuEff"] = (
+            100
+            * result["CpuTimeHr"]
+            / result["WallClockHr"]
+            / float(ad.get("RequestCpus", 1.0))
+        )
+    result["QueueHrs"] = (
+                             ad.get("JobCurrentStartDate", time.time()) - ad["QDate"]
+                         ) / 3600.0
+    result["Badput"] = max(result["CoreHr"] - result["CommittedCoreHr"], 0.0)
+    result["CpuBadput"] = max(result["CoreHr"] - result["CpuTimeHr"], 0.0)
+    if result["CoreHr"] > 0:
+        result["EventRate"] = result.get("ChirpCMSSWEvents", 0) / float(
+            result["CoreHr"] * 3600.0
+        )
+        if result["EventRate"] > 0:
+            result["TimePerEvent"] = 1.0 / result["EventRate"]
+
+
+def normalize_benchmarks(ad, result):
+    """HS06 and DB12 normalized versions of the time and event rate metrics"""
+    # Parse new machine statistics.
+    try:
+        cpus = float(result["GLIDEIN_Cpus"])
+        result["BenchmarkJobHS06"] = float(ad["MachineAttrMJF_JOB_HS06_JOB0"]) / cpus
+        if result.get("EventRate", 0) > 0:
+            result["HS06EventRate"] = result["EventRate"] / result["BenchmarkJobHS06"]
+        if result.get("CpuEventRate", 0) > 0:
+            result["HS06CpuEventRate"] = (
+                result["CpuEventRate"] / result["BenchmarkJobHS06"]
+            )
+        if result.get("CpuTimePerEvent", 0) > 0:
+            result["HS06CpuTimePerEvent"] = (
+                result["CpuTimePerEvent"] * result["BenchmarkJobHS06"]
+            )
+        if result.get("TimePerEvent", 0) > 0:
+            result["HS06TimePerEvent"] = (
+                result["TimePerEvent"] * result["BenchmarkJobHS06"]
+            )
+        result["HS06CoreHr"] = result["CoreHr"] * result["BenchmarkJobHS06"]
+        result["HS06CommittedCoreHr"] = (
+            result["CommittedCoreHr"] * result["BenchmarkJobHS06"]
+        )
+        result["HS06CpuTimeHr"] = result["CpuTimeHr"] * result["BenchmarkJobHS06"]
+    except:
+        result.pop("MachineAttrMJF_JOB_HS06_JOB0", None)
+    if ("MachineAttrDIRACBenchmark0" in ad) and has_dirac_benchmark(ad):
+        result["BenchmarkJobDB12"] = float(ad["MachineAttrDIRACBenchmark0"])
+        if result.get("EventRate", 0) > 0:
+            result["DB12EventRate"] = result["EventRate"] / result["BenchmarkJobDB12"]
+        if result.get("CpuEventRate", 0) > 0:
+            result["DB12CpuEventRate"] = (
+                result["CpuEventRate"] / result["BenchmarkJobDB12"]
+            )
+        if result.get("CpuTimePerEvent", 0) > 0:
+            result["DB12CpuTimePerEvent"] = (
+                result["CpuTimePerEvent"] * result["BenchmarkJobDB12"]
+            )
+        if result.get("TimePerEvent", 0) > 0:
+            result["DB12TimePerEvent"] = (
+                result["TimePerEvent"] * result["BenchmarkJobDB12"]
+            )
+        result["DB12CoreHr"] = result["CoreHr"] * result["BenchmarkJobDB12"]
+        result["DB12CommittedCoreHr"] = (
+            result["CommittedCoreHr"] * result["BenchmarkJobDB12"]
+        )
+        result["DB12CpuTimeHr"] = result["CpuTimeHr"] * result["BenchmarkJobDB12"]
+
+
+def finalize_document(result, return_dict=False, reduce_data=False):
+    """Last conversion stage: reduce, flag outliers and serialize the document"""
     if reduce_data:
         result = drop_fields_for_running_jobs(result)
 
@@ -975,7 +1225,49 @@ def convert_to_json(
     if return_dict:
         return result
     else:
-        return json.dumps(result)
+        return encoding.dumps(result)
+
+
+def convert_ads(ads, on_error=None, **kwargs):
+    """
+    Generator of (ad, document) pairs for an iterable of job ClassAds.
+
+    The keyword arguments are passed to convert_to_json. The document is None
+    for skipped ads and for failed conversions (reported to on_error).
+    """
+    for ad in ads:
+        doc = None
+        try:
+            doc = convert_to_json(ad, **kwargs)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(ad, e)
+        yield ad, doc
+
+
+def classify_exit_code(ad, result):
+    """Classify failed jobs"""
+    result["JobFailed"] = jobFailed(ad)
+    result["ErrorType"] = errorType(ad)
+    result["ErrorClass"] = errorClass(result)
+    result["ExitCode"] = commonExitCode(ad)
+    if "ExitCode" in ad:
+        result["CondorExitCode"] = ad["ExitCode"]
+
+
+def add_affiliation(result):
+    """Affiliation data of the CRAB user or the proxy DN"""
+    if aff_mgr:
+        _aff = None
+        if "CRAB_UserHN" in result:
+            _aff = aff_mgr.getAffiliation(login=result["CRAB_UserHN"])
+        elif "x509userproxysubject" in result:
+            _aff = aff_mgr.getAffiliation(dn=result["x509userproxysubject"])
+
+        if _aff is not None:
+            result["AffiliationInstitute"] = _aff["institute"]
+            result["AffiliationCountry"] = _aff["country"]
 
 
 def set_outliers(result):
@@ -1014,41 +1306,7 @@ def guessTaskType(ad):
         return "DataProcessing"
     elif jobType == "Production":
         ttype = ad.get("WMAgent_SubTaskName", "/UNKNOWN").rsplit("/", 1)[-1]
-        # Guess an alternate campaign name from the subtask
-        camp2_info = ttype.split("-")
-        if len(camp2_info) > 1:
-            camp2 = camp2_info[1]
-        else:
-            camp2 = ttype
-    
-        if "CleanupUnmerged" in ttype:
-            return "Cleanup"
-        elif "Merge" in ttype:
-            return "Merge"
-        elif "LogCollect" in ttype:
-            return "LogCollect"
-        elif ("MiniAOD" in ad.get("WMAgent_RequestName", "UNKNOWN")) and (
-            ttype == "StepOneProc"
-        ):
-            return "MINIAOD"
-        elif "MiniAOD" in ttype:
-            return "MINIAOD"
-        elif ttype == "StepOneProc" and (
-            re.search("[1-9][0-9]DR", camp2)
-        ):
-            return "DIGIRECO"
-        elif (
-            re.search("[1-9][0-9]GS", camp2)
-        ) and ttype.endswith("_0"):
-            return "GENSIM"
-        elif ttype.endswith("_0"):
-            return "DIGI"
-        elif ttype.endswith("_1") or ttype.lower() == "reco":
-            return "RECO"
-        elif ttype == "MonteCarloFromGEN":
-            return "GENSIM"
-        else:
-            return "UNKNOWN"
+        return classification.matchers["TaskType"].classify(ttype, ad)
     else:
         return jobType
 
@@ -1060,22 +1318,11 @@ def guessCampaign(ad, analysis, cms_campaign_type):
         return ad.get("CMS_CampaignName")
     if analysis:
         return "crab_" + ad.get("CRAB_UserHN", "UNKNOWN")
-    if camp.startswith("PromptReco"):
-        return "PromptReco"
-    if camp.startswith("Repack"):
-        return "Repack"
-    if camp.startswith("Express"):
-        return "Express"
-    if "RVCMSSW" in camp:
-        return "RelVal"
-    m = _camp_re.match(camp)
-    if m:
-        return m.groups()[0]
-    m = _rereco_re.match(camp)
-    if m and ("DataProcessing" in ad.get("WMAgent_SubTaskName", "")):
-        return m.groups()[0] + "Reprocessing"
+    campaign = classification.matchers["Campaign"].classify(camp, ad)
+    if campaign is not None:
+        return campaign
     # [Temp solution] If Campaign not found, return CMS_CampaignType
-    logging.info("Campaign will be CMS_CampaignType. camp:{}".format(camp))
+    logging.info("Campaign will be CMS_CampaignType. camp:%s", camp)
     return cms_campaign_type
 
 
@@ -1085,50 +1332,25 @@ def guess_campaign_type(ad, analysis):
         The campaign type is based on the classification defined at
         https://its.cern.ch/jira/browse/CMSMONIT-174#comment-3050384
     """
-    camp = ad.get("WMAgent_RequestName", "UNKNOWN")
     if analysis:
         return "Analysis"
-    elif re.match(r".*(RunIISummer([12])[0-9]UL|_UL[0-9]+).*", camp):
-        return "MC Ultralegacy"
-    elif re.match(r".*UltraLegacy.*", camp):
-        return "Data Ultralegacy"
-    elif re.match(r".*Phase2.*", camp):
-        return "Phase2 requests"
-    elif re.match(r".*(Run3|RunIII).*", camp):
-        return "Run3 requests"
-    elif "RVCMSSW" in camp:
-        return "RelVal"
-    elif re.match(r".*(RunII|(Summer|Fall|Autumn|Winter|Spring)(1[5-9]|20)).*", camp):  # [!] Should be after UL
-        return "Run2 requests"
-    elif "SnowmassWinter21" in camp:
-        # Example WMAgent_RequestName: pdmvserv_task_TSG-SnowmassWinter21wmLHEGEN-00229__v1_T_211208_125036_3179
-        return "SnowmassWinter21"
-    else:
-        return "UNKNOWN"
+    camp = ad.get("WMAgent_RequestName", "UNKNOWN")
+    return classification.matchers["CMS_CampaignType"].classify(camp, ad)
 
 
 def guessWorkflow(ad, analysis):
-    prep = ad.get("WMAgent_RequestName", "UNKNOWN")
-    m = _prep_re.match(prep)
     if analysis:
         return ad.get("CRAB_Workflow", "UNKNOWN").split(":", 1)[-1]
-    elif m:
-        return m.groups()[0]
-    else:
-        m = _prep_prompt_re.match(prep)
-        if m:
-            return m.groups()[0] + "_" + m.groups()[1]
-        else:
-            m = _rval_re.match(prep)
-            if m:
-                return m.groups()[0]
-
+    prep = ad.get("WMAgent_RequestName", "UNKNOWN")
+    workflow = classification.matchers["Workflow"].classify(prep, ad)
+    if workflow is not None:
+        return workflow
     return prep
 
 
 def chirpCMSSWIOSiteName(key):
     """Extract site name from ChirpCMSS_IOSite key"""
-    iosite_match = re.match(r"ChirpCMSSW(.*?)IOSite_(.*)_(ReadBytes|ReadTimeMS)", key)
+    iosite_match = _chirp_iosite.match(key)
     return iosite_match.group(2), iosite_match.group(1).strip("_")
 
 
@@ -1258,40 +1480,45 @@ def handle_chirp_info(ad, result):
 
     Chirp statistics should be available in CMSSW_8_0_0 and later.
     """
-    for key, val in list(result.items()):
-        if key.startswith("ChirpCMSSW") and "IOSite" in key:
-            sitename, chirpstring = chirpCMSSWIOSiteName(key)
-            keybase = key.rsplit("_", 1)[0]
-            try:
-                readbytes = result.pop(keybase + "_ReadBytes")
-                readtimems = result.pop(keybase + "_ReadTimeMS")
-                siteio = {}
-                siteio["SiteName"] = sitename
-                siteio["ChirpString"] = chirpstring
-                siteio["ReadBytes"] = readbytes
-                siteio["ReadTimeMS"] = readtimems
-                result.setdefault("ChirpCMSSW_SiteIO", []).append(siteio)
-
-            except KeyError:
-                # First hit will pop both ReadBytes and ReadTimeMS fields hence
-                # second hit will throw a KeyError that we want to ignore
-                pass
-
+    totals = {}
+    iosites = {}
+    for key, val in result.items():
+        if not key.startswith("ChirpCMSSW"):
             continue
+        plan = _CHIRP_KEY_PLANS.get(key)
+        if plan is None:
+            plan = _make_chirp_key_plan(key)
+            if len(_CHIRP_KEY_PLANS) < _KEY_PLANS_MAX_SIZE:
+                _CHIRP_KEY_PLANS[key] = plan
+        if plan is _SKIP:
+            continue
+        is_iosite, target, arg1, arg2 = plan
+        if is_iosite:
+            # ReadBytes/ReadTimeMS pairs, named after the first key seen
+            if target not in iosites:
+                iosites[target] = (arg1, arg2)
+            continue
+        if target in totals:
+            total = totals[target]
+        elif target in result:
+            total = result[target]
+        else:
+            totals[target] = val
+            continue
+        totals[target] = max(total, val) if arg1 else total + val
 
-        if key.startswith("ChirpCMSSW_"):
-            cmssw_key = "ChirpCMSSW" + key.split("_", 2)[-1]
-            if cmssw_key not in result:
-                result[cmssw_key] = val
-            elif (
-                cmssw_key.endswith("LastUpdate")
-                or cmssw_key.endswith("Events")
-                or cmssw_key.endswith("MaxLumis")
-                or cmssw_key.endswith("MaxFiles")
-            ):
-                result[cmssw_key] = max(result[cmssw_key], val)
-            else:
-                result[cmssw_key] += val
+    for keybase, (sitename, chirpstring) in iosites.items():
+        # A ReadBytes value without its ReadTimeMS is dropped
+        readbytes = result.pop(keybase + "_ReadBytes", _SKIP)
+        if readbytes is _SKIP or keybase + "_ReadTimeMS" not in result:
+            continue
+        siteio = {}
+        siteio["SiteName"] = sitename
+        siteio["ChirpString"] = chirpstring
+        siteio["ReadBytes"] = readbytes
+        siteio["ReadTimeMS"] = result.pop(keybase + "_ReadTimeMS")
+        result.setdefault("ChirpCMSSW_SiteIO", []).append(siteio)
+    result.update(totals)
 
     if "ChirpCMSSWFiles" in result:
         result["CompletedFiles"] = result["ChirpCMSSWFiles"]
@@ -1330,12 +1557,6 @@ def handle_chirp_info(ad, result):
         )
         if result["CMSSWEventRate"] > 0:
             result["CMSSWTimePerEvent"] = 1.0 / result["CMSSWEventRate"]
-    if result["CoreHr"] > 0:
-        result["EventRate"] = result.get("ChirpCMSSWEvents", 0) / float(
-            result["CoreHr"] * 3600.0
-        )
-        if result["EventRate"] > 0:
-            result["TimePerEvent"] = 1.0 / result["EventRate"]
     if ("ChirpCMSSWReadOps" in result) and ("ChirpCMSSWReadSegments" in result):
         ops = result["ChirpCMSSWReadSegments"] + result["ChirpCMSSWReadOps"]
         if ops:
@@ -1348,70 +1569,227 @@ def handle_chirp_info(ad, result):
             result["ReadOpsPercent"] = result["ChirpCMSSWReadOps"] / float(ops) * 100
 
 
-_CONVERT_COUNT = 0
-_CONVERT_CPU = 0
+class StageTimer(object):
+    """
+    Wall/CPU time and call counts of the conversion stages, for diagnostics.
+
+    Disabled by default. enable() replaces the stage functions of this module
+    with timed wrappers, so that there is no overhead at all while disabled.
+    The totals are per process, reset them before each schedd.
+    """
+
+    # (stage, function of this module), the stages do not nest
+    stages = (
+        ("materialize", "materialize_ad"),
+        ("bulk_convert", "bulk_convert_ad_data"),
+        ("exit_codes", "classify_exit_code"),
+        ("task_info", "get_task_info"),
+        ("chirp", "handle_chirp_info"),
+        ("time_metrics", "compute_time_metrics"),
+        ("benchmarks", "normalize_benchmarks"),
+        ("affiliation", "add_affiliation"),
+        ("drop_running_fields", "drop_fields_for_running_jobs"),
+    )
+
+    def __init__(self):
+        self.enabled = False
+        self._originals = {}
+        self.reset()
+
+    def reset(self):
+        # stage -> [calls, wall seconds, cpu seconds]
+        self.totals = collections.OrderedDict(
+            (stage, [0, 0.0, 0.0]) for stage, _ in self.stages
+        )
+
+    def enable(self):
+        if self.enabled:
+            return
+        module = globals()
+        for stage, name in self.stages:
+            self._originals[name] = module[name]
+            module[name] = self._timed(stage, module[name])
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        globals().update(self._originals)
+        self._originals = {}
+        self.enabled = False
+
+    def _timed(self, stage, func):
+        perf_counter = time.perf_counter
+        process_time = time.process_time
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            wall = perf_counter()
+            cpu = process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                totals = self.totals[stage]
+                totals[0] += 1
+                totals[1] += perf_counter() - wall
+                totals[2] += process_time() - cpu
+
+        return timed
+
+    def report(self, label):
+        """Log the totals of the stages that ran"""
+        for stage, (calls, wall, cpu) in self.totals.items():
+            if not calls:
+                continue
+            logging.warning(
+                "%s conversion stage %-19s %8d calls; wall %8.2f s; "
+                "cpu %8.2f s; %8.1f us cpu/call",
+                label,
+                stage,
+                calls,
+                wall,
+                cpu,
+                cpu / calls * 1e6,
+            )
+
+
+stage_timer = StageTimer()
+
+
+# Process-wide cache of per-attribute conversion plans, built lazily by
+# _get_key_plan. Per-site Chirp keys make the attribute vocabulary open-ended,
+# hence the size bound.
+_KEY_PLANS = {}
+_KEY_PLANS_MAX_SIZE = 20000
+
+# Marks an attribute (or a value) that should not be copied to the document
+_SKIP = object()
+
+# Same for the ChirpCMSSW* attributes handled by handle_chirp_info
+_CHIRP_KEY_PLANS = {}
+
+# Per step Chirp counters that are maxed rather than summed over the steps
+_chirp_max_suffixes = ("LastUpdate", "Events", "MaxLumis", "MaxFiles")
+
+
+def _convert_bool(key, value):
+    return bool(value)
+
+
+def _convert_int(key, value):
+    try:
+        return int(value)
+    except ValueError:
+        if value == "Unknown":
+            return None
+        elif (key == "MATCH_EXP_JOB_GLIDEIN_MaxMemMBs") and (value == "GLIDEIN_MaxMemMBs"):
+            # FIXME after SI/WMA/CRAB teams solve this upstream. This key should be convertible to int
+            return _SKIP
+        logging.warning(
+            "Failed to convert key %s with value %s to int" % (key, repr(value))
+        )
+        return _SKIP
+
+
+def _convert_string(key, value):
+    return str(value)
+
+
+def _convert_date(key, value):
+    if value == 0 or (isinstance(value, str) and value.lower() == "unknown"):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        logging.warning(
+            "Failed to convert key %s with value %s to int for a date field"
+            % (key, repr(value))
+        )
+        return None
+
+
+def _make_key_plan(key):
+    """
+    Work out once how a raw ClassAd attribute is copied to the document.
+
+    Returns _SKIP for ignored attributes, otherwise a tuple of
+    (type_key, output_key, handler, decompress) where handler may be None
+    for attributes that are copied verbatim.
+    """
+    if key in ignore:
+        return _SKIP
+    if key.startswith("HasBeen") and key not in bool_vals:
+        return _SKIP
+    type_key = "DESIRED_Sites" if key == "DESIRED_SITES" else key
+    if type_key in bool_vals:
+        handler = _convert_bool
+    elif type_key in int_vals:
+        handler = _convert_int
+    elif type_key in string_vals:
+        handler = _convert_string
+    elif type_key in date_vals:
+        handler = _convert_date
+    else:
+        handler = None
+    out_key = type_key
+    if out_key.startswith("MATCH_EXP_JOB_"):
+        out_key = out_key[len("MATCH_EXP_JOB_"):]
+    if out_key.endswith("_RAW"):
+        out_key = out_key[: -len("_RAW")]
+    decompress = bool(_wmcore_exe_exmsg.match(out_key))
+    return type_key, out_key, handler, decompress
+
+
+def _make_chirp_key_plan(key):
+    """
+    Work out once what handle_chirp_info does with a ChirpCMSSW* attribute.
+
+    Returns _SKIP for attributes it leaves alone, otherwise a tuple of
+    (True, keybase, sitename, chirpstring) for the per site IO attributes or
+    (False, aggregated_key, use_max, None) for the per step counters.
+    """
+    if "IOSite" in key:
+        sitename, chirpstring = chirpCMSSWIOSiteName(key)
+        return True, key.rsplit("_", 1)[0], sitename, chirpstring
+    if key.startswith("ChirpCMSSW_"):
+        cmssw_key = "ChirpCMSSW" + key.split("_", 2)[-1]
+        return False, cmssw_key, cmssw_key.endswith(_chirp_max_suffixes), None
+    return _SKIP
+
+
+def _get_key_plan(key):
+    plan = _KEY_PLANS.get(key)
+    if plan is None:
+        plan = _make_key_plan(key)
+        if len(_KEY_PLANS) < _KEY_PLANS_MAX_SIZE:
+            _KEY_PLANS[key] = plan
+    return plan
 
 
 def bulk_convert_ad_data(ad, result):
     """
     Given a ClassAd, bulk convert to a python dictionary.
     """
-    _keys = set(ad.keys()) - ignore
-    for key in _keys:
-        if key.startswith("HasBeen") and key not in bool_vals:
+    for key in ad.keys():
+        plan = _get_key_plan(key)
+        if plan is _SKIP:
             continue
-        if key == "DESIRED_SITES":
-            key = "DESIRED_Sites"
+        type_key, out_key, handler, decompress = plan
         try:
             value = ad.eval(key)
         except:
             continue
         if isinstance(value, classad.Value):
-            _is_err_cond = value is classad.Value.Error
-            if _is_err_cond:
+            if value is classad.Value.Error:
                 continue
-            else:
-                value = None
-        elif key in bool_vals:
-            value = bool(value)
-        elif key in int_vals:
-            try:
-                value = int(value)
-            except ValueError:
-                if value == "Unknown":
-                    value = None
-                elif (key == "MATCH_EXP_JOB_GLIDEIN_MaxMemMBs") and (value == "GLIDEIN_MaxMemMBs"):
-                    # FIXME after SI/WMA/CRAB teams solve this upstream. This key should be convertible to int
-                    continue
-                else:
-                    logging.warning(
-                        "Failed to convert key %s with value %s to int"
-                        % (key, repr(value))
-                    )
-                    continue
-        elif key in string_vals:
-            value = str(value)
-        elif key in date_vals:
-            if value == 0 or (isinstance(value, str) and value.lower() == "unknown"):
-                value = None
-            else:
-                try:
-                    value = int(value)
-                except ValueError:
-                    logging.warning(
-                        "Failed to convert key %s with value %s to int for a date field"
-                        % (key, repr(value))
-                    )
-                    value = None
-        # elif key in date_vals:
-        #    value = datetime.datetime.fromtimestamp(value).strftime("%Y-%m-%d %H:%M:%S")
-        if key.startswith("MATCH_EXP_JOB_"):
-            key = key[len("MATCH_EXP_JOB_"):]
-        if key.endswith("_RAW"):
-            key = key[: -len("_RAW")]
-        if _wmcore_exe_exmsg.match(key):
+            value = None
+        elif handler is not None:
+            value = handler(type_key, value)
+            if value is _SKIP:
+                continue
+        if decompress:
             value = str(decode_and_decompress(value))
-        result[key] = value
+        result[out_key] = value
     evaluate_fields(result, ad)
 
 
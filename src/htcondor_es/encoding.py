@@ -0,0 +1,78 @@
+"""
+JSON encoding of the documents sent to ES, and of convert_to_json's output.
+
+The stdlib json module is used by default, its output is unchanged. The
+"orjson" backend ("auto" picks it when orjson is installed) is several times
+faster. It produces the same documents once parsed, but not the same bytes:
+compact separators, UTF-8 instead of \\u escapes and the shortest float
+representation (1e-7 instead of 1e-07). Non finite floats, which the json
+module writes as the non standard NaN/Infinity, are written as null.
+Documents orjson refuses (integers beyond 64 bits, non string keys) are
+encoded with the json module instead.
+
+The backend is a per process setting, select it before forking the workers.
+orjson is only imported when it is selected.
+"""
+
+import json
+import logging
+
+orjson = None
+
+BACKENDS = ("auto", "json", "orjson")
+
+_backend = "json"
+
+
+def set_backend(name):
+    """Select the encoder of this process, returns the backend in use"""
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError("Unknown JSON backend %s, use one of %s" % (name, BACKENDS))
+    if name == "auto":
+        name = "orjson" if _import_orjson() else "json"
+    elif name == "orjson" and not _import_orjson():
+        logging.warning("orjson is not installed, using the json module")
+        name = "json"
+    _backend = name
+    return name
+
+
+def _import_orjson():
+    global orjson
+    if orjson is None:
+        try:
+            import orjson as _orjson
+        except ImportError:
+            return False
+        orjson = _orjson
+    return True
+
+
+def get_backend():
+    return _backend
+
+
+def dumps(obj):
+    """Encode obj as a JSON str"""
+    if _backend == "orjson":
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj)
+
+
+def dumpb(obj):
+    """Encode obj as UTF-8 JSON bytes"""
+    if _backend == "orjson":
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj).encode("utf-8")
+
+
+def item_separator():
+    """Separator between the members of an object, for splicing encoded documents"""
+    return b"," if _backend == "orjson" else b", "
@@ -5,13 +5,16 @@ import json
 import logging
 import os
 import socket
+import threading
 import time
 from collections import Counter as collectionsCounter
+from concurrent import futures
 
 import elasticsearch
 from opensearchpy import OpenSearch
 
 import htcondor_es.convert_to_json
+from htcondor_es import encoding
 
 _WORKDIR = os.getenv("SPIDER_WORKDIR", "/home/cmsjobmon/cms-htcondor-es")
 
@@ -27,6 +30,20 @@ _es_clients = None
 # Global index cache, keep tracks of daily indices that are already created with mapping for all clusters
 _index_cache = set()
 
+# Threads sending the bulks to all clusters concurrently, per process
+_bulk_executor = None
+_bulk_executor_pid = None
+
+# Bulks not acknowledged yet by the clusters left behind with --es_delivery quorum,
+# awaited (and retried) by the next post_ads calls or by flush()
+_laggards = []
+_MAX_LAGGING_BULKS = 4  # per cluster, post_ads waits for the oldest beyond this
+_LAGGARD_RETRIES = 2
+
+# Bulks, time and failures per cluster, since the last report_clusters()
+_cluster_stats = {}
+_cluster_stats_lock = threading.Lock()
+
 
 class ElasticAndOpenSearchInterfaces(object):
     """Interface to elasticsearch
@@ -43,6 +60,9 @@ class ElasticAndOpenSearchInterfaces(object):
           { "host": "es-cmsZ(OpenSearch).cern.ch/es", "username": "user", "password": "pass" },
           ...
         ]
+
+    An instance can set "use_ssl": false to be reached over plain http, e.g. the local
+    stand-in of tests/fakeUploadEndpoints.py.
     """
 
     def __init__(self, mock_cern_domain=False):
@@ -55,16 +75,18 @@ class ElasticAndOpenSearchInterfaces(object):
                     creds = json.loads(f.read())
                     self.host_count = len(creds)
                     for cred in creds:
+                        use_ssl = cred.get("use_ssl", True)
                         if cred["host"].endswith("/os"):
                             logging.info("OpenSearch instance is initializing")
-                            url = 'https://' + cred["username"] + ':' + cred["password"] + '@' + cred["host"]
+                            scheme = "https://" if use_ssl else "http://"
+                            url = scheme + cred["username"] + ':' + cred["password"] + '@' + cred["host"]
                             self.handles.add(
                                 OpenSearch(
                                     [url],
                                     verify_certs=False,
                                     # TODO: Keep it false until we confirm that CERN grid
                                     #       certificates are up-to-date
-                                    use_ssl=True,
+                                    use_ssl=use_ssl,
                                     ca_certs="/etc/pki/tls/certs/ca-bundle.trust.crt",
                                 )
                             )
@@ -77,7 +99,7 @@ class ElasticAndOpenSearchInterfaces(object):
                                     "http_auth": cred["username"] + ":" + cred["password"],
                                 }],
                                 verify_certs=True,
-                                use_ssl=True,
+                                use_ssl=use_ssl,
                                 ca_certs="/etc/pki/tls/certs/ca-bundle.trust.crt",
                                 maxsize=25,  # https://elasticsearch-py.readthedocs.io/en/7.x/#thread-safety
                             ))
@@ -161,21 +183,173 @@ def get_index(timestamp, template, args, update_es=True):
     return idx
 
 
-def post_ads(args, idx, ads, metadata=None):
+def post_ads(args, idx, ads, metadata=None, wait_laggards=False):
     """
-    Send ads in bulks to all ES OpenSearch instances
+    Send ads in bulks to all ES OpenSearch instances, concurrently
+
+    The bulk body is built once. With --es_delivery all, waits for every
+    cluster and raises the error of a failed one. With quorum, returns once a
+    majority of the clusters acknowledged the bulk, the requests to the other
+    ones are awaited, and retried if they fail, by the next calls, by flush()
+    or right away with wait_laggards.
+
+    Returns the number of documents the acknowledging clusters failed to index.
     """
     global _es_clients
     _es_clients = get_es_clients(args=args)
+    handles = list(_es_clients.handles)
+    if not handles:
+        return 0
+    executor = _get_bulk_executor(len(handles))
     body = make_es_body(ads, metadata)
+    str_body = None
+    pending = {}
+    for _handle in handles:
+        _body = body
+        if isinstance(_handle, elasticsearch.Elasticsearch):
+            # elasticsearch 7.6 fails on bytes bulk bodies, OpenSearch takes them as they are
+            str_body = str_body or body.decode("utf-8")
+            _body = str_body
+        pending[executor.submit(_bulk, _handle, idx, _body)] = (_handle, _body)
+
+    needed = len(handles) // 2 + 1 if args.es_delivery == "quorum" else len(handles)
+    acknowledged = 0
     result_n_failed = 0
-    for _handle in _es_clients.handles:
-        res = _handle.bulk(body=body, index=idx, request_timeout=120)
-        if res.get("errors"):
-            result_n_failed += parse_errors(res)
+    error = None
+    while pending and acknowledged < needed:
+        done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+        for future in done:
+            _handle, _body = pending.pop(future)
+            try:
+                result_n_failed += future.result()
+                acknowledged += 1
+            except Exception as e:
+                error = error or e
+                if args.es_delivery == "quorum":
+                    _laggards.append([_handle, idx, _body, None, 0])
+        if acknowledged + len(pending) < needed:
+            break
+    if args.es_delivery == "quorum":
+        for future, (_handle, _body) in pending.items():
+            _laggards.append([_handle, idx, _body, future, 0])
+    elif pending:
+        # The bulk failed already, the requests left are not counted
+        for future in pending:
+            future.cancel()
+        futures.wait(pending)
+
+    _await_laggards(executor, wait_all=wait_laggards)
+    if acknowledged < needed:
+        raise error
     return result_n_failed
 
 
+def flush():
+    """Wait for the bulks left to the lagging clusters by post_ads"""
+    if _laggards:
+        _await_laggards(_get_bulk_executor(len(_es_clients.handles)), wait_all=True)
+
+
+def report_clusters(label):
+    """Log the bulk statistics of each cluster since the last report"""
+    global _cluster_stats
+    with _cluster_stats_lock:
+        stats, _cluster_stats = _cluster_stats, {}
+    for name, cluster in sorted(stats.items()):
+        logging.warning(
+            "ES cluster %s for %s: %d bulks in %.2f min, mean %.2f s, max %.2f s; "
+            "%d failed bulks, %d failed docs",
+            name,
+            label,
+            cluster["bulks"],
+            cluster["secs"] / 60.0,
+            cluster["secs"] / max(1, cluster["bulks"]),
+            cluster["max_secs"],
+            cluster["failed_bulks"],
+            cluster["failed_docs"],
+        )
+
+
+def _handle_name(handle):
+    host = handle.transport.hosts[0]
+    return "%s:%s%s" % (host.get("host"), host.get("port", ""), host.get("url_prefix", ""))
+
+
+def _get_bulk_executor(n_handles):
+    """Threads of this process, the ones of a forked parent are gone"""
+    global _bulk_executor, _bulk_executor_pid
+    if _bulk_executor is None or _bulk_executor_pid != os.getpid():
+        _bulk_executor = futures.ThreadPoolExecutor(max_workers=n_handles * (_MAX_LAGGING_BULKS + 1))
+        _bulk_executor_pid = os.getpid()
+    return _bulk_executor
+
+
+def _bulk(handle, idx, body):
+    """Send a bulk to a cluster, returns the number of failed documents"""
+    st = time.time()
+    n_failed = 0
+    failed = True
+    try:
+        res = handle.bulk(body=body, index=idx, request_timeout=120)
+        if res.get("errors"):
+            n_failed = parse_errors(res)
+        failed = False
+        return n_failed
+    finally:
+        elapsed = time.time() - st
+        with _cluster_stats_lock:
+            cluster = _cluster_stats.setdefault(
+                _handle_name(handle),
+                {"bulks": 0, "secs": 0.0, "max_secs": 0.0, "failed_bulks": 0, "failed_docs": 0},
+            )
+            cluster["bulks"] += 1
+            cluster["secs"] += elapsed
+            cluster["max_secs"] = max(cluster["max_secs"], elapsed)
+            cluster["failed_bulks"] += failed
+            cluster["failed_docs"] += n_failed
+
+
+def _await_laggards(executor, wait_all=False):
+    """
+    Collect the bulks of the lagging clusters which are done and retry the
+    failed ones. Waits for all of them with wait_all, otherwise only for the
+    oldest ones of a cluster lagging more than _MAX_LAGGING_BULKS bulks.
+    """
+    while True:
+        excess = collectionsCounter(laggard[0] for laggard in _laggards)
+        for _handle in excess:
+            excess[_handle] -= _MAX_LAGGING_BULKS
+        ready = []
+        for laggard in _laggards:
+            if wait_all or laggard[3] is None or laggard[3].done() or excess[laggard[0]] > 0:
+                ready.append(laggard)
+            excess[laggard[0]] -= 1
+        if not ready:
+            return
+        for laggard in ready:
+            _handle, idx, body, future, attempt = laggard
+            if future is None:
+                laggard[3] = executor.submit(_bulk, _handle, idx, body)
+                laggard[4] = attempt + 1
+                continue
+            try:
+                future.result()
+                _laggards.remove(laggard)
+            except Exception as e:
+                if attempt < _LAGGARD_RETRIES:
+                    laggard[3] = None
+                    continue
+                _laggards.remove(laggard)
+                logging.error(
+                    "Cluster %s failed to index a bulk of %s after %d retries, "
+                    "the documents are missing there: %s",
+                    _handle_name(_handle),
+                    idx,
+                    attempt,
+                    str(e),
+                )
+
+
 def filter_name(keys):
     """
     Filters ClassAd fields and removes 'MATCH_EXP_JOB_' prefix and '_RAW' suffix
@@ -248,17 +422,38 @@ def make_settings():
 def make_es_body(ads, metadata=None):
     """
     Prepares ES documents for bulk send by adding metadata part, adding _id part and separating with new line
+
+    Returns the bulk body as bytes, encoded with the selected htcondor_es.encoding
+    backend. The metadata is encoded once and spliced into every document, the
+    ads themselves are not modified.
     """
-    metadata = metadata or {}
-    body = ""
+    metadata_tail = None
+    if metadata:
+        metadata_tail = (
+            encoding.item_separator()
+            + encoding.dumpb({"metadata": metadata})[1:]
+            + b"\n"
+        )
+    chunks = []
     for id_, ad in ads:
-        if metadata:
-            ad.setdefault("metadata", {}).update(metadata)
-
-        body += json.dumps({"index": {"_id": id_}}) + "\n"
-        body += json.dumps(ad) + "\n"
-
-    return body
+        chunks.append(encoding.dumpb({"index": {"_id": id_}}))
+        chunks.append(b"\n")
+        if not metadata_tail:
+            chunks.append(encoding.dumpb(ad))
+            chunks.append(b"\n")
+        elif "metadata" in ad or not ad:
+            # Rare cases, merge with the document's own metadata
+            doc = dict(ad)
+            doc["metadata"] = dict(doc.get("metadata", {}))
+            doc["metadata"].update(metadata)
+            chunks.append(encoding.dumpb(doc))
+            chunks.append(b"\n")
+        else:
+            # Drop the closing brace of the document, metadata_tail closes it
+            chunks.append(memoryview(encoding.dumpb(ad))[:-1])
+            chunks.append(metadata_tail)
+
+    return b"".join(chunks)
 
 
 def parse_errors(result):
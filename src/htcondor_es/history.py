@@ -3,193 +3,491 @@ Methods for processing the history in a schedd queue.
 """
 
 import datetime
-import json
+import hashlib
 import logging
+import math
 import multiprocessing
 import os
+import queue
+import sqlite3
+import threading
 import time
 import traceback
 
 import classad
 import elasticsearch
-import htcondor
 
 import htcondor_es.amq
+import htcondor_es.checkpoint
 import htcondor_es.es
+import htcondor_es.projection
+import htcondor_es.utils
+from htcondor_es.convert_to_json import convert_ads
 from htcondor_es.convert_to_json import convert_dates_to_millisecs
-from htcondor_es.convert_to_json import convert_to_json
+from htcondor_es.convert_to_json import stage_timer
+from htcondor_es.convert_to_json import task_info_cache
 from htcondor_es.convert_to_json import unique_doc_id
 from htcondor_es.utils import send_email_alert, time_remaining, TIMEOUT_MINS
+from htcondor_es.utils import load_schedd_stats, save_schedd_stats, longest_first, log_makespan
 
 # Main query time, should be same with cron schedule.
 QUERY_TIME_PERIOD = 720  # 12 minutes
 
-# Even in checkpoint.json last query time is older than this, older than "now()-12h" results will be ignored.
+# Even in checkpoint last query time is older than this, older than "now()-12h" results will be ignored.
 CRAB_MAX_QUERY_TIME_SPAN = 12 * 3600  # 12 hours
 
-# If last query time in checkpoint.json is too old, but not from crab, results older
+# If last query time in checkpoint is too old, but not from crab, results older
 # than "now()-RETENTION_POLICY" will be ignored.
 RETENTION_POLICY = 39 * 24 * 3600  # 39 days
 
+# Each progress sub-window is one more history query, each scanning the schedd
+# history from its newest record, so a long window gets longer sub-windows.
+MAX_PROGRESS_WINDOWS = 12
+
 _WORKDIR = os.getenv("SPIDER_WORKDIR", "/home/cmsjobmon/cms-htcondor-es")
-_CHECKPOINT_JSON = os.path.join(_WORKDIR, "checkpoint.json")
+# Ads, time window and processing time of the last complete history crawl of each schedd,
+# to split the heavy ones and to start with the longest ones
+_HISTORY_STATS_JSON = os.path.join(_WORKDIR, "history_stats.json")
+
+
+def history_constraint(begin, end=None, crab_postjob=True):
+    """
+    Return the history query of the jobs which entered their current status
+    in [begin, end), end is open if None. The CRAB jobs updated by their
+    PostJob since begin are added with crab_postjob, only the first
+    sub-window of a split schedd asks for them so that they are not
+    returned twice.
+    """
+    _q = """
+        (JobUniverse == 5) && (CMS_Type != "DONOTMONIT")
+        &&
+        (
+            EnteredCurrentStatus >= %(begin)d
+            %(crab_postjob)s
+        )
+        %(end)s
+        """
+    return classad.ExprTree(
+        _q
+        % {
+            "begin": begin,
+            "crab_postjob": "|| CRAB_PostJobLastUpdate >= %d" % begin if crab_postjob else "",
+            "end": "&& EnteredCurrentStatus < %d" % end if end is not None else "",
+        }
+    )
+
+
+def split_windows(name, begin, now, history_stats, args):
+    """
+    Split the [begin, now] history window of a schedd in sub-windows of about
+    args.history_split_ads ads, estimated from the rate of its last crawl,
+    at most one per query process. Returns a list of
+    (index, n_windows, begin, end) tuples, the last one is open ended.
+    """
+    stats = history_stats.get(name)
+    n_windows = 1
+    if args.history_split_ads and stats and stats.get("window_secs"):
+        expected_ads = stats["ads"] * (now - begin) / stats["window_secs"]
+        n_windows = int(math.ceil(expected_ads / args.history_split_ads))
+        n_windows = max(1, min(n_windows, args.query_pool_size))
+    if n_windows == 1:
+        return [None]
+
+    logging.warning(
+        "Schedd %s history split in %d sub-windows, about %d ads expected",
+        name,
+        n_windows,
+        expected_ads,
+    )
+    step = (now - begin) / float(n_windows)
+    bounds = [int(begin + i * step) for i in range(n_windows)] + [None]
+    return [(i, n_windows, bounds[i], bounds[i + 1]) for i in range(n_windows)]
+
+
+def progress_windows(begin, end, now, args):
+    """
+    Split the [begin, end) history window of a query in ascending sub-windows
+    of args.history_progress_secs, at most MAX_PROGRESS_WINDOWS of them, end
+    is open if None, like the last sub-window then. The schedds return the
+    history newest first: the end of a sub-window is the date up to which the
+    history is uploaded once it is processed, so that a timed out crawl
+    keeps its progress.
+    """
+    edges = [begin]
+    if args.history_progress_secs:
+        stop = end if end is not None else now
+        step = max(
+            args.history_progress_secs,
+            int(math.ceil((stop - begin) / float(MAX_PROGRESS_WINDOWS))),
+        )
+        while edges[-1] + step < stop:
+            edges.append(edges[-1] + step)
+    edges.append(end)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def expected_history_secs(stats, window_secs):
+    """
+    Expected time to process a history window of window_secs, from the
+    statistics of the last crawl of the schedd. None without statistics.
+    """
+    if not stats or not stats.get("window_secs") or "query_secs" not in stats:
+        return None
+    # Uploads overlap with the queries since the background uploader
+    secs = stats.get("secs", stats["query_secs"] + stats["upload_secs"])
+    return secs * window_secs / stats["window_secs"]
+
+
+def shipped_key(job_ad):
+    """
+    Cheap key of the document of a history ad, computed before its conversion:
+    a 64 bits hash of its GlobalJobId, EnteredCurrentStatus and
+    CRAB_PostJobLastUpdate (a PostJob update makes a new document).
+    Returns (key, date), the ad is returned again by the queries beginning before date.
+    """
+    entered = job_ad.get("EnteredCurrentStatus") or 0
+    postjob = job_ad.get("CRAB_PostJobLastUpdate") or 0
+    digest = hashlib.blake2b(
+        ("%s#%s#%s" % (job_ad.get("GlobalJobId"), entered, postjob)).encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big", signed=True), max(entered, postjob)
+
+
+def newest_job_id(schedd):
+    """
+    Return the "ClusterId.ProcId" of the most recent record of the history
+    of a schedd, None if it is empty. The schedds write the history records
+    in the order the jobs leave the queue, not in EnteredCurrentStatus order.
+    """
+    for job_ad in schedd.history(None, ["ClusterId", "ProcId"], match=1):
+        return "%d.%d" % (job_ad["ClusterId"], job_ad["ProcId"])
+    return None
+
+
+class HistoryUploader(object):
+    """
+    Posts the bunches of documents of a schedd to ES and AMQ from a background
+    thread, fed through a queue of args.upload_queue_size bunches, so that the
+    schedd keeps streaming during the uploads. With a queue size of 0, or
+    without anything to post, the bunches are posted synchronously by put().
+
+    The first exception raised by a post is raised again by the next put()
+    or by close(), the following bunches are dropped: like for a synchronous
+    post, the schedd is not checkpointed.
+    """
+
+    def __init__(self, args, metadata, label):
+        self.args = args
+        self.metadata = metadata
+        self.busy_secs = 0.0  # time spent posting
+        self.wait_secs = 0.0  # time the caller waited for the posts
+        self.error = None
+        self.queue = None
+        self.thread = None
+        if args.upload_queue_size > 0 and not args.read_only and (args.feed_es or args.feed_amq):
+            self.queue = queue.Queue(maxsize=args.upload_queue_size)
+            self.thread = threading.Thread(target=self._run, name="uploader %s" % label, daemon=True)
+            self.thread.start()
+
+    def put(self, idx, ad_list):
+        if self.error is not None:
+            raise self.error
+        st = time.time()
+        if self.thread is None:
+            self._post(idx, ad_list)
+        else:
+            self.queue.put((idx, ad_list))
+        self.wait_secs += time.time() - st
+
+    def flush(self):
+        """Wait for the posts of the bunches put so far, raise the error of a failed one"""
+        st = time.time()
+        if self.thread is not None:
+            self.queue.join()
+        if self.error is None and self.args.feed_es and not self.args.read_only:
+            # Bulks still awaited from the clusters behind the quorum
+            htcondor_es.es.flush()
+        self.wait_secs += time.time() - st
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """Wait for the pending posts and stop, raise the error of a failed one"""
+        self.flush()
+        self.stop()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            try:
+                if self.error is None:
+                    self._post(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _post(self, idx, ad_list):
+        args = self.args
+        st = time.time()
+        try:
+            if not args.read_only:
+                if args.feed_es:
+                    htcondor_es.es.post_ads(args=args, idx=idx, ads=ad_list, metadata=self.metadata)
+                if args.feed_amq:
+                    if args.feed_es and self.metadata:
+                        # The AMQ docs carry the metadata of the ES docs too,
+                        # as they did when the ES body was built in place
+                        for _, dict_ad in ad_list:
+                            dict_ad.setdefault("metadata", {}).update(self.metadata)
+                    data_for_amq = [
+                        (id_, convert_dates_to_millisecs(dict_ad))
+                        for id_, dict_ad in ad_list
+                    ]
+                    htcondor_es.amq.post_ads(data_for_amq, metadata=self.metadata)
+        finally:
+            self.busy_secs += time.time() - st
 
 
 def process_schedd(
-    starttime, last_completion, checkpoint_queue, schedd_ad, args, metadata=None
+    starttime, last_completion, schedd_ad, args, metadata=None, window=None, since=None
 ):
     """
-    Given a schedd, process its entire set of history since last checkpoint.
+    Given a schedd, process its entire set of history since last checkpoint,
+    or only the (index, n_windows, begin, end) sub-window of it given by
+    split_windows. The window is crawled in ascending progress_windows, the
+    checkpoint is moved to the end of each one uploaded. The checkpoint of a
+    split schedd is left to process_histories.
+
+    The history queries only scan the records written after the since job
+    id. With args.history_since, the id of the most recent record is fetched
+    before the queries: once the crawl is complete the previous records were
+    all scanned, it bounds the next crawl.
+
+    With args.skip_shipped, the ads shipped by the previous run in the
+    QUERY_TIME_PERIOD overlap are skipped before their conversion, the keys of
+    the ads shipped are recorded with the checkpoint.
+
+    Returns a dict with the schedd name, the new last completion date, the date
+    up to which the history is uploaded, the number of ads, of ads skipped,
+    the query, upload and total times, whether the whole window was processed,
+    the most recent job id and when it was fetched, for a split schedd the
+    keys of the ads shipped, with args.learn_projection_attrs the attribute
+    names learned (see projection.pop_learned_attributes) and, with
+    args.task_cache, the new entries of the task info cache.
     """
     my_start = time.time()
     pool_name = schedd_ad.get("CMS_Pool", "Unknown")
+    result = {
+        "name": schedd_ad["Name"],
+        "last_completion": last_completion,
+        "progress": last_completion,
+        "count": 0,
+        "skipped": 0,
+        "shipped": [],
+        "newest": None,
+        "started": None,
+        "query_secs": 0.0,
+        "upload_secs": 0.0,
+        "secs": 0.0,
+        "complete": False,
+    }
+    if window is None:
+        begin, end, crab_postjob = last_completion - QUERY_TIME_PERIOD, None, True
+        label = schedd_ad["Name"]
+    else:
+        index, n_windows, begin, end = window
+        crab_postjob = index == 0
+        label = "%s[%d/%d]" % (schedd_ad["Name"], index + 1, n_windows)
+        result["progress"] = begin
     if time_remaining(starttime) < 10:
-        message = (
-            "No time remaining to process %s history; exiting." % schedd_ad["Name"]
-        )
+        message = "No time remaining to process %s history; exiting." % label
         logging.error(message)
         send_email_alert(
             args.email_alerts, "spider_cms history timeout warning", message
         )
-        return last_completion
+        return result
 
     metadata = metadata or {}
-    schedd = htcondor.Schedd(schedd_ad)
-    _q = """
-        (JobUniverse == 5) && (CMS_Type != "DONOTMONIT")
-        &&
-        (
-            EnteredCurrentStatus >= %(last_completion)d
-            || CRAB_PostJobLastUpdate >= %(last_completion)d
-        )
-        """
-    history_query = classad.ExprTree(_q % {"last_completion": last_completion - QUERY_TIME_PERIOD})
-    logging.info(
-        "Querying %s for history: %s.  " "%.1f minutes of ads",
-        schedd_ad["Name"],
-        history_query,
-        (time.time() - last_completion) / 60.0,
-    )
+    schedd = htcondor_es.utils.get_schedd(schedd_ad)
+    if args.stage_timing:
+        stage_timer.enable()
+        stage_timer.reset()
+    projection = htcondor_es.projection.get_projection(args)
+    learn_attributes = args.learn_projection_attrs and not projection
     buffered_ads = {}
     count = 0
-    total_upload = 0
+    skipped = 0
+    shipped = htcondor_es.checkpoint.load_shipped(schedd_ad["Name"]) if args.skip_shipped else set()
+    new_shipped = []
+    uploader = HistoryUploader(args, metadata, label)
     sent_warnings = False
     timed_out = False
+    aborted = False
     error = False
-    try:
-        if not args.dry_run:
-            history_iter = schedd.history(history_query, [], match=-1)
-        else:
-            history_iter = []
-
-        for job_ad in history_iter:
-            dict_ad = None
-            try:
-                dict_ad = convert_to_json(job_ad, return_dict=True, pool_name=pool_name)
-            except Exception as e:
-                message = "Failure when converting document on %s history: %s" % (
-                    schedd_ad["Name"],
-                    str(e),
-                )
-                exc = traceback.format_exc()
-                message += "\n{}".format(exc)
-                logging.warning(message)
-                if not sent_warnings:
-                    send_email_alert(
-                        args.email_alerts,
-                        "spider_cms history document conversion error",
-                        message,
-                    )
-                    sent_warnings = True
 
-            if not dict_ad:
+    def conversion_error(job_ad, e):
+        nonlocal sent_warnings
+        message = "Failure when converting document on %s history: %s" % (
+            schedd_ad["Name"],
+            str(e),
+        )
+        exc = traceback.format_exc()
+        message += "\n{}".format(exc)
+        logging.warning(message)
+        if not sent_warnings:
+            send_email_alert(
+                args.email_alerts,
+                "spider_cms history document conversion error",
+                message,
+            )
+            sent_warnings = True
+
+    def skip_shipped(job_ads):
+        nonlocal skipped
+        for job_ad in job_ads:
+            key = shipped_key(job_ad)
+            if key[0] in shipped:
+                skipped += 1
                 continue
+            new_shipped.append(key)
+            yield job_ad
 
-            idx = htcondor_es.es.get_index(
-                timestamp=job_ad["QDate"],
-                template=args.es_index_template,
-                args=args,
-                update_es=(args.feed_es and not args.read_only),
+    try:
+        if args.history_since and not args.dry_run:
+            result["started"] = time.time()
+            result["newest"] = newest_job_id(schedd)
+        for sub_begin, sub_end in progress_windows(begin, end, time.time(), args):
+            history_query = history_constraint(
+                sub_begin, sub_end, crab_postjob=(crab_postjob and sub_begin == begin)
             )
-            # Initialize in for loop. setdefault returns the value of the key always
-            ad_list = buffered_ads.setdefault(idx, [])
-            # ad_list keeps the dict_ad values and is propagated in each iteration until buffered_ads[idx] set empty
-            ad_list.append((unique_doc_id(dict_ad), dict_ad))
-
-            if len(ad_list) == args.es_bunch_size:
-                st = time.time()
-                if not args.read_only:
-                    if args.feed_es:
-                        htcondor_es.es.post_ads(args=args, idx=idx, ads=ad_list, metadata=metadata)
-                    if args.feed_amq:
-                        data_for_amq = [
-                            (id_, convert_dates_to_millisecs(dict_ad))
-                            for id_, dict_ad in ad_list
-                        ]
-                        htcondor_es.amq.post_ads(data_for_amq, metadata=metadata)
-
-                logging.debug(
-                    "...posting %d ads from %s (process_schedd)",
-                    len(ad_list),
-                    schedd_ad["Name"],
-                )
-                total_upload += time.time() - st
-                # Clear the buffer dict after batch post operation and set buffered_ads[idx] as empty list
-                buffered_ads[idx] = []
-
-            count += 1
-
-            # Find the most recent job and use that date as the new
-            # last_completion date
-            job_completion = job_ad.get("EnteredCurrentStatus")
-            if job_completion > last_completion:
-                last_completion = job_completion
-
-            if time_remaining(starttime) < 10:
-                message = (
-                    "History crawler on %s has been running for "
-                    "more than %d minutes; exiting." % (schedd_ad["Name"], TIMEOUT_MINS)
-                )
-                logging.error(message)
-                send_email_alert(
-                    args.email_alerts, "spider_cms history timeout warning", message
+            logging.info(
+                "Querying %s for history: %s.  " "%.1f minutes of ads",
+                label,
+                history_query,
+                ((sub_end or time.time()) - sub_begin) / 60.0,
+            )
+            if not args.dry_run:
+                history_iter = schedd.history(history_query, projection, match=-1, since=since)
+            else:
+                history_iter = []
+            if args.skip_shipped:
+                history_iter = skip_shipped(history_iter)
+
+            converted_ads = convert_ads(
+                history_iter,
+                on_error=conversion_error,
+                return_dict=True,
+                pool_name=pool_name,
+                materialize=args.materialize_ads,
+            )
+            for job_ad, dict_ad in converted_ads:
+                if learn_attributes:
+                    htcondor_es.projection.learn_attributes(job_ad)
+                if not dict_ad:
+                    continue
+
+                idx = htcondor_es.es.get_index(
+                    timestamp=job_ad["QDate"],
+                    template=args.es_index_template,
+                    args=args,
+                    update_es=(args.feed_es and not args.read_only),
                 )
-                timed_out = True
-                break
+                # Initialize in for loop. setdefault returns the value of the key always
+                ad_list = buffered_ads.setdefault(idx, [])
+                # ad_list keeps the dict_ad values and is propagated in each iteration until buffered_ads[idx] set empty
+                ad_list.append((unique_doc_id(dict_ad), dict_ad))
+
+                if len(ad_list) == args.es_bunch_size:
+                    logging.debug(
+                        "...posting %d ads from %s (process_schedd)",
+                        len(ad_list),
+                        schedd_ad["Name"],
+                    )
+                    uploader.put(idx, ad_list)
+                    # Start a new buffer, the uploader keeps the full one
+                    buffered_ads[idx] = []
+
+                count += 1
+
+                # Find the most recent job and use that date as the new
+                # last_completion date
+                job_completion = job_ad.get("EnteredCurrentStatus")
+                if job_completion > last_completion:
+                    last_completion = job_completion
+
+                if time_remaining(starttime) < 10:
+                    message = (
+                        "History crawler on %s has been running for "
+                        "more than %d minutes; exiting." % (label, TIMEOUT_MINS)
+                    )
+                    logging.error(message)
+                    send_email_alert(
+                        args.email_alerts, "spider_cms history timeout warning", message
+                    )
+                    timed_out = True
+                    break
 
-            if args.max_documents_to_process and count > args.max_documents_to_process:
-                logging.warning(
-                    "Aborting after %d documents (--max_documents_to_process option)"
-                    % args.max_documents_to_process
-                )
+                if args.max_documents_to_process and count > args.max_documents_to_process:
+                    logging.warning(
+                        "Aborting after %d documents (--max_documents_to_process option)"
+                        % args.max_documents_to_process
+                    )
+                    aborted = True
+                    break
+            # Post the remaining ads
+            for idx, ad_list in list(buffered_ads.items()):
+                if ad_list:
+                    logging.debug(
+                        "...posting remaining %d ads from %s " "(process_schedd)",
+                        len(ad_list),
+                        schedd_ad["Name"],
+                    )
+                    uploader.put(idx, ad_list)
+            buffered_ads = {}
+            if timed_out or aborted or sub_end is None:
                 break
-        # Post the remaining ads
-        for idx, ad_list in list(buffered_ads.items()):
-            if ad_list:
-                logging.debug(
-                    "...posting remaining %d ads from %s " "(process_schedd)",
-                    len(ad_list),
-                    schedd_ad["Name"],
+            # The sub-window is uploaded once its posts are done, raises the error of a failed one
+            uploader.flush()
+            result["progress"] = max(result["progress"], sub_end)
+            # Only the ads the next run could query again are kept
+            expire_before = result["progress"] - QUERY_TIME_PERIOD if args.skip_shipped else None
+            if window is None:
+                htcondor_es.checkpoint.update(
+                    schedd_ad["Name"], result["progress"], new_shipped, expire_before
                 )
-                if not args.read_only:
-                    if args.feed_es:
-                        htcondor_es.es.post_ads(args=args, idx=idx, ads=ad_list, metadata=metadata)
-                    if args.feed_amq:
-                        data_for_amq = [
-                            (id_, convert_dates_to_millisecs(dict_ad))
-                            for id_, dict_ad in ad_list
-                        ]
-                        htcondor_es.amq.post_ads(data_for_amq, metadata=metadata)
+            elif args.skip_shipped:
+                result["shipped"] = [
+                    key for key in result["shipped"] + new_shipped if key[1] >= expire_before
+                ]
+            new_shipped = []
+            logging.info("Schedd %s history uploaded up to %s", label, sub_end)
+        # Wait for the uploads, raises the error of a failed one
+        uploader.close()
     except RuntimeError:
-        message = "Failed to query schedd for job history: %s" % schedd_ad["Name"]
+        message = "Failed to query schedd for job history: %s" % label
         exc = traceback.format_exc()
         message += "\n{}".format(exc)
         logging.error(message)
         error = True
 
+    except sqlite3.Error as e:
+        # The next run queries the window again from the last checkpoint
+        logging.error("Failed to update the checkpoint of %s history: %s", label, str(e))
+        error = True
+
     except Exception as exn:
         message = "Failure when processing schedd history query on %s: %s" % (
-            schedd_ad["Name"],
+            label,
             str(exn),
         )
         exc = traceback.format_exc()
@@ -199,63 +497,94 @@ def process_schedd(
             args.email_alerts, "spider_cms schedd history query error", message
         )
         error = True
+    finally:
+        uploader.stop()
+
+    if learn_attributes:
+        # Saved once by process_histories
+        result["learned"] = htcondor_es.projection.pop_learned_attributes()
+    if args.task_cache:
+        # Saved once by spider_cms
+        result["task_info"] = task_info_cache.pop_new_entries()
+    logging.info(
+        "Task info cache: %d entries, %d hits, %d misses",
+        len(task_info_cache),
+        task_info_cache.hits,
+        task_info_cache.misses,
+    )
+    if args.stage_timing:
+        stage_timer.report("%s history" % label)
+    if args.feed_es and not args.read_only:
+        htcondor_es.es.report_clusters("%s history" % label)
 
     total_time = (time.time() - my_start) / 60.0
-    total_upload /= 60.0
+    total_upload = uploader.busy_secs / 60.0
+    # Time the schedd was not read, waiting for the uploads
+    total_wait = uploader.wait_secs / 60.0
     last_formatted = datetime.datetime.fromtimestamp(last_completion).strftime(
         "%Y-%m-%d %H:%M:%S"
     )
     logging.warning(
-        "Schedd %-25s history: response count: %5d; last completion %s; "
+        "Schedd %-25s history: response count: %5d; skipped %d shipped; last completion %s; "
         "query time %.2f min; upload time %.2f min",
-        schedd_ad["Name"],
+        label,
         count,
+        skipped,
         last_formatted,
-        total_time - total_upload,
+        total_time - total_wait,
         total_upload,
     )
 
     # If we got to this point without a timeout, all these jobs have
-    # been processed and uploaded, so we can update the checkpoint
+    # been processed and uploaded, so we can update the checkpoint,
+    # not before the end of the last sub-window uploaded
     if not timed_out and not error:
-        checkpoint_queue.put((schedd_ad["Name"], last_completion))
-
-    return last_completion
-
-
-def update_checkpoint(name, completion_date):
-    try:
-        with open(_CHECKPOINT_JSON, "r") as fd:
-            checkpoint = json.load(fd)
-    except Exception as e:
-        logging.warning("!!! checkpoint.json is not found or not readable. "
-                        "It will be created and fresh results will be written. " + str(e))
-        checkpoint = {}
-
-    checkpoint[name] = completion_date
-
-    with open(_CHECKPOINT_JSON, "w") as fd:
-        json.dump(checkpoint, fd)
+        result["progress"] = max(result["progress"], last_completion)
+        expire_before = result["progress"] - QUERY_TIME_PERIOD if args.skip_shipped else None
+        if window is None:
+            try:
+                htcondor_es.checkpoint.update(
+                    schedd_ad["Name"], result["progress"], new_shipped, expire_before, result["newest"]
+                )
+            except sqlite3.Error as e:
+                logging.error("Failed to update the checkpoint of %s history: %s", label, str(e))
+                error = True
+        elif args.skip_shipped:
+            result["shipped"] = [
+                key for key in result["shipped"] + new_shipped if key[1] >= expire_before
+            ]
+    result.update(
+        last_completion=last_completion,
+        count=count,
+        skipped=skipped,
+        query_secs=(total_time - total_wait) * 60,
+        upload_secs=total_upload * 60,
+        secs=total_time * 60,
+        complete=not timed_out and not error,
+    )
+    return result
 
 
 def process_histories(schedd_ads, starttime, pool, args, metadata=None):
     """
     Process history files for each schedd listed in a given
     multiprocessing pool
+
+    The history window of a heavy schedd is split in sub-windows processed in
+    parallel (see split_windows), its checkpoint is moved to the progress of
+    its first incomplete sub-window, or past all of them. The tasks are submitted longest expected first, according to
+    the statistics of the previous runs.
     """
-    try:
-        checkpoint = json.load(open(_CHECKPOINT_JSON))
-    except Exception as e:
-        # Exception should be general
-        logging.warning("!!! checkpoint.json is not found or not readable. Empty dict will be used. " + str(e))
-        checkpoint = {}
+    checkpoint = htcondor_es.checkpoint.load()
+    since_bounds = htcondor_es.checkpoint.load_since() if args.history_since else {}
+    history_stats = load_schedd_stats(_HISTORY_STATS_JSON)
 
     futures = []
     metadata = metadata or {}
     metadata["spider_source"] = "condor_history"
 
-    manager = multiprocessing.Manager()
-    checkpoint_queue = manager.Queue()
+    windows = {}
+    tasks = []
 
     for schedd_ad in schedd_ads:
         name = schedd_ad["Name"]
@@ -270,38 +599,46 @@ def process_histories(schedd_ads, starttime, pool, args, metadata=None):
         if name.startswith("crab") and last_completion < time.time() - CRAB_MAX_QUERY_TIME_SPAN:
             last_completion = time.time() - history_query_max_n_minutes * 60
 
-        future = pool.apply_async(
-            process_schedd,
-            (starttime, last_completion, checkpoint_queue, schedd_ad, args, metadata),
-        )
-        futures.append((name, future))
-
-    def _chkp_updater():
-        while True:
-            try:
-                job = checkpoint_queue.get()
-                if job is None:  # Swallow poison pill
-                    break
-            except EOFError as error:
-                logging.warning(
-                    "EOFError - Nothing to consume left in the queue %s", error
+        begin = last_completion - QUERY_TIME_PERIOD
+        windows[name] = (begin, time.time())
+        split = split_windows(name, begin, time.time(), history_stats, args)
+        expected_secs = expected_history_secs(history_stats.get(name), time.time() - begin)
+        for window in split:
+            tasks.append(
+                (
+                    expected_secs / len(split) if expected_secs is not None else None,
+                    (
+                        name,
+                        (
+                            starttime,
+                            last_completion,
+                            schedd_ad,
+                            args,
+                            metadata,
+                            window,
+                            since_bounds.get(name),
+                        ),
+                    ),
                 )
-                break
-            update_checkpoint(*job)
+            )
 
-    chkp_updater = multiprocessing.Process(target=_chkp_updater)
-    chkp_updater.start()
+    tasks, predicted_makespan = longest_first(tasks, args.query_pool_size)
+    submitted = time.time()
+    for name, task_args in tasks:
+        window = task_args[5]
+        futures.append((name, window[0] if window else 0, pool.apply_async(process_schedd, task_args)))
 
     # Check whether one of the processes timed out and reset their last
     # completion checkpoint in case
     timed_out = False
-    for name, future in futures:
+    results = {}
+    for name, index, future in futures:
         if time_remaining(starttime, positive=False) > -20:
             try:
-                future.get(time_remaining(starttime) + 10)
+                results.setdefault(name, {})[index] = future.get(time_remaining(starttime) + 10)
             except multiprocessing.TimeoutError:
-                # This implies that the checkpoint hasn't been updated
-                message = "Schedd %s history timed out; ignoring progress." % name
+                # The checkpoint keeps the sub-windows uploaded so far
+                message = "Schedd %s history timed out; ignoring further progress." % name
                 exc = traceback.format_exc()
                 message += "\n{}".format(exc)
                 logging.error(message)
@@ -326,9 +663,61 @@ def process_histories(schedd_ads, starttime, pool, args, metadata=None):
             break
     if timed_out:
         pool.terminate()
+    log_makespan("history", predicted_makespan, time.time() - submitted, args.query_pool_size)
+
+    n_parts = {}
+    for name, _, _ in futures:
+        n_parts[name] = n_parts.get(name, 0) + 1
+    for name, parts in results.items():
+        for part in parts.values():
+            task_info_cache.merge(part.get("task_info", []))
+        complete = len(parts) == n_parts[name] and all(part["complete"] for part in parts.values())
+        if n_parts[name] > 1:
+            # The history is uploaded up to the progress of the first incomplete sub-window
+            progress = None
+            for index in range(n_parts[name]):
+                if index not in parts:
+                    break
+                progress = parts[index]["progress"]
+                if not parts[index]["complete"]:
+                    break
+            newest = None
+            if complete:
+                progress = max(part["progress"] for part in parts.values())
+                # The records before the most recent one when the first sub-window started were all scanned
+                newest = min(parts.values(), key=lambda part: part["started"] or 0)["newest"]
+            if progress is not None and (progress > windows[name][0] + QUERY_TIME_PERIOD or newest):
+                try:
+                    htcondor_es.checkpoint.update(
+                        name,
+                        progress,
+                        [key for part in parts.values() for key in part["shipped"]],
+                        progress - QUERY_TIME_PERIOD if args.skip_shipped else None,
+                        newest,
+                    )
+                except sqlite3.Error as e:
+                    logging.error("Failed to update the checkpoint of %s history: %s", name, str(e))
+                    complete = False
+        # Only the schedds processed completely, in all their sub-windows, give statistics
+        if not complete:
+            continue
+        parts = list(parts.values())
+        begin, scheduled = windows[name]
+        history_stats[name] = {
+            "ads": sum(part["count"] for part in parts),
+            "window_secs": scheduled - begin,
+            "query_secs": sum(part["query_secs"] for part in parts),
+            "upload_secs": sum(part["upload_secs"] for part in parts),
+            "secs": sum(part["secs"] for part in parts),
+        }
+    if not args.dry_run:
+        save_schedd_stats(_HISTORY_STATS_JSON, history_stats)
+    if args.learn_projection_attrs:
+        htcondor_es.projection.save_learned_attributes(
+            part["learned"] for parts in results.values() for part in parts.values() if "learned" in part
+        )
 
-    checkpoint_queue.put(None)  # Send a poison pill
-    chkp_updater.join()
+    htcondor_es.checkpoint.export_json()
 
     logging.warning(
         "Processing time for history: %.2f mins", ((time.time() - starttime) / 60.0)
@@ -0,0 +1,203 @@
+"""
+Attribute projection for schedd history and queue queries.
+
+In "full" mode the schedds send every attribute of every job. In "projected"
+mode only the attributes that end up in the documents, or that are read
+while deriving them, are requested.
+
+HTCondor projections are plain attribute lists, so the ChirpCMSSW* and
+MachineAttr* families (whose members depend on the job's CMSSW steps, the
+sites it read from and the machine it ran on) cannot be matched by prefix.
+Family members seen in full mode runs with --learn_projection_attrs are
+remembered in the workdir and added to later projected queries.
+
+The projected mode is not a drop-in replacement of the full one: the family
+members not learned yet (a new IOSite, a new machine attribute) are not
+fetched, and expressions are not evaluated by the schedd, an attribute like
+RequestMemory that refers to an attribute outside of the projection will
+evaluate differently.
+"""
+
+import json
+import logging
+import os
+
+from htcondor_es.convert_to_json import (
+    bool_vals,
+    date_vals,
+    ignore,
+    int_vals,
+    running_fields,
+    string_vals,
+)
+
+_WORKDIR = os.getenv("SPIDER_WORKDIR", "/home/cmsjobmon/cms-htcondor-es")
+
+# Family members learned in full mode runs
+_PROJECTION_ATTRS_JSON = os.path.join(_WORKDIR, "projection_attrs.json")
+
+# Attributes read by convert_to_json and its helpers (recordTime, commonExitCode,
+# guessCampaign, handle_chirp_info, ...) that are not in the typed field sets
+derived_attrs = {
+    "ChirpCMSSWCPUModels",
+    "Chirp_CRAB3_Job_ExitCode",
+    "Chirp_WMCore_cmsRun_ExitCode",
+    "CMS_CampaignName",
+    "CMS_extendedJobType",
+    "CMS_SubmissionTool",
+    "CMS_TaskType",
+    "CMS_Type",
+    "CommittedTime",
+    "CompletionDate",
+    "CRAB_AdditionalOutputFiles",
+    "CRAB_AsyncDest",
+    "CRAB_EDMOutputFiles",
+    "CRAB_PostJobLastUpdate",
+    "CRAB_TFileOutputFiles",
+    "CreamAttributes",
+    "ExitCode",
+    "GLIDEIN_Cpus",
+    "JobExitCode",
+    "JobFinishedHookDone",
+    "MATCH_EXP_JOB_GLIDEIN_Cpus",
+    "MATCH_EXP_JOBGLIDEIN_CMSSite",
+    "MATCH_EXP_JOBGLIDEIN_ResourceName",
+    "MATCH_GLIDEIN_CMSSite",
+    "MATCH_GLIDEIN_ToDie",
+    "MachineAttrCMSProcessingSiteName0",
+    "MachineAttrCPUModel0",
+    "MachineAttrDIRACBenchmark0",
+    "MachineAttrGLIDEIN_CMSSite0",
+    "MachineAttrHAS_SINGULARITY0",
+    "MachineAttrMJF_JOB_HS06_JOB0",
+    "RequestMemory",
+    "xcount",
+}
+
+# Chirp statistics reported by the CMSSW jobs, per step
+_chirp_stats = (
+    "Done",
+    "Elapsed",
+    "Events",
+    "Files",
+    "LastUpdate",
+    "Lumis",
+    "MaxFiles",
+    "MaxLumis",
+    "ReadBytes",
+    "ReadOps",
+    "ReadSegments",
+    "ReadTimeMsecs",
+    "ReadVOps",
+    "WriteBytes",
+    "WriteTimeMsecs",
+)
+
+# Prefixes of the attribute families that can only be projected by name
+wildcard_families = ("ChirpCMSSW", "MachineAttr")
+
+# Upper bound of learned names per family, per-site Chirp keys are open-ended
+_FAMILY_MAX_SIZE = 5000
+
+_learned = None
+_projection = None
+
+# Family members seen by this process since the last pop_learned_attributes()
+_seen = {family: set() for family in wildcard_families}
+
+
+def _load_learned():
+    global _learned
+    if _learned is None:
+        _learned = {family: set() for family in wildcard_families}
+        try:
+            with open(_PROJECTION_ATTRS_JSON) as fd:
+                for family, names in json.load(fd).items():
+                    if family in _learned:
+                        _learned[family].update(names[:_FAMILY_MAX_SIZE])
+        except (IOError, ValueError) as e:
+            logging.info("No learned projection attributes loaded: %s", str(e))
+    return _learned
+
+
+def get_projection(args):
+    """
+    Returns the attribute list for schedd.history/xquery.
+
+    An empty list (full mode) makes the schedd return all the attributes.
+    """
+    global _projection
+    if getattr(args, "attribute_projection", "full") != "projected":
+        return []
+    if _projection is None:
+        attrs = (string_vals | int_vals | date_vals | bool_vals) - ignore
+        attrs |= derived_attrs
+        for name in running_fields:
+            attrs.add(name)
+            if name.startswith("GLIDEIN_"):
+                attrs.add("MATCH_EXP_JOB_" + name)
+        for step in range(1, 11):
+            for stat in _chirp_stats:
+                attrs.add("ChirpCMSSW_cmsRun%d_%s" % (step, stat))
+        learned = _load_learned()
+        if not any(learned.values()):
+            logging.warning(
+                "No learned ChirpCMSSW*/MachineAttr* attributes, projected queries will miss them "
+                "(see --learn_projection_attrs)"
+            )
+        for names in learned.values():
+            attrs |= names
+        _projection = sorted(attrs)
+    return _projection
+
+
+def learn_attributes(ad):
+    """Remember the wildcard family members of a job ad fetched in full mode"""
+    for key in ad.keys():
+        if key.startswith(wildcard_families):
+            family = "ChirpCMSSW" if key.startswith("ChirpCMSSW") else "MachineAttr"
+            names = _seen[family]
+            if len(names) < _FAMILY_MAX_SIZE:
+                names.add(key)
+
+
+def pop_learned_attributes():
+    """
+    Return the {family: names} seen by learn_attributes in this process and
+    forget them, for the worker results handed to save_learned_attributes
+    """
+    learned = {family: sorted(names) for family, names in _seen.items()}
+    for names in _seen.values():
+        names.clear()
+    return learned
+
+
+def save_learned_attributes(learned):
+    """
+    Merge the {family: names} dicts of pop_learned_attributes into the workdir
+    file, replaced atomically. Called once per run, by the main process.
+    """
+    merged = {family: set() for family in wildcard_families}
+    try:
+        with open(_PROJECTION_ATTRS_JSON) as fd:
+            for family, names in json.load(fd).items():
+                if family in merged:
+                    merged[family].update(names)
+    except (IOError, ValueError):
+        pass
+    for names_by_family in learned:
+        for family, names in names_by_family.items():
+            merged[family].update(names)
+    tmp_file = _PROJECTION_ATTRS_JSON + ".tmp"
+    try:
+        with open(tmp_file, "w") as fd:
+            json.dump(
+                {
+                    family: sorted(names)[:_FAMILY_MAX_SIZE]
+                    for family, names in merged.items()
+                },
+                fd,
+            )
+        os.replace(tmp_file, _PROJECTION_ATTRS_JSON)
+    except (IOError, OSError) as e:
+        logging.warning("Could not save learned projection attributes: %s", str(e))
@@ -2,120 +2,296 @@
 Process the jobs in queue for given set of schedds.
 """
 
+import os
 import time
+import pickle
 import logging
 import resource
 import traceback
 import queue
+import threading
 import multiprocessing
 
 import classad
-import htcondor
 
 import htcondor_es.es
 import htcondor_es.amq
+import htcondor_es.projection
+import htcondor_es.utils
 from htcondor_es.utils import send_email_alert, time_remaining, TIMEOUT_MINS
-from htcondor_es.convert_to_json import convert_to_json
+from htcondor_es.utils import load_schedd_stats, save_schedd_stats, longest_first, log_makespan
+from htcondor_es.convert_to_json import convert_ads
 from htcondor_es.convert_to_json import convert_dates_to_millisecs
 from htcondor_es.convert_to_json import unique_doc_id
+from htcondor_es.convert_to_json import stage_timer
+from htcondor_es.convert_to_json import task_info_cache
 
+_WORKDIR = os.getenv("SPIDER_WORKDIR", "/home/cmsjobmon/cms-htcondor-es")
 
-class ListenAndBunch(multiprocessing.Process):
-    """
-    Listens to incoming items on a queue and puts bunches of items
-    to an outgoing queue
+# Docs and query time of the last queue crawl of each schedd, to start with the longest ones
+_QUEUE_STATS_JSON = os.path.join(_WORKDIR, "queue_stats.json")
+
+# Queue of the docs sent to the uploaders, multiprocessing queues can only be
+# inherited, it is handed to the query pool processes by set_doc_queue
+_doc_queue = None
+
+# The doc batches are pickled once, by the process converting them, and decoded
+# by the uploader which posts them
+_PICKLE_PROTOCOL = 5
+
+
+def set_doc_queue(doc_queue):
+    """Set the queue of the docs sent to the uploaders, initializer of the query pool"""
+    global _doc_queue
+    _doc_queue = doc_queue
+    if doc_queue is not None:
+        # Do not hang on exit if the uploaders gave up reading (see QueueUploader.run),
+        # otherwise all the docs are read before the processes exit
+        doc_queue.cancel_join_thread()
 
-    n_expected is the expected number of agents writing to the
-    queue. Necessary for knowing when to shut down.
+
+def put_start(name, starttime):
+    """Tell the uploaders that the docs of a schedd are coming"""
+    _doc_queue.put(("start", name), timeout=time_remaining(starttime))
+
+
+def put_batch(name, batch, starttime):
+    """Send a batch of (id, doc) of a schedd to the uploaders"""
+    _doc_queue.put(
+        ("docs", name, len(batch), pickle.dumps(batch, protocol=_PICKLE_PROTOCOL)),
+        timeout=time_remaining(starttime),
+    )
+
+
+def put_end(name, count, starttime):
+    """Tell the uploaders the number of docs sent for a schedd"""
+    _doc_queue.put(("end", name, count), timeout=time_remaining(starttime))
+
+
+def load_bunch(payloads):
+    """Return the (id, doc) of a bunch of batches sent by put_batch"""
+    bunch = []
+    for payload in payloads:
+        bunch.extend(pickle.loads(payload))
+    return bunch
+
+
+class QueueUploader(multiprocessing.Process):
+    """
+    Reads the batches of docs sent by the schedd queries on the input
+    queue, shared with the other uploaders, and posts them to ES and AMQ in
+    bunches of up to bunch_size docs.
+
+    The start and end of each schedd (see put_start and put_end) and the
+    number of docs of each batch are relayed to the results queue, where
+    collect_uploads tracks them: a schedd is done once the uploaders received
+    as many docs as were sent. Once all the schedds are done, it puts a poison
+    pill on the input queue for each uploader, which posts its last bunch and
+    puts a dict with its counts on the results queue. An uploader waiting too
+    long for docs closes by itself the same way.
     """
 
     def __init__(
         self,
         input_queue,
-        output_queue,
-        n_expected,
+        results_queue,
         starttime,
+        args,
+        metadata,
         bunch_size=5000,
-        report_every=50000,
     ):
-        super(ListenAndBunch, self).__init__()
+        super(QueueUploader, self).__init__()
         self.input_queue = input_queue
-        self.output_queue = output_queue
-        logging.warning("Bunching records for AMQP in sizes of %d", bunch_size)
-        self.bunch_size = bunch_size
-        self.report_every = report_every
-        self.n_expected = n_expected
+        self.results_queue = results_queue
         self.starttime = starttime
+        self.args = args
+        self.metadata = metadata
+        self.bunch_size = bunch_size
 
         self.buffer = []
-        self.tracker = []
-        self.n_processed = 0
+        self.buffer_count = 0  # number of docs in the buffer
         self.count_in = 0  # number of added docs
+        self.count_sent = 0
+        self.upload_secs = 0.0
 
         self.start()
 
     def run(self):
-        since_last_report = 0
         while True:
             try:
                 next_batch = self.input_queue.get(
                     timeout=time_remaining(self.starttime - 5)
                 )
             except queue.Empty:
-                logging.warning("Closing listener before all schedds were processed")
-                self.close()
-                return
-
-            if isinstance(next_batch, str):
-                schedd_name = str(next_batch)
-                try:
-                    # We were already processing this sender,
-                    # this is the signal that it's done sending.
-                    self.tracker.remove(schedd_name)
-                    self.n_processed += 1
-                except ValueError:
-                    # This is a new sender
-                    self.tracker.append(schedd_name)
-
-                if self.n_processed == self.n_expected:
-                    # We finished processing all expected senders.
-                    assert len(self.tracker) == 0
-                    self.close()
-                    return
-                continue
+                logging.warning("Closing uploader before all schedds were processed")
+                break
 
-            self.count_in += len(next_batch)
-            since_last_report += len(next_batch)
-            self.buffer.extend(next_batch)
+            if next_batch is None:  # poison pill
+                break
 
-            if since_last_report > self.report_every:
-                logging.debug("Processed %d docs", self.count_in)
-                since_last_report = 0
+            if next_batch[0] != "docs":
+                self.results_queue.put(next_batch)
+                continue
 
-            # If buffer is full, send the docs and clear the buffer
-            if len(self.buffer) >= self.bunch_size:
-                self.output_queue.put(
-                    self.buffer[: self.bunch_size],
-                    timeout=time_remaining(self.starttime),
+            _, name, n_docs, payload = next_batch
+            self.results_queue.put(("docs", name, n_docs))
+            self.count_in += n_docs
+            # If the batch does not fit, post the docs and clear the buffer
+            if self.buffer and self.buffer_count + n_docs > self.bunch_size:
+                self.post()
+            self.buffer.append(payload)
+            self.buffer_count += n_docs
+        self.close()
+
+    def post(self):
+        args = self.args
+        bunch = load_bunch(self.buffer)
+        self.buffer = []
+        self.buffer_count = 0
+        if args.read_only:
+            return
+        st = time.time()
+        sent = []  # docs of the bunch each feed took
+        try:
+            if args.feed_es_for_queues:
+                # FIXME: Why are we determining the index from one ad?
+                idx = htcondor_es.es.get_index(
+                    timestamp=bunch[0][1].get("QDate", int(time.time())),
+                    template=args.es_index_template,
+                    args=args,
+                    update_es=args.feed_es,
                 )
-                self.buffer = self.buffer[self.bunch_size:]
+                failed = htcondor_es.es.post_ads(args, idx, bunch, self.metadata)
+                sent.append(len(bunch) - failed)
+            if args.feed_amq:
+                amq_bunch = [
+                    (id_, convert_dates_to_millisecs(dict_ad)) for id_, dict_ad in bunch
+                ]
+                amq_sent, received, elapsed = htcondor_es.amq.post_ads(amq_bunch, self.metadata)
+                logging.info(
+                    "Uploaded %d/%d docs to StompAMQ in %d seconds", amq_sent, received, elapsed
+                )
+                sent.append(amq_sent)
+            # A doc is counted once, if all the feeds took it
+            self.count_sent += min(sent, default=0)
+        except Exception as e:
+            logging.error("Failed to upload %d queue docs: %s", len(bunch), str(e))
+            traceback.print_exc()
+        self.upload_secs += time.time() - st
 
     def close(self):
-        """Clear the buffer, send a poison pill and the total number of docs"""
+        """Post the buffer and send the counts"""
         if self.buffer:
-            self.output_queue.put(self.buffer, timeout=time_remaining(self.starttime))
-            self.buffer = []
+            self.post()
+        if self.args.feed_es_for_queues and not self.args.read_only:
+            try:
+                # Bulks still awaited from the clusters behind the quorum
+                htcondor_es.es.flush()
+            except Exception as e:
+                logging.error("Failed to upload the queue docs: %s", str(e))
+
+        logging.warning("Closing uploader, received %d documents total", self.count_in)
+        self.results_queue.put(
+            {
+                "received": self.count_in,
+                "sent": self.count_sent,
+                "upload_secs": self.upload_secs,
+            }
+        )
+
+
+def collect_uploads(results_queue, n_schedds, uploaders, starttime):
+    """
+    Track the progress relayed by the uploaders on the results queue (see
+    QueueUploader) until the docs of the n_schedds schedds were all received,
+    then stop the uploaders. An uploader may close by itself, once it waited
+    too long for docs: its counts are taken as they come.
+
+    Returns the numbers of docs received and sent, and the upload seconds,
+    summed over the uploaders.
+    """
+    totals = {"received": 0, "sent": 0, "upload_secs": 0.0}
+    n_closed = 0
+
+    def add_counts(counts):
+        nonlocal n_closed
+        for key in totals:
+            totals[key] += counts[key]
+        n_closed += 1
+
+    # Docs sent and received of the schedds started
+    pending = {}
+    n_processed = 0
+    # Nothing is received any more once all the uploaders closed
+    while n_processed < n_schedds and n_closed < len(uploaders):
+        try:
+            progress = results_queue.get(timeout=time_remaining(starttime - 5))
+        except queue.Empty:
+            logging.warning(
+                "Closing uploaders before all schedds were processed: %s",
+                ", ".join(sorted(pending)),
+            )
+            break
+        if isinstance(progress, dict):
+            add_counts(progress)
+            continue
+        counts = pending.setdefault(progress[1], {"sent": None, "received": 0})
+        if progress[0] == "docs":
+            counts["received"] += progress[2]
+        elif progress[0] == "end":
+            counts["sent"] = progress[2]
+        if counts["sent"] is not None and counts["received"] >= counts["sent"]:
+            del pending[progress[1]]
+            n_processed += 1
+
+    # All the docs were read, one poison pill per uploader still running
+    for _ in range(len(uploaders) - n_closed):
+        _doc_queue.put(None)
+    while n_closed < len(uploaders):
+        try:
+            progress = results_queue.get(timeout=time_remaining(starttime) + 10)
+        except queue.Empty:
+            logging.warning("Uploaders did not shut down properly; terminating.")
+            for uploader in uploaders:
+                uploader.terminate()
+            break
+        if isinstance(progress, dict):
+            add_counts(progress)
+    for uploader in uploaders:
+        uploader.join()
+    return totals["received"], totals["sent"], totals["upload_secs"]
 
-        logging.warning("Closing listener, received %d documents total", self.count_in)
-        # send back a poison pill
-        self.output_queue.put(None, timeout=time_remaining(self.starttime))
-        # send the number of total docs
-        self.output_queue.put(self.count_in, timeout=time_remaining(self.starttime))
 
+def queue_constraint(starttime):
+    """
+    Query for a snapshot of the jobs running/idle/held,
+    but only the completed that had changed in the last period of time.
+    """
+    _completed_since = starttime - (TIMEOUT_MINS + 1) * 60
+    return """
+         (JobUniverse == 5) && (CMS_Type != "DONOTMONIT")
+         &&
+         (
+             JobStatus < 3 || JobStatus > 4
+             || EnteredCurrentStatus >= %(completed_since)d
+             || CRAB_PostJobLastUpdate >= %(completed_since)d
+         )
+         """ % {
+        "completed_since": _completed_since
+    }
 
-def query_schedd_queue(starttime, schedd_ad, queue, args):
+
+def query_schedd_queue(starttime, schedd_ad, args):
+    """
+    Query the queue of a schedd and send the converted docs to the uploaders.
+
+    Returns a dict with the schedd name, the number of docs, the query time,
+    with args.learn_projection_attrs the attribute names learned and, with
+    args.task_cache, the new entries of the task info cache.
+    """
     my_start = time.time()
     pool_name = schedd_ad.get("CMS_Pool", "Unknown")
+    result = {"name": schedd_ad["Name"], "count": 0, "query_secs": 0.0}
     logging.info("Querying %s queue for jobs.", schedd_ad["Name"])
     if time_remaining(starttime) < 10:
         message = (
@@ -124,55 +300,55 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
         )
         logging.error(message)
         send_email_alert(args.email_alerts, "spider_cms queue timeout warning", message)
-        return
+        return result
 
     count_since_last_report = 0
     count = 0
     cpu_usage = resource.getrusage(resource.RUSAGE_SELF).ru_utime
-    queue.put(schedd_ad["Name"], timeout=time_remaining(starttime))
+    put_start(schedd_ad["Name"], starttime)
 
-    schedd = htcondor.Schedd(schedd_ad)
+    schedd = htcondor_es.utils.get_schedd(schedd_ad)
     sent_warnings = False
     batch = []
-    # Query for a snapshot of the jobs running/idle/held,
-    # but only the completed that had changed in the last period of time.
-    _completed_since = starttime - (TIMEOUT_MINS + 1) * 60
-    query = """
-         (JobUniverse == 5) && (CMS_Type != "DONOTMONIT")
-         &&
-         (
-             JobStatus < 3 || JobStatus > 4
-             || EnteredCurrentStatus >= %(completed_since)d
-             || CRAB_PostJobLastUpdate >= %(completed_since)d
-         )
-         """ % {
-        "completed_since": _completed_since
-    }
-    try:
-        query_iter = schedd.xquery(constraint=query) if not args.dry_run else []
-        for job_ad in query_iter:
-            dict_ad = None
-            try:
-                dict_ad = convert_to_json(
-                    job_ad,
-                    return_dict=True,
-                    reduce_data=not args.keep_full_queue_data,
-                    pool_name=pool_name,
-                )
-            except Exception as e:
-                message = "Failure when converting document on %s queue: %s" % (
-                    schedd_ad["Name"],
-                    str(e),
-                )
-                logging.warning(message)
-                if not sent_warnings:
-                    send_email_alert(
-                        args.email_alerts,
-                        "spider_cms queue document conversion error",
-                        message,
-                    )
-                    sent_warnings = True
+    query = queue_constraint(starttime)
+    if args.stage_timing:
+        stage_timer.enable()
+        stage_timer.reset()
+    projection = htcondor_es.projection.get_projection(args)
+    learn_attributes = args.learn_projection_attrs and not projection
+
+    def conversion_error(job_ad, e):
+        nonlocal sent_warnings
+        message = "Failure when converting document on %s queue: %s" % (
+            schedd_ad["Name"],
+            str(e),
+        )
+        logging.warning(message)
+        if not sent_warnings:
+            send_email_alert(
+                args.email_alerts,
+                "spider_cms queue document conversion error",
+                message,
+            )
+            sent_warnings = True
 
+    try:
+        query_iter = (
+            schedd.xquery(constraint=query, projection=projection)
+            if not args.dry_run
+            else []
+        )
+        converted_ads = convert_ads(
+            query_iter,
+            on_error=conversion_error,
+            return_dict=True,
+            reduce_data=not args.keep_full_queue_data,
+            pool_name=pool_name,
+            materialize=args.materialize_ads,
+        )
+        for job_ad, dict_ad in converted_ads:
+            if learn_attributes:
+                htcondor_es.projection.learn_attributes(job_ad)
             if not dict_ad:
                 continue
 
@@ -192,7 +368,7 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
                         args.email_alerts, "spider_cms queue timeout warning", message
                     )
                     break
-                queue.put(batch, timeout=time_remaining(starttime))
+                put_batch(schedd_ad["Name"], batch, starttime)
                 batch = []
                 if count_since_last_report >= 1000:
                     cpu_usage_now = resource.getrusage(resource.RUSAGE_SELF).ru_utime
@@ -231,10 +407,25 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
         traceback.print_exc()
 
     if batch:  # send remaining docs
-        queue.put(batch, timeout=time_remaining(starttime))
+        put_batch(schedd_ad["Name"], batch, starttime)
         batch = []
 
-    queue.put(schedd_ad["Name"], timeout=time_remaining(starttime))
+    if learn_attributes:
+        # Saved once by process_queues
+        result["learned"] = htcondor_es.projection.pop_learned_attributes()
+    if args.task_cache:
+        # Saved once by spider_cms
+        result["task_info"] = task_info_cache.pop_new_entries()
+    logging.info(
+        "Task info cache: %d entries, %d hits, %d misses",
+        len(task_info_cache),
+        task_info_cache.hits,
+        task_info_cache.misses,
+    )
+    if args.stage_timing:
+        stage_timer.report("%s queue" % schedd_ad["Name"])
+
+    put_end(schedd_ad["Name"], count, starttime)
     total_time = (time.time() - my_start) / 60.0
     logging.warning(
         "Schedd %-25s queue: response count: %5d; " "query time %.2f min; ",
@@ -243,12 +434,167 @@ def query_schedd_queue(starttime, schedd_ad, queue, args):
         total_time,
     )
 
-    return count
+    result.update(count=count, query_secs=total_time * 60)
+    return result
+
+
+def convert_queue_batch(starttime, ad_texts, schedd_name, pool_name, args):
+    """
+    Convert a batch of the queue ads of a schedd received by poll_schedd_queues,
+    in their text form, and send the docs to the uploaders. Returns the number
+    of docs and, with args.task_cache, the new entries of the task info cache.
+    """
+
+    def conversion_error(job_ad, e):
+        logging.warning("Failure when converting document on %s queue: %s", schedd_name, str(e))
+
+    batch = [
+        (unique_doc_id(dict_ad), dict_ad)
+        for job_ad, dict_ad in convert_ads(
+            (classad.ClassAd(text) for text in ad_texts),
+            on_error=conversion_error,
+            return_dict=True,
+            reduce_data=not args.keep_full_queue_data,
+            pool_name=pool_name,
+            materialize=args.materialize_ads,
+        )
+        if dict_ad
+    ]
+    if batch:
+        put_batch(schedd_name, batch, starttime)
+    return len(batch), task_info_cache.pop_new_entries() if args.task_cache else []
+
+
+def poll_schedd_queues(starttime, schedd_ads, pool, args, results):
+    """
+    Query the queues of all the schedds at once from a single thread, the
+    xquery streams multiplexed with htcondor.poll, so that the number of
+    schedds queried concurrently does not depend on the number of processes.
+    The ads received are converted by batches of args.query_queue_batch_size
+    in the processes of the pool, which send the docs to the uploaders. The
+    batches are sent as the text of the ads, cheaper to make in this process
+    than the pickle of the ClassAds, and parsed again by the workers.
+
+    Appends a dict like the ones of query_schedd_queue to results for each schedd.
+    """
+    projection = htcondor_es.projection.get_projection(args)
+    learn_attributes = args.learn_projection_attrs and not projection
+    query = queue_constraint(starttime)
+    streams = {}
+    active = {}
+    for schedd_ad in schedd_ads:
+        name = schedd_ad["Name"]
+        put_start(name, starttime)
+        stream = streams[name] = {
+            "result": {"name": name, "count": 0, "query_secs": 0.0},
+            "pool_name": schedd_ad.get("CMS_Pool", "Unknown"),
+            "start": time.time(),
+            "ads": [],
+            "received": 0,
+            "conversions": [],
+        }
+        if args.dry_run:
+            continue
+        try:
+            active[name] = htcondor_es.utils.get_schedd(schedd_ad).xquery(
+                constraint=query, projection=projection, name=name
+            )
+        except RuntimeError as e:
+            logging.error("Failed to query schedd %s for jobs: %s", name, str(e))
+
+    def convert(name):
+        stream = streams[name]
+        if stream["ads"]:
+            stream["conversions"].append(
+                pool.apply_async(
+                    convert_queue_batch,
+                    args=(starttime, stream["ads"], name, stream["pool_name"], args),
+                )
+            )
+            stream["ads"] = []
+
+    def finish(name):
+        convert(name)
+        streams[name]["result"]["query_secs"] = time.time() - streams[name]["start"]
+        del active[name]
+
+    timed_out = False
+    while active and not timed_out:
+        try:
+            # The failed queries are dropped and the others polled again
+            for query_iter in htcondor_es.utils.poll_queries(
+                list(active.values()), timeout_ms=int(time_remaining(starttime) * 1000)
+            ):
+                name = query_iter.tag()
+                stream = streams[name]
+                try:
+                    job_ads = query_iter.nextAdsNonBlocking()
+                except RuntimeError as e:
+                    logging.error("Failed to query schedd %s for jobs: %s", name, str(e))
+                    finish(name)
+                    break
+                if (
+                    args.max_documents_to_process
+                    and stream["received"] > args.max_documents_to_process
+                ):
+                    job_ads = []
+                for job_ad in job_ads:
+                    if learn_attributes:
+                        htcondor_es.projection.learn_attributes(job_ad)
+                    stream["ads"].append(str(job_ad))
+                    if len(stream["ads"]) == args.query_queue_batch_size:
+                        convert(name)
+                stream["received"] += len(job_ads)
+                if query_iter.done():
+                    finish(name)
+                if time_remaining(starttime) < 10:
+                    message = (
+                        "Queue crawler has been running for more than %d minutes; "
+                        "exiting with %d schedds not done" % (TIMEOUT_MINS, len(active))
+                    )
+                    logging.error(message)
+                    send_email_alert(
+                        args.email_alerts, "spider_cms queue timeout warning", message
+                    )
+                    timed_out = True
+                    break
+            else:
+                # poll is over, all the queries were consumed
+                for name in list(active):
+                    finish(name)
+        except Exception as e:
+            # A timeout of the poll too
+            logging.error("Failed to poll the schedd queries: %s", str(e))
+            for name in list(active):
+                finish(name)
+    for name in list(active):
+        finish(name)
+
+    for name, stream in streams.items():
+        for conversion in stream["conversions"]:
+            try:
+                count, task_info = conversion.get(time_remaining(starttime) + 10)
+                stream["result"]["count"] += count
+                # Saved once by spider_cms
+                task_info_cache.merge(task_info)
+            except Exception as e:
+                logging.error("Failed to convert the queue of %s: %s", name, str(e))
+        put_end(name, stream["result"]["count"], starttime)
+        logging.warning(
+            "Schedd %-25s queue: response count: %5d; " "query time %.2f min; ",
+            name,
+            stream["result"]["count"],
+            stream["result"]["query_secs"] / 60.0,
+        )
+        results.append(stream["result"])
 
 
 def process_queues(schedd_ads, starttime, pool, args, metadata=None):
     """
-    Process all the jobs in all the schedds given.
+    Process all the jobs in all the schedds given, longest expected first
+    according to the statistics of the previous runs. With args.poll_queues,
+    all the schedds are queried at once by poll_schedd_queues, the pool only
+    converts the ads.
     """
     my_start = time.time()
     if time_remaining(starttime) < 10:
@@ -258,95 +604,72 @@ def process_queues(schedd_ads, starttime, pool, args, metadata=None):
     metadata = metadata or {}
     metadata["spider_source"] = "condor_queue"
 
-    mp_manager = multiprocessing.Manager()
-    input_queue = mp_manager.Queue()
-    output_queue = mp_manager.Queue()
-    listener = ListenAndBunch(
-        input_queue=input_queue,
-        output_queue=output_queue,
-        n_expected=len(schedd_ads),
-        starttime=starttime,
-        bunch_size=args.amq_bunch_size,
-    )
-    futures = []
-
-    upload_pool = multiprocessing.Pool(processes=args.upload_pool_size)
-
-    for schedd_ad in schedd_ads:
-        future = pool.apply_async(
-            query_schedd_queue, args=(starttime, schedd_ad, input_queue, args)
+    # The query pool processes send the docs straight to the uploaders (see
+    # set_doc_queue), which send back the progress of the schedds and their counts
+    results_queue = multiprocessing.Queue()
+    logging.warning("Bunching records for AMQP in sizes of %d", args.amq_bunch_size)
+    uploaders = [
+        QueueUploader(
+            input_queue=_doc_queue,
+            results_queue=results_queue,
+            starttime=starttime,
+            args=args,
+            metadata=metadata,
+            bunch_size=args.amq_bunch_size,
         )
-        futures.append((schedd_ad["Name"], future))
+        for _ in range(args.upload_pool_size)
+    ]
+    futures = []
 
-    def _callback_amq(result):
-        sent, received, elapsed = result
-        logging.info(
-            "Uploaded %d/%d docs to StompAMQ in %d seconds", sent, received, elapsed
+    queue_stats = load_schedd_stats(_QUEUE_STATS_JSON)
+    tasks = [
+        (queue_stats.get(schedd_ad["Name"], {}).get("query_secs"), schedd_ad)
+        for schedd_ad in schedd_ads
+    ]
+    # All the queries run at once when polled
+    n_workers = len(schedd_ads) if args.poll_queues else args.query_pool_size
+    ordered_schedd_ads, predicted_makespan = longest_first(tasks, n_workers)
+    submitted = time.time()
+    poll_results = []
+    if args.poll_queues:
+        poller = threading.Thread(
+            target=poll_schedd_queues,
+            args=(starttime, ordered_schedd_ads, pool, args, poll_results),
+            name="queue poller",
+            daemon=True,
         )
-
-    total_processed = 0
-    while True:
-        if args.dry_run or len(schedd_ads) == 0:
-            break
-
-        if time_remaining(starttime) < 5:
-            logging.warning("Listener did not shut down properly; terminating.")
-            listener.terminate()
-            break
-
-        bunch = output_queue.get(timeout=time_remaining(starttime))
-        if bunch is None:  # swallow the poison pill
-            total_processed = int(output_queue.get(timeout=time_remaining(starttime)))
-            break
-
-        if args.feed_es_for_queues and not args.read_only:
-            # Note that these bunches are sized according to --amq_bunch_size
-            # FIXME: Why are we determining the index from one ad?
-            idx = htcondor_es.es.get_index(
-                timestamp=bunch[0][1].get("QDate", int(time.time())),
-                template=args.es_index_template,
-                args=args,
-                update_es=(args.feed_es and not args.read_only),
-            )
-
-            future = upload_pool.apply_async(
-                htcondor_es.es.post_ads, args=(args, idx, bunch, metadata)
+        poller.start()
+    else:
+        poller = None
+        for schedd_ad in ordered_schedd_ads:
+            future = pool.apply_async(
+                query_schedd_queue, args=(starttime, schedd_ad, args)
             )
-            futures.append(("UPLOADER_ES", future))
-
-        if args.feed_amq and not args.read_only:
-            amq_bunch = [
-                (id_, convert_dates_to_millisecs(dict_ad)) for id_, dict_ad in bunch
-            ]
-            future = upload_pool.apply_async(
-                htcondor_es.amq.post_ads,
-                args=(amq_bunch, metadata),
-                callback=_callback_amq,
-            )
-            futures.append(("UPLOADER_AMQ", future))
-
-        logging.info("Starting new uploader, %d items in queue" % output_queue.qsize())
+            futures.append((schedd_ad["Name"], future))
 
-    listener.join()
+    total_processed, total_sent, total_upload_time = collect_uploads(
+        results_queue, len(schedd_ads), uploaders, starttime
+    )
+    if poller is not None:
+        poller.join(time_remaining(starttime) + 10)
+    log_makespan("queues", predicted_makespan, time.time() - submitted, n_workers)
 
     timed_out = False
-    total_sent = 0
-    total_upload_time = 0
     total_queried = 0
+    # The names learned by the poller thread, then by the query processes
+    learned = [htcondor_es.projection.pop_learned_attributes()]
+    for result in poll_results:
+        total_queried += result["count"]
+        queue_stats[result["name"]] = {"docs": result["count"], "query_secs": result["query_secs"]}
     for name, future in futures:
         if time_remaining(starttime, positive=False) > -20:
             try:
                 count = future.get(time_remaining(starttime) + 10)
-                if name == "UPLOADER_AMQ":
-                    total_sent += count[0]
-                    total_upload_time += count[2]
-                elif name == "UPLOADER_ES":
-                    total_sent += count
-                else:
-                    try:
-                        total_queried += count
-                    except TypeError:
-                        pass
+                total_queried += count["count"]
+                queue_stats[name] = {"docs": count["count"], "query_secs": count["query_secs"]}
+                if "learned" in count:
+                    learned.append(count["learned"])
+                task_info_cache.merge(count.get("task_info", []))
             except multiprocessing.TimeoutError:
                 message = "Schedd %s queue timed out; ignoring progress." % name
                 logging.error(message)
@@ -358,12 +681,15 @@ def process_queues(schedd_ads, starttime, pool, args, metadata=None):
             break
 
     if timed_out:
-        logging.error("Timed out when retrieving uploaders. Upload count incomplete.")
+        logging.error("Timed out when retrieving the queries. Query count incomplete.")
         pool.terminate()
-        upload_pool.terminate()
 
     if not total_queried == total_processed:
         logging.warning("Number of queried docs not equal to number of processed docs.")
+    if not args.dry_run:
+        save_schedd_stats(_QUEUE_STATS_JSON, queue_stats)
+    if args.learn_projection_attrs:
+        htcondor_es.projection.save_learned_attributes(learned)
 
     logging.warning(
         "Processing time for queues: %.2f mins, %d/%d docs sent in %.2f min "
@@ -373,6 +699,3 @@ def process_queues(schedd_ads, starttime, pool, args, metadata=None):
         total_queried,
         total_upload_time / 60.0,
     )
-
-    upload_pool.close()
-    upload_pool.join()
@@ -7,11 +7,13 @@ import pwd
 import sys
 import time
 import errno
+import heapq
 import shlex
 import socket
 import random
 import logging
 import smtplib
+import statistics
 import subprocess
 import email.mime.text
 import logging.handlers
@@ -74,6 +76,19 @@ def get_schedds(args=None, collectors=None, pool_name="Unknown"):
     return schedd_ads
 
 
+def get_schedd(schedd_ad):
+    """
+    Return the client of a schedd ad. The history and queue crawlers get
+    their schedds from here, tests/fakeCondor.py replaces it.
+    """
+    return htcondor.Schedd(schedd_ad)
+
+
+def poll_queries(queries, timeout_ms=20000):
+    """Return htcondor.poll of the xquery iterators given, see get_schedd"""
+    return htcondor.poll(queries, timeout_ms)
+
+
 def send_email_alert(recipients, subject, message):
     """
     Send a simple email alert (typically of failure).
@@ -115,6 +130,71 @@ def time_remaining(starttime, timeout=TIMEOUT_MINS * 60, positive=True):
     return timeout - elapsed
 
 
+def load_schedd_stats(filename):
+    """
+    Return the per schedd statistics of the previous runs kept in filename,
+    an empty dict if there are none yet.
+    """
+    try:
+        with open(filename) as fd:
+            return json.load(fd)
+    except Exception as e:
+        logging.warning("No schedd statistics read from %s: %s", filename, str(e))
+        return {}
+
+
+def save_schedd_stats(filename, stats):
+    """Write the schedd statistics to filename, replaced atomically"""
+    tmp_file = filename + ".tmp"
+    try:
+        with open(tmp_file, "w") as fd:
+            json.dump(stats, fd)
+        os.replace(tmp_file, filename)
+    except Exception as e:
+        logging.warning("Failed to write the schedd statistics to %s: %s", filename, str(e))
+
+
+def longest_first(tasks, n_workers):
+    """
+    Order (expected_secs, task) pairs longest expected first, the tasks of
+    schedds without statistics (None) are expected to take the median time
+    of the others.
+
+    Returns the ordered tasks and the makespan predicted when assigning them
+    in this order to the first free of n_workers, None without any statistics.
+    """
+    known = [secs for secs, _ in tasks if secs is not None]
+    if not known:
+        return [task for _, task in tasks], None
+    median = statistics.median(known)
+    tasks = sorted(
+        ((secs if secs is not None else median, task) for secs, task in tasks),
+        key=lambda item: -item[0],
+    )
+    workers = [0.0] * max(1, n_workers)
+    for secs, _ in tasks:
+        heapq.heapreplace(workers, workers[0] + secs)
+    return [task for _, task in tasks], max(workers)
+
+
+def log_makespan(kind, predicted, actual, n_workers):
+    if predicted is None:
+        logging.warning(
+            "Makespan of the %s: %.2f min on %d workers, no prediction without statistics",
+            kind,
+            actual / 60.0,
+            n_workers,
+        )
+    else:
+        logging.warning(
+            "Makespan of the %s: %.2f min on %d workers, %.2f min predicted",
+            kind,
+            actual / 60.0,
+            n_workers,
+            predicted / 60.0,
+        )
+
+
 def set_up_logging(args):
     """Configure root logger with rotating file handler"""
     logger = logging.getLogger()
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+"""
+Benchmark the rule based campaign/workflow/task type classification
+against the if/elif regex chains it replaced, on a replayed corpus of job ads.
+
+The corpus is either a pickle of job ClassAds (as written by testDocConversion.py)
+or a json list of dicts with the WMAgent/CRAB attributes.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import logging
+import argparse
+
+try:
+    import htcondor_es
+except ImportError:
+    if os.path.exists("src/htcondor_es/__init__.py") and "src" not in sys.path:
+        sys.path.append("src")
+
+from htcondor_es.convert_to_json import (
+    guessCampaign,
+    guess_campaign_type,
+    guessTaskType,
+    guessWorkflow,
+    isAnalysisJob,
+)
+
+# Reference implementation: the regex chains as they were before the rule engine
+_camp_re = re.compile(r"[A-Za-z0-9_]+_[A-Z0-9]+-([A-Za-z0-9]+)-")
+_prep_re = re.compile(r"[A-Za-z0-9_]+_([A-Z]+-([A-Za-z0-9]+)-[0-9]+)")
+_rval_re = re.compile(r"[A-Za-z0-9]+_(RVCMSSW_[0-9]+_[0-9]+_[0-9]+)")
+_prep_prompt_re = re.compile(r"(PromptReco|Repack|Express)_[A-Za-z0-9]+_([A-Za-z0-9]+)")
+_rereco_re = re.compile(r"[A-Za-z0-9_]+_Run20[A-Za-z0-9-_]+-([A-Za-z0-9]+)")
+
+
+def chain_task_type(ad):
+    jobType = ad.get("CMS_JobType", "UNKNOWN")
+    if jobType == "Processing":
+        return "DataProcessing"
+    elif jobType == "Production":
+        ttype = ad.get("WMAgent_SubTaskName", "/UNKNOWN").rsplit("/", 1)[-1]
+        camp2_info = ttype.split("-")
+        if len(camp2_info) > 1:
+            camp2 = camp2_info[1]
+        else:
+            camp2 = ttype
+        if "CleanupUnmerged" in ttype:
+            return "Cleanup"
+        elif "Merge" in ttype:
+            return "Merge"
+        elif "LogCollect" in ttype:
+            return "LogCollect"
+        elif ("MiniAOD" in ad.get("WMAgent_RequestName", "UNKNOWN")) and (
+            ttype == "StepOneProc"
+        ):
+            return "MINIAOD"
+        elif "MiniAOD" in ttype:
+            return "MINIAOD"
+        elif ttype == "StepOneProc" and (re.search("[1-9][0-9]DR", camp2)):
+            return "DIGIRECO"
+        elif (re.search("[1-9][0-9]GS", camp2)) and ttype.endswith("_0"):
+            return "GENSIM"
+        elif ttype.endswith("_0"):
+            return "DIGI"
+        elif ttype.endswith("_1") or ttype.lower() == "reco":
+            return "RECO"
+        elif ttype == "MonteCarloFromGEN":
+            return "GENSIM"
+        else:
+            return "UNKNOWN"
+    else:
+        return jobType
+
+
+def chain_campaign(ad, analysis, cms_campaign_type):
+    camp = ad.get("WMAgent_RequestName", "UNKNOWN")
+    if ad.get("CMS_CampaignName"):
+        return ad.get("CMS_CampaignName")
+    if analysis:
+        return "crab_" + ad.get("CRAB_UserHN", "UNKNOWN")
+    if camp.startswith("PromptReco"):
+        return "PromptReco"
+    if camp.startswith("Repack"):
+        return "Repack"
+    if camp.startswith("Express"):
+        return "Express"
+    if "RVCMSSW" in camp:
+        return "RelVal"
+    m = _camp_re.match(camp)
+    if m:
+        return m.groups()[0]
+    m = _rereco_re.match(camp)
+    if m and ("DataProcessing" in ad.get("WMAgent_SubTaskName", "")):
+        return m.groups()[0] + "Reprocessing"
+    logging.info("Campaign will be CMS_CampaignType. camp:{}".format(camp))
+    return cms_campaign_type
+
+
+def chain_campaign_type(ad, analysis):
+    camp = ad.get("WMAgent_RequestName", "UNKNOWN")
+    if analysis:
+        return "Analysis"
+    elif re.match(r".*(RunIISummer([12])[0-9]UL|_UL[0-9]+).*", camp):
+        return "MC Ultralegacy"
+    elif re.match(r".*UltraLegacy.*", camp):
+        return "Data Ultralegacy"
+    elif re.match(r".*Phase2.*", camp):
+        return "Phase2 requests"
+    elif re.match(r".*(Run3|RunIII).*", camp):
+        return "Run3 requests"
+    elif "RVCMSSW" in camp:
+        return "RelVal"
+    elif re.match(r".*(RunII|(Summer|Fall|Autumn|Winter|Spring)(1[5-9]|20)).*", camp):
+        return "Run2 requests"
+    elif "SnowmassWinter21" in camp:
+        return "SnowmassWinter21"
+    else:
+        return "UNKNOWN"
+
+
+def chain_workflow(ad, analysis):
+    prep = ad.get("WMAgent_RequestName", "UNKNOWN")
+    m = _prep_re.match(prep)
+    if analysis:
+        return ad.get("CRAB_Workflow", "UNKNOWN").split(":", 1)[-1]
+    elif m:
+        return m.groups()[0]
+    else:
+        m = _prep_prompt_re.match(prep)
+        if m:
+            return m.groups()[0] + "_" + m.groups()[1]
+        else:
+            m = _rval_re.match(prep)
+            if m:
+                return m.groups()[0]
+    return prep
+
+
+def classify_with_chains(ad, analysis):
+    campaign_type = chain_campaign_type(ad, analysis)
+    return (
+        campaign_type,
+        chain_campaign(ad, analysis, campaign_type),
+        chain_task_type(ad),
+        chain_workflow(ad, analysis),
+    )
+
+
+def classify_with_rules(ad, analysis):
+    campaign_type = guess_campaign_type(ad, analysis)
+    return (
+        campaign_type,
+        guessCampaign(ad, analysis, campaign_type),
+        guessTaskType(ad),
+        guessWorkflow(ad, analysis),
+    )
+
+
+def load_corpus(filename):
+    if filename.endswith(".json"):
+        with open(filename) as fd:
+            return json.load(fd)
+    with open(filename, "rb") as fd:
+        return pickle.load(fd)
+
+
+def timed(classify, ads, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [classify(ad, analysis) for ad, analysis in ads]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main(args):
+    ads = [(ad, isAnalysisJob(ad)) for ad in load_corpus(args.filename)]
+    print("...replaying %d job ads, best of %d" % (len(ads), args.repeat))
+
+    chain_time, chain_results = timed(classify_with_chains, ads, args.repeat)
+    rules_time, rules_results = timed(classify_with_rules, ads, args.repeat)
+
+    mismatches = [
+        (ad, old, new)
+        for (ad, _), old, new in zip(ads, chain_results, rules_results)
+        if old != new
+    ]
+    for ad, old, new in mismatches[: args.show_mismatches]:
+        print("   mismatch for %s: %s != %s" % (ad.get("WMAgent_SubTaskName"), old, new))
+
+    print("   regex chains: %8.0f ads/sec" % (len(ads) / chain_time))
+    print("   rule engine:  %8.0f ads/sec" % (len(ads) / rules_time))
+    print("   %d/%d ads classified differently" % (len(mismatches), len(ads)))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "filename",
+        type=str,
+        help="Pickle file of job ClassAds or json file with a list of job attribute dicts",
+    )
+    parser.add_argument(
+        "--repeat",
+        default=5,
+        type=int,
+        dest="repeat",
+        help="Number of timing repetitions [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--show_mismatches",
+        default=10,
+        type=int,
+        dest="show_mismatches",
+        help="Number of mismatching ads to print [default: %(default)d]",
+    )
+
+    args = parser.parse_args()
+    sys.exit(main(args))
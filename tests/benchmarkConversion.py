@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""
+Benchmark the document pipeline of the spider on a stored corpus of job ads:
+convert_to_json (full and reduce_data modes), make_es_body,
+convert_dates_to_millisecs and the AMQ notification building.
+
+Reports, per stage, the throughput (best of --repeat), the per ad latency
+percentiles and the peak memory (measured by tracemalloc in a separate pass).
+The results can be written with --output and two result files compared with
+--compare, e.g. to check an optimization of the converter between two commits:
+
+    python tests/benchmarkConversion.py ads.pck --output before.json
+    python tests/benchmarkConversion.py ads.pck --output after.json
+    python tests/benchmarkConversion.py --compare before.json after.json
+
+The corpus is a pickle of job ClassAds, as written by testDocConversion.py,
+or a file of ClassAds in the old format (gzip compressed if its name ends
+with .gz), as written by condor_history -l or generateAdCorpus.py.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+try:
+    import htcondor_es
+except ImportError:
+    if os.path.exists("src/htcondor_es/__init__.py") and "src" not in sys.path:
+        sys.path.append("src")
+
+from htcondor_es import encoding
+from htcondor_es.es import make_es_body
+from htcondor_es.convert_to_json import (
+    convert_to_json,
+    convert_dates_to_millisecs,
+    unique_doc_id,
+)
+from fakeCondor import read_ads
+
+try:
+    from CMSMonitoring.StompAMQ7 import StompAMQ7 as StompAMQ
+except ImportError:
+    StompAMQ = None
+
+STAGES = ("convert", "convert_reduced", "es_body", "dates", "amq")
+PERCENTILES = (50, 90, 99)
+
+
+def load_corpus(filename, max_ads=0):
+    if filename.endswith((".pck", ".pkl", ".pickle")):
+        with open(filename, "rb") as fd:
+            job_ads = pickle.load(fd)
+        return job_ads[:max_ads] if max_ads else job_ads
+    return list(read_ads(filename, max_ads))
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Stage:
+    """
+    A benchmarked step: prepare() returns fresh (call arguments, number of ads)
+    items for one pass, so that stages updating the documents in place
+    always start from the same input.
+    """
+
+    def __init__(self, name, func, prepare):
+        self.name = name
+        self.func = func
+        self.prepare = prepare
+
+    def timed_pass(self):
+        items = self.prepare()
+        func = self.func
+        clock = time.perf_counter
+        latencies = []
+        start = clock()
+        for item, n_ads in items:
+            item_start = clock()
+            func(*item)
+            elapsed = clock() - item_start
+            latencies.extend([elapsed / n_ads] * n_ads)
+        return clock() - start, latencies
+
+    def memory_pass(self):
+        items = self.prepare()
+        tracemalloc.start()
+        try:
+            outputs = [self.func(*item) for item, _ in items]
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del outputs
+        return peak
+
+    def run(self, repeat):
+        best = None
+        all_latencies = []
+        for _ in range(repeat):
+            elapsed, latencies = self.timed_pass()
+            best = elapsed if best is None else min(best, elapsed)
+            all_latencies.extend(latencies)
+        all_latencies.sort()
+        n_ads = len(all_latencies) // repeat
+        result = {
+            "ads": n_ads,
+            "ads_per_sec": n_ads / best if best else None,
+            "peak_memory_mb": self.memory_pass() / 1e6,
+        }
+        for pct in PERCENTILES:
+            value = percentile(all_latencies, pct)
+            result["p%d_us" % pct] = value * 1e6 if value is not None else None
+        return result
+
+
+def convertible(job_ads):
+    """Drop the ads the spider would fail to convert or to serialize"""
+    kept, docs = [], []
+    for job_ad in job_ads:
+        try:
+            doc = convert_to_json(job_ad, return_dict=True)
+            encoding.dumps(doc)
+        except Exception:
+            continue
+        kept.append(job_ad)
+        if doc:
+            docs.append((unique_doc_id(doc), doc))
+    if len(kept) < len(job_ads):
+        print("   skipping %d job ads failing the conversion" % (len(job_ads) - len(kept)))
+    return kept, docs
+
+
+def make_stages(job_ads, docs, args):
+    metadata = {"spider_runtime": int(time.time() * 1000), "spider_source": "benchmark"}
+    bunches = [docs[i : i + args.es_bunch_size] for i in range(0, len(docs), args.es_bunch_size)]
+    millisec_docs = [(id_, convert_dates_to_millisecs(dict(doc))) for id_, doc in docs]
+
+    stages = {
+        "convert": Stage(
+            "convert",
+            lambda ad: convert_to_json(ad, return_dict=True),
+            lambda: [((ad,), 1) for ad in job_ads],
+        ),
+        "convert_reduced": Stage(
+            "convert_reduced",
+            lambda ad: convert_to_json(ad, return_dict=True, reduce_data=True),
+            lambda: [((ad,), 1) for ad in job_ads],
+        ),
+        "es_body": Stage(
+            "es_body",
+            lambda bunch: make_es_body(bunch, metadata),
+            lambda: [((bunch,), len(bunch)) for bunch in bunches],
+        ),
+        "dates": Stage(
+            "dates",
+            convert_dates_to_millisecs,
+            lambda: [((dict(doc),), 1) for _, doc in docs],
+        ),
+    }
+    if StompAMQ is not None:
+        # The broker is only contacted on send(), building the notifications is local
+        interface = StompAMQ(
+            username="benchmark",
+            password="benchmark",
+            producer="benchmark",
+            topic="/topic/benchmark",
+            host_and_ports=[("localhost", 61313)],
+            validation_schema=args.amq_schema or None,
+        )
+
+        def make_notification(id_, doc):
+            return interface.make_notification(
+                payload=doc,
+                doc_type=None,
+                doc_id=id_,
+                ts=doc["RecordTime"],
+                metadata=metadata,
+                data_subfield=None,
+            )
+
+        stages["amq"] = Stage(
+            "amq",
+            make_notification,
+            lambda: [((id_, dict(doc)), 1) for id_, doc in millisec_docs],
+        )
+    return stages
+
+
+def run(args):
+    used = encoding.set_backend(args.json_backend)
+    job_ads, docs = convertible(load_corpus(args.filenames[0], args.max_ads))
+    stages = make_stages(job_ads, docs, args)
+    print(
+        "...benchmarking %d job ads, best of %d, JSON backend %s"
+        % (len(job_ads), args.repeat, used)
+    )
+
+    results = {}
+    for name in args.stages.split(","):
+        if name not in stages:
+            print("   %-16s not available, skipped" % name)
+            continue
+        results[name] = stages[name].run(args.repeat)
+        print_stage(name, results[name])
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "corpus": os.path.abspath(args.filenames[0]),
+            "n_job_ads": len(job_ads),
+            "repeat": args.repeat,
+            "es_bunch_size": args.es_bunch_size,
+            "json_backend": used,
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "time": int(time.time()),
+            "stages": results,
+        }
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=4, sort_keys=True)
+        print("   ...results written to %s" % args.output)
+    return 0
+
+
+def print_stage(name, result):
+    print(
+        "   %-16s %9.0f ads/sec  p50 %8.1f us  p90 %8.1f us  p99 %8.1f us  peak %7.1f MB"
+        % (
+            name,
+            result["ads_per_sec"] or 0,
+            result["p50_us"] or 0,
+            result["p90_us"] or 0,
+            result["p99_us"] or 0,
+            result["peak_memory_mb"],
+        )
+    )
+
+
+def relative_change(old, new):
+    if not old or new is None:
+        return None
+    return 100.0 * (new - old) / old
+
+
+def compare(args):
+    reports = []
+    for filename in args.filenames:
+        with open(filename) as fd:
+            reports.append(json.load(fd))
+    old, new = reports
+    print("...comparing %s (old) with %s (new)" % (old.get("commit"), new.get("commit")))
+    if old.get("corpus") != new.get("corpus") or old.get("n_job_ads") != new.get("n_job_ads"):
+        print("   warning: the results were not measured on the same corpus")
+    for setting in ("json_backend", "es_bunch_size", "python"):
+        if old.get(setting) != new.get(setting):
+            print(
+                "   warning: different %s, %s != %s" % (setting, old.get(setting), new.get(setting))
+            )
+
+    regressions = 0
+    for name in STAGES:
+        if name not in old["stages"] or name not in new["stages"]:
+            continue
+        before, after = old["stages"][name], new["stages"][name]
+        changes = [
+            relative_change(before.get(key), after.get(key))
+            for key in ("ads_per_sec", "p50_us", "p99_us", "peak_memory_mb")
+        ]
+        print(
+            "   %-16s ads/sec %s  p50 %s  p99 %s  peak memory %s"
+            % ((name,) + tuple("%+7.1f%%" % c if c is not None else "    n/a " for c in changes))
+        )
+        if changes[0] is not None and changes[0] < -args.tolerance:
+            regressions += 1
+    if regressions:
+        print("   %d stage(s) slower by more than %.1f%%" % (regressions, args.tolerance))
+    return 1 if regressions else 0
+
+
+def main(args):
+    if args.compare:
+        if len(args.filenames) != 2:
+            print("--compare needs two result files")
+            return 2
+        return compare(args)
+    if len(args.filenames) != 1:
+        print("Give one corpus file to benchmark")
+        return 2
+    return run(args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "filenames",
+        type=str,
+        nargs="+",
+        help="Pickle or old format file of job ClassAds, or two result files with --compare",
+    )
+    parser.add_argument(
+        "--max_ads",
+        default=0,
+        type=int,
+        dest="max_ads",
+        help="Benchmark only the first N job ads of the corpus [default: all]",
+    )
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        dest="compare",
+        help="Compare two result files written with --output",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        type=str,
+        dest="output",
+        help="Write the results to this json file",
+    )
+    parser.add_argument(
+        "--stages",
+        default=",".join(STAGES),
+        type=str,
+        dest="stages",
+        help="Comma separated list of stages to run [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--repeat",
+        default=5,
+        type=int,
+        dest="repeat",
+        help="Number of timing repetitions [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--es_bunch_size",
+        default=250,
+        type=int,
+        dest="es_bunch_size",
+        help="Documents per bulk body [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--json_backend",
+        default="json",
+        choices=encoding.BACKENDS,
+        dest="json_backend",
+        help="JSON encoder of the ES bulk bodies [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--amq_schema",
+        default="",
+        type=str,
+        dest="amq_schema",
+        help="Validate the AMQ notifications against this schema, e.g. JobMonitoring.json "
+             "[default: no validation]",
+    )
+    parser.add_argument(
+        "--tolerance",
+        default=5.0,
+        type=float,
+        dest="tolerance",
+        help="With --compare, fail if a stage is slower by more than this percentage "
+             "[default: %(default).1f]",
+    )
+
+    args = parser.parse_args()
+    sys.exit(main(args))
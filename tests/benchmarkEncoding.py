@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Benchmark the JSON encoding backends of htcondor_es.encoding on converted
+documents, and check that they give the same documents once parsed.
+
+The input is either a pickle of job ClassAds (as written by testDocConversion.py)
+or a json list of already converted documents (as dumped by testDocConversion.py).
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+
+try:
+    import htcondor_es
+except ImportError:
+    if os.path.exists("src/htcondor_es/__init__.py") and "src" not in sys.path:
+        sys.path.append("src")
+
+from htcondor_es import encoding
+from htcondor_es.es import make_es_body
+from htcondor_es.convert_to_json import convert_to_json, unique_doc_id
+
+
+def load_docs(filename):
+    if filename.endswith(".json"):
+        with open(filename) as fd:
+            dict_ads = json.load(fd)
+    else:
+        with open(filename, "rb") as fd:
+            job_ads = pickle.load(fd)
+        dict_ads = [convert_to_json(job_ad, return_dict=True) for job_ad in job_ads]
+    return [(unique_doc_id(dict_ad), dict_ad) for dict_ad in dict_ads if dict_ad]
+
+
+def timed(docs, bunch_size, metadata, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        bodies = [
+            make_es_body(docs[i : i + bunch_size], metadata)
+            for i in range(0, len(docs), bunch_size)
+        ]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, bodies
+
+
+def parsed(bodies):
+    return [json.loads(line) for body in bodies for line in body.splitlines()]
+
+
+def main(args):
+    docs = load_docs(args.filename)
+    metadata = {"spider_runtime": int(time.time() * 1000), "spider_source": "benchmark"}
+    print(
+        "...encoding %d documents in bunches of %d, best of %d"
+        % (len(docs), args.es_bunch_size, args.repeat)
+    )
+
+    reference = None
+    mismatches = 0
+    for backend in args.backends.split(","):
+        used = encoding.set_backend(backend)
+        if used != backend:
+            print("   %-8s not available, skipped" % backend)
+            continue
+        elapsed, bodies = timed(docs, args.es_bunch_size, metadata, args.repeat)
+        size = sum(len(body) for body in bodies)
+        print(
+            "   %-8s %8.0f docs/sec  %6.1f MB"
+            % (backend, len(docs) / elapsed, size / 1e6)
+        )
+        if reference is None:
+            reference = parsed(bodies)
+        elif parsed(bodies) != reference:
+            print("   %-8s documents differ from the first backend" % backend)
+            mismatches += 1
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "filename",
+        type=str,
+        help="Pickle file of job ClassAds or json file with a list of converted documents",
+    )
+    parser.add_argument(
+        "--backends",
+        default="json,orjson",
+        type=str,
+        dest="backends",
+        help="Comma separated list of backends to compare [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--es_bunch_size",
+        default=250,
+        type=int,
+        dest="es_bunch_size",
+        help="Documents per bulk body [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--repeat",
+        default=5,
+        type=int,
+        dest="repeat",
+        help="Number of timing repetitions [default: %(default)d]",
+    )
+
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,14 @@
+"""
+pytest configuration: run the tests against the src tree when htcondor_es
+is not installed, like the scripts of this directory do.
+"""
+
+import os
+import sys
+
+try:
+    import htcondor_es
+except ImportError:
+    _SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    if _SRC not in sys.path:
+        sys.path.insert(0, _SRC)
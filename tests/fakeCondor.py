@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+Stand-in for the HTCondor collectors and schedds, to run the spider
+end to end on a laptop:
+
+    python tests/fakeCondor.py CONFIG [spider_cms.py options]
+
+runs scripts/spider_cms.py with its collector query, htcondor_es.utils
+get_schedd and poll_queries replaced by the ones of this module, before
+the spider forks its workers.
+
+The fake schedds serve job ads taken from local corpora of old format
+ClassAds (see tests/generateAdCorpus.py), with configurable ad counts,
+latency, throughput caps, stalls and failures per schedd. The config is a
+json file like:
+
+    {
+        "corpus": "history_ads.gz",
+        "queue_corpus": "queue_ads.gz",
+        "corpus_size": 5000,
+        "n_schedds": 20,
+        "schedd_name": "vocms%04d.cern.ch",
+        "pool_name": "Global",
+        "default": {"n_ads": 20000, "latency": 0.5, "ads_per_sec": 5000},
+        "schedds": {
+            "vocms0003.cern.ch": {"n_ads": 200000},
+            "vocms0007.cern.ch": {"stall_every": 1000, "stall_secs": 120},
+            "crab3@vocms0199.cern.ch": {"fail_after": 5000}
+        }
+    }
+
+Relative corpus paths are relative to the config file. The first
+corpus_size ads of each corpus are loaded once, in the spider's main
+process so that the forked workers share them, and every schedd cycles
+through them from its own offset, with its own GlobalJobId/ClusterId. The
+ads are parsed again for each query, like the bindings deserialize the ads
+received from a real schedd.
+
+Constraints are ignored unless match_constraint is set, the corpus ads
+may well be outside the queried time window. The history of a schedd is
+the same for every query, the ad served first being the most recently
+recorded, and the since bound of the history queries is honoured. The
+xqueries can be multiplexed with poll(), like htcondor.poll.
+"""
+
+import os
+import re
+import sys
+import json
+import gzip
+import time
+import zlib
+import random
+import logging
+import threading
+import collections
+
+import classad
+
+# Behaviour of each schedd, "default" and "schedds" in the config override it
+SCHEDD_DEFAULTS = {
+    "n_ads": 1000,  # ads returned by each history query
+    "queue_n_ads": None,  # ads returned by each xquery, n_ads if None
+    "latency": 0.0,  # seconds before the first ad is returned
+    "ads_per_sec": 0,  # throughput cap, 0 for none
+    "stall_every": 0,  # the query stalls after every N ads
+    "stall_secs": 0.0,
+    "fail_probability": 0.0,  # probability that a query fails before returning any ad
+    "fail_after": -1,  # the query fails after returning N ads
+    "match_constraint": False,  # only return the ads matching the query constraint
+}
+
+_pools = {}
+
+
+def read_ads(filename, max_ads=0):
+    """
+    Stream the ClassAds of an old format file (gzip compressed if its name
+    ends with .gz), separated by blank lines. Parsing them one by one is much
+    faster than classad.parseAds on a file object that is not a real file.
+    """
+    opener = gzip.open if filename.endswith(".gz") else open
+    count = 0
+    with opener(filename, "rt") as fd:
+        lines = []
+        for line in fd:
+            if line.strip():
+                lines.append(line)
+                continue
+            if not lines:
+                continue
+            yield classad.parseOne("".join(lines), classad.Parser.Old)
+            lines = []
+            count += 1
+            if count == max_ads:
+                return
+        if lines:
+            yield classad.parseOne("".join(lines), classad.Parser.Old)
+
+
+class FakePool(object):
+    """The schedds of a config file, and the ads they serve"""
+
+    def __init__(self, config_file):
+        with open(config_file) as fd:
+            config = json.load(fd)
+        self.config_file = config_file
+        self.pool_name = config.get("pool_name", "Fake")
+        corpus_size = config.get("corpus_size", 5000)
+        config_dir = os.path.dirname(os.path.abspath(config_file))
+        history_corpus = os.path.join(config_dir, config["corpus"])
+        queue_corpus = os.path.join(config_dir, config.get("queue_corpus", config["corpus"]))
+        # Kept as text, new ClassAd format is the fastest to parse
+        self.history_ads = [str(ad) for ad in read_ads(history_corpus, corpus_size)]
+        if queue_corpus == history_corpus:
+            self.queue_ads = self.history_ads
+        else:
+            self.queue_ads = [str(ad) for ad in read_ads(queue_corpus, corpus_size)]
+        if not self.history_ads or not self.queue_ads:
+            raise ValueError("Empty ClassAd corpus in %s" % config_file)
+
+        defaults = dict(SCHEDD_DEFAULTS, **config.get("default", {}))
+        overrides = config.get("schedds", {})
+        names = [
+            config.get("schedd_name", "fake%04d.cern.ch") % i
+            for i in range(config.get("n_schedds", 10))
+        ]
+        names.extend(name for name in overrides if name not in names)
+        self.schedds = {name: dict(defaults, **overrides.get(name, {})) for name in names}
+        logging.warning(
+            "Fake HTCondor pool %s: %d schedds, %d history and %d queue ads in the corpus",
+            self.pool_name,
+            len(self.schedds),
+            len(self.history_ads),
+            len(self.queue_ads),
+        )
+
+    def schedd_ads(self):
+        return [
+            classad.ClassAd(
+                {
+                    "Name": name,
+                    "MyAddress": "<127.0.0.1:0>",
+                    "ScheddIpAddr": "<127.0.0.1:0>",
+                    "CMS_Pool": self.pool_name,
+                    "FakeCondorConfig": self.config_file,
+                }
+            )
+            for name in self.schedds
+        ]
+
+
+def get_pool(config_file):
+    """Load a config once per process"""
+    pool = _pools.get(config_file)
+    if pool is None:
+        pool = _pools[config_file] = FakePool(config_file)
+    return pool
+
+
+def get_schedds(args=None, config_file=None):
+    """
+    Return the schedd ads of the fake pool, like utils.get_schedds
+    does for the ones of real collectors.
+    """
+    schedd_ads = get_pool(config_file).schedd_ads()
+    random.shuffle(schedd_ads)
+
+    if args and args.schedd_filter:
+        return [s for s in schedd_ads if s["Name"] in args.schedd_filter.split(",")]
+
+    return schedd_ads
+
+
+class Schedd(object):
+    """
+    Fake htcondor.Schedd, see htcondor_es.utils.get_schedd.
+
+    Failures are raised as RuntimeError, like the bindings do.
+    """
+
+    def __init__(self, schedd_ad):
+        self.name = schedd_ad["Name"]
+        self.pool = get_pool(schedd_ad["FakeCondorConfig"])
+        self.settings = self.pool.schedds[self.name]
+        self.offset = zlib.crc32(self.name.encode("utf-8"))
+        self.first_cluster = 1000000 + self.offset % 1000000
+
+    def history(self, constraint, projection, match=-1, since=None):
+        n_ads = self.settings["n_ads"]
+        if match >= 0:
+            n_ads = min(n_ads, match)
+        if isinstance(since, int):
+            since = "ClusterId == %d" % since
+        elif isinstance(since, str) and re.match(r"^\d+\.\d+$", since):
+            since = "ClusterId == %s && ProcId == %s" % tuple(since.split("."))
+        if since is not None:
+            since = classad.ExprTree(str(since))
+        return self._serve("history", self.pool.history_ads, n_ads, constraint, projection, since)
+
+    def xquery(self, constraint="true", projection=None, name=None):
+        n_ads = self.settings["queue_n_ads"]
+        if n_ads is None:
+            n_ads = self.settings["n_ads"]
+        ads = self._serve("queue", self.pool.queue_ads, n_ads, constraint, projection)
+        return Query(ads, name or self.name)
+
+    def _serve(self, kind, corpus, n_ads, constraint, projection, since=None):
+        settings = self.settings
+        if random.random() < settings["fail_probability"]:
+            raise RuntimeError("Fake schedd %s failed the %s query" % (self.name, kind))
+        if settings["match_constraint"] and constraint is not None:
+            constraint = classad.ExprTree(str(constraint))
+        else:
+            constraint = None
+        return self._ads(kind, corpus, n_ads, constraint, projection, since)
+
+    def _ads(self, kind, corpus, n_ads, constraint, projection, since):
+        settings = self.settings
+        ads_per_sec = settings["ads_per_sec"]
+        stall_every = settings["stall_every"]
+        fail_after = settings["fail_after"]
+        start = time.time()
+        time.sleep(settings["latency"])
+        served_start = time.time()
+        count = 0
+        scanned = 0
+        try:
+            for index in range(n_ads):
+                if count == fail_after:
+                    raise RuntimeError(
+                        "Fake schedd %s failed after %d ads of the %s query"
+                        % (self.name, count, kind)
+                    )
+                if stall_every and count and count % stall_every == 0:
+                    time.sleep(settings["stall_secs"])
+                if ads_per_sec:
+                    ahead = served_start + count / ads_per_sec - time.time()
+                    if ahead > 0.001:
+                        time.sleep(ahead)
+
+                ad = classad.ClassAd(corpus[(self.offset + index) % len(corpus)])
+                cluster = self.first_cluster + index
+                ad["ClusterId"] = cluster
+                ad["ProcId"] = 0
+                ad["GlobalJobId"] = "%s#%d.0#%d" % (self.name, cluster, ad.get("QDate", 0))
+                if since is not None and since.eval(ad) is True:
+                    break
+                scanned += 1
+                if constraint is not None and constraint.eval(ad) is not True:
+                    continue
+                if projection:
+                    ad = classad.ClassAd({key: ad.lookup(key) for key in projection if key in ad})
+                count += 1
+                yield ad
+        finally:
+            logging.warning(
+                "Fake schedd %-25s %s: served %d ads of %d scanned in %.2f s",
+                self.name,
+                kind,
+                count,
+                scanned,
+                time.time() - start,
+            )
+
+
+class Query(object):
+    """
+    Stand-in of htcondor.QueryIterator. Iterating it reads the ads as they
+    are served, nextAdsNonBlocking() returns the ones buffered by a reader
+    thread, started on its first call, so that poll() can multiplex queries.
+    """
+
+    _ready = threading.Condition()
+
+    def __init__(self, ads, tag):
+        self._ads = ads
+        self._tag = tag
+        self._buffer = collections.deque()
+        self._finished = False
+        self._error = None
+        self._thread = None
+
+    def __iter__(self):
+        return iter(self._ads)
+
+    def tag(self):
+        return self._tag
+
+    def done(self):
+        return self._finished and not self._buffer and self._error is None
+
+    def nextAdsNonBlocking(self):
+        self._start()
+        ads = []
+        while self._buffer:
+            ads.append(self._buffer.popleft())
+        if not ads and self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return ads
+
+    def _ready_to_read(self):
+        self._start()
+        return bool(self._buffer) or self._finished
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._read, daemon=True)
+            self._thread.start()
+
+    def _read(self):
+        try:
+            for ad in self._ads:
+                self._buffer.append(ad)
+                with Query._ready:
+                    Query._ready.notify_all()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._finished = True
+            with Query._ready:
+                Query._ready.notify_all()
+
+
+def poll(queries, timeout_ms=20000):
+    """
+    Stand-in of htcondor.poll: yields the queries which have ads to read,
+    until they are all done. Raises RuntimeError, like the bindings, when
+    none of them has any for timeout_ms.
+    """
+    active = list(queries)
+    while active:
+        deadline = time.time() + timeout_ms / 1000.0
+        ready = [query for query in active if query._ready_to_read()]
+        while not ready:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError("Timeout when waiting for remote host")
+            with Query._ready:
+                Query._ready.wait(min(0.05, remaining))
+            ready = [query for query in active if query._ready_to_read()]
+        for query in ready:
+            yield query
+            if query.done():
+                active.remove(query)
+
+
+def install(config_file):
+    """
+    Serve the schedd queries of htcondor_es from the fake pool of config_file.
+    The corpora are loaded here, so that the forked workers share them.
+    """
+    import htcondor_es.utils
+
+    get_pool(config_file)
+    htcondor_es.utils.get_schedd = Schedd
+    htcondor_es.utils.poll_queries = poll
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1].startswith("-"):
+        print("Usage: %s CONFIG [spider_cms.py options]" % sys.argv[0])
+        return 1
+    config_file = sys.argv[1]
+    scripts_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts")
+    sys.path.insert(0, scripts_dir)
+    try:
+        import htcondor_es
+    except ImportError:
+        sys.path.append(os.path.join(os.path.dirname(scripts_dir), "src"))
+    import spider_cms
+
+    install(config_file)
+    spider_cms.get_schedds = lambda args, collectors=None: get_schedds(args, config_file=config_file)
+    sys.argv = [os.path.join(scripts_dir, "spider_cms.py")] + sys.argv[2:]
+    spider_cms.main()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+"""
+Local stand-ins for the Elasticsearch/OpenSearch clusters and the AMQ
+broker, to measure the upload path of the spider without the real services.
+
+The HTTP endpoint accepts the calls of htcondor_es.es (index creation and
+_bulk, with or without the "/os" path prefix of the OpenSearch hosts), the
+STOMP endpoint the CONNECT/SEND/DISCONNECT frames of StompAMQ7. Both record
+requests, bytes, documents and latencies, and inject faults drawn from
+--seed and the request sequence number, so that a run can be repeated:
+whole _bulk requests rejected with 429, partial item failures, slow
+responses and dropped connections.
+
+    python tests/fakeUploadEndpoints.py --reject_rate 0.05 --item_failure_rate 0.01 \\
+        --output upload_stats.json
+
+and point the spider to them, running it with --mock_cern_domain:
+
+    etc/es_conf.json: [{"host": "localhost", "port": 9200, "username": "u",
+                        "password": "p", "use_ssl": false}]
+    CMS_HTCONDOR_BROKER=localhost (the spider always uses port 61313)
+
+The statistics are printed every --report_every seconds and on exit, and
+can be fetched (GET) or reset (POST) at http://localhost:9200/_fake/stats.
+"""
+
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import argparse
+import threading
+import socketserver
+import http.server
+from urllib.parse import urlsplit
+
+PERCENTILES = (50, 90, 99)
+
+
+class Recorder:
+    """Thread safe statistics, per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.endpoints = {}
+
+    def record(self, endpoint, n_bytes=0, n_docs=0, elapsed=0.0, outcome="ok", n_failed=0):
+        with self.lock:
+            stats = self.endpoints.setdefault(
+                endpoint,
+                {"requests": 0, "bytes": 0, "docs": 0, "failed_docs": 0, "outcomes": {}, "latencies": []},
+            )
+            stats["requests"] += 1
+            stats["bytes"] += n_bytes
+            stats["docs"] += n_docs
+            stats["failed_docs"] += n_failed
+            stats["outcomes"][outcome] = stats["outcomes"].get(outcome, 0) + 1
+            stats["latencies"].append(elapsed)
+
+    def report(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            report = {"elapsed_secs": elapsed, "endpoints": {}}
+            for endpoint, stats in sorted(self.endpoints.items()):
+                latencies = sorted(stats["latencies"])
+                summary = {key: value for key, value in stats.items() if key != "latencies"}
+                summary["mb_per_sec"] = stats["bytes"] / 1e6 / elapsed if elapsed else None
+                summary["docs_per_sec"] = stats["docs"] / elapsed if elapsed else None
+                for pct in PERCENTILES:
+                    index = min(len(latencies) - 1, int(round(pct / 100.0 * (len(latencies) - 1))))
+                    summary["p%d_ms" % pct] = latencies[index] * 1e3
+                summary["max_ms"] = latencies[-1] * 1e3
+                report["endpoints"][endpoint] = summary
+        return report
+
+
+class Faults:
+    """
+    Fault decisions, drawn from a generator seeded by --seed, the endpoint
+    and the sequence number of the request on this endpoint.
+    """
+
+    def __init__(self, seed):
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.sequence = {}
+
+    def draw(self, endpoint):
+        with self.lock:
+            number = self.sequence[endpoint] = self.sequence.get(endpoint, 0) + 1
+        return random.Random("%s-%s-%d" % (self.seed, endpoint, number))
+
+
+def es_error(error_type, reason, status):
+    return {"error": {"root_cause": [{"type": error_type, "reason": reason}], "type": error_type, "reason": reason},
+            "status": status}
+
+
+class ElasticHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeElasticsearch/7.6"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def handle_request(self, method):
+        start = time.perf_counter()
+        server = self.server
+        options = server.options
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        path = urlsplit(self.path).path.rstrip("/")
+
+        if path.endswith("/_fake/stats"):
+            if method == "POST":
+                server.recorder.reset()
+            self.send_json(200, server.recorder.report())
+            return
+
+        segments = [segment for segment in path.split("/") if segment and segment not in ("os", "es")]
+        if segments and segments[-1] == "_bulk":
+            endpoint = "bulk"
+        elif method == "PUT" and segments:
+            endpoint = "create_index"
+        else:
+            endpoint = "info"
+        rng = server.faults.draw(endpoint)
+
+        if endpoint != "info" and rng.random() < options.drop_rate:
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            server.recorder.record(endpoint, len(body), 0, time.perf_counter() - start, "dropped")
+            return
+        delay = options.latency
+        if rng.random() < options.slow_rate:
+            delay += options.slow_secs
+        time.sleep(delay)
+
+        n_docs, n_failed = 0, 0
+        if endpoint == "info":
+            outcome = "ok"
+            self.send_json(200, {"name": "fake", "cluster_name": "fake", "version": {"number": "7.6.0"},
+                                 "tagline": "You Know, for Search"})
+        elif rng.random() < options.reject_rate:
+            outcome = "rejected"
+            self.send_json(429, es_error("es_rejected_execution_exception",
+                                         "rejected execution of coordinating operation", 429))
+        elif endpoint == "create_index":
+            index = segments[-1]
+            with server.lock:
+                exists = index in server.indices
+                server.indices.add(index)
+            if exists:
+                outcome = "exists"
+                self.send_json(400, es_error("resource_already_exists_exception",
+                                             "index [%s] already exists" % index, 400))
+            else:
+                outcome = "ok"
+                self.send_json(200, {"acknowledged": True, "shards_acknowledged": True, "index": index})
+        else:
+            default_index = segments[-2] if len(segments) > 1 else None
+            items = []
+            lines = iter(body.splitlines())
+            for line in lines:
+                if not line.strip():
+                    continue
+                action = json.loads(line)
+                op, meta = next(iter(action.items()))
+                if op != "delete":
+                    next(lines, None)
+                item = {"_index": meta.get("_index", default_index), "_type": "_doc", "_id": meta.get("_id")}
+                if rng.random() < options.item_failure_rate:
+                    item["status"] = 429
+                    item["error"] = {"type": "es_rejected_execution_exception",
+                                     "reason": "rejected execution of processing of bulk item"}
+                    n_failed += 1
+                else:
+                    item.update({"_version": 1, "result": "created", "status": 201})
+                items.append({op: item})
+            n_docs = len(items)
+            outcome = "partial" if n_failed else "ok"
+            self.send_json(200, {"took": int(delay * 1000), "errors": bool(n_failed), "items": items})
+
+        server.recorder.record(endpoint, len(body), n_docs, time.perf_counter() - start, outcome, n_failed)
+
+
+class ElasticServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options, recorder, faults):
+        super().__init__(address, ElasticHandler)
+        self.options = options
+        self.recorder = recorder
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.indices = set()
+
+
+class StompHandler(socketserver.BaseRequestHandler):
+    """Minimal STOMP 1.2 broker, heart-beating disabled"""
+
+    def setup(self):
+        self.buffer = b""
+
+    def read_frame(self):
+        """Return (command, headers, body), None when the client closed the connection"""
+        while True:
+            self.buffer = self.buffer.lstrip(b"\r\n")
+            header_end = self.buffer.find(b"\n\n")
+            if header_end >= 0:
+                lines = self.buffer[:header_end].decode().split("\n")
+                headers = {}
+                for line in lines[1:]:
+                    key, _, value = line.rstrip("\r").partition(":")
+                    headers.setdefault(key, value)
+                body_start = header_end + 2
+                if "content-length" in headers:
+                    body_end = body_start + int(headers["content-length"])
+                    if len(self.buffer) > body_end:
+                        body = self.buffer[body_start:body_end]
+                        self.buffer = self.buffer[body_end + 1:]
+                        return lines[0].strip(), headers, body
+                else:
+                    body_end = self.buffer.find(b"\0", body_start)
+                    if body_end >= 0:
+                        body = self.buffer[body_start:body_end]
+                        self.buffer = self.buffer[body_end + 1:]
+                        return lines[0].strip(), headers, body
+            data = self.request.recv(65536)
+            if not data:
+                return None
+            self.buffer += data
+
+    def send_frame(self, command, headers=None, body=b""):
+        lines = [command] + ["%s:%s" % item for item in (headers or {}).items()]
+        self.request.sendall(("\n".join(lines) + "\n\n").encode() + body + b"\0")
+
+    def handle(self):
+        server = self.server
+        options = server.options
+        while True:
+            start = time.perf_counter()
+            try:
+                frame = self.read_frame()
+            except (ConnectionError, OSError):
+                return
+            if frame is None:
+                return
+            command, headers, body = frame
+
+            if command in ("CONNECT", "STOMP"):
+                rng = server.faults.draw("stomp_connect")
+                if rng.random() < options.stomp_reject_rate:
+                    self.send_frame("ERROR", {"message": "connection rejected"})
+                    server.recorder.record("stomp_connect", outcome="rejected")
+                    return
+                self.send_frame("CONNECTED", {"version": "1.2", "heart-beat": "0,0", "server": "fake"})
+                server.recorder.record("stomp_connect", elapsed=time.perf_counter() - start)
+                continue
+
+            if command == "SEND":
+                rng = server.faults.draw("stomp_send")
+                if rng.random() < options.stomp_drop_rate:
+                    self.request.shutdown(socket.SHUT_RDWR)
+                    server.recorder.record("stomp_send", len(body), 0, outcome="dropped")
+                    return
+                delay = options.stomp_latency
+                if rng.random() < options.slow_rate:
+                    delay += options.slow_secs
+                time.sleep(delay)
+                server.recorder.record("stomp_send", len(body), 1, time.perf_counter() - start)
+
+            if "receipt" in headers:
+                self.send_frame("RECEIPT", {"receipt-id": headers["receipt"]})
+            if command == "DISCONNECT":
+                return
+
+
+class StompServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, options, recorder, faults):
+        super().__init__(address, StompHandler)
+        self.options = options
+        self.recorder = recorder
+        self.faults = faults
+
+
+def print_report(report):
+    print("...%.0f s" % report["elapsed_secs"])
+    for endpoint, stats in report["endpoints"].items():
+        print(
+            "   %-14s %7d requests %9d docs (%d failed) %8.2f MB/s  p50 %7.1f ms  p99 %7.1f ms  max %7.1f ms  %s"
+            % (
+                endpoint,
+                stats["requests"],
+                stats["docs"],
+                stats["failed_docs"],
+                stats["mb_per_sec"] or 0,
+                stats["p50_ms"],
+                stats["p99_ms"],
+                stats["max_ms"],
+                ", ".join("%s: %d" % item for item in sorted(stats["outcomes"].items())),
+            )
+        )
+    sys.stdout.flush()
+
+
+def main(args):
+    recorder = Recorder()
+    faults = Faults(args.seed)
+    servers = [
+        ElasticServer((args.host, args.es_port), args, recorder, faults),
+        StompServer((args.host, args.stomp_port), args, recorder, faults),
+    ]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("...listening on %s, ES port %d, STOMP port %d" % (args.host, args.es_port, args.stomp_port))
+    sys.stdout.flush()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    try:
+        while not stop.wait(args.report_every or None):
+            print_report(recorder.report())
+    except KeyboardInterrupt:
+        pass
+
+    for server in servers:
+        server.shutdown()
+    report = recorder.report()
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=4, sort_keys=True)
+        print("   ...statistics written to %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1", type=str, dest="host",
+                        help="Address to listen on [default: %(default)s]")
+    parser.add_argument("--es_port", default=9200, type=int, dest="es_port",
+                        help="Port of the Elasticsearch/OpenSearch endpoint [default: %(default)d]")
+    parser.add_argument("--stomp_port", default=61313, type=int, dest="stomp_port",
+                        help="Port of the STOMP endpoint [default: %(default)d]")
+    parser.add_argument("--latency", default=0.0, type=float, dest="latency",
+                        help="Seconds added to every HTTP response [default: %(default).1f]")
+    parser.add_argument("--reject_rate", default=0.0, type=float, dest="reject_rate",
+                        help="Fraction of _bulk and index creation requests rejected with 429 "
+                             "[default: %(default).2f]")
+    parser.add_argument("--item_failure_rate", default=0.0, type=float, dest="item_failure_rate",
+                        help="Fraction of the _bulk items failing with 429 [default: %(default).2f]")
+    parser.add_argument("--slow_rate", default=0.0, type=float, dest="slow_rate",
+                        help="Fraction of requests and STOMP messages delayed by --slow_secs "
+                             "[default: %(default).2f]")
+    parser.add_argument("--slow_secs", default=5.0, type=float, dest="slow_secs",
+                        help="Delay of the slow responses [default: %(default).1f]")
+    parser.add_argument("--drop_rate", default=0.0, type=float, dest="drop_rate",
+                        help="Fraction of HTTP requests whose connection is dropped without a response "
+                             "[default: %(default).2f]")
+    parser.add_argument("--stomp_latency", default=0.0, type=float, dest="stomp_latency",
+                        help="Seconds spent reading every STOMP message [default: %(default).1f]")
+    parser.add_argument("--stomp_reject_rate", default=0.0, type=float, dest="stomp_reject_rate",
+                        help="Fraction of STOMP connections refused with an ERROR frame [default: %(default).2f]")
+    parser.add_argument("--stomp_drop_rate", default=0.0, type=float, dest="stomp_drop_rate",
+                        help="Fraction of STOMP messages on which the connection is dropped [default: %(default).4f]")
+    parser.add_argument("--seed", default=0, type=int, dest="seed",
+                        help="Seed of the fault injection [default: %(default)d]")
+    parser.add_argument("--report_every", default=0, type=float, dest="report_every",
+                        help="Print the statistics every N seconds [default: only on exit]")
+    parser.add_argument("--output", default=None, type=str, dest="output",
+                        help="Write the statistics to this json file on exit")
+
+    args = parser.parse_args()
+    sys.exit(main(args))
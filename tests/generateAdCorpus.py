@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic corpus of CMS job ClassAds, for running the benchmarks
+and load tests offline at production scale.
+
+The ads are streamed to disk in the old ClassAd format (the one of
+condor_history -l), gzip compressed if the file name ends with .gz, and can
+be read back with classad.parseAds(fd, classad.Parser.Old).
+benchmarkConversion.py reads such files directly.
+
+The generated ads mimic the ones of the CMS pools: the analysis/production
+mix, CRAB or WMAgent attributes grouped in tasks shared by many jobs, the
+MATCH_EXP_JOB_* glidein attributes of the jobs that were matched, the
+ChirpCMSSW* step counters and IO site attributes, the compressed
+Chirp_WMCore_*_Exception_Message payloads of failed production jobs and the
+status distribution of the history (or of the queues, with --mode queue).
+The rest of each ad is filled with attributes of the string_vals, int_vals,
+date_vals and bool_vals vocabulary of the converter, plus some of the
+attributes it ignores, to get ads of a realistic size.
+
+    python tests/generateAdCorpus.py ads.gz --n_ads 10000000
+"""
+
+import os
+import sys
+import gzip
+import time
+import zlib
+import base64
+import random
+import argparse
+
+try:
+    import htcondor_es
+except ImportError:
+    if os.path.exists("src/htcondor_es/__init__.py") and "src" not in sys.path:
+        sys.path.append("src")
+
+from htcondor_es.convert_to_json import (
+    bool_vals,
+    date_vals,
+    ignore,
+    int_vals,
+    string_vals,
+)
+
+# Status mix of the ads returned by schedd.history and schedd.xquery
+STATUS_MIX = {
+    "history": {4: 0.86, 3: 0.14},
+    "queue": {1: 0.42, 2: 0.52, 5: 0.05, 7: 0.01},
+}
+
+SITES = [
+    "T1_DE_KIT", "T1_ES_PIC", "T1_FR_CCIN2P3", "T1_IT_CNAF", "T1_RU_JINR",
+    "T1_UK_RAL", "T1_US_FNAL", "T2_BE_IIHE", "T2_BR_SPRACE", "T2_CH_CERN",
+    "T2_CH_CSCS", "T2_DE_DESY", "T2_DE_RWTH", "T2_EE_Estonia", "T2_ES_CIEMAT",
+    "T2_FR_GRIF", "T2_IT_Bari", "T2_IT_Legnaro", "T2_IT_Pisa", "T2_UK_London_IC",
+    "T2_US_Caltech", "T2_US_Florida", "T2_US_MIT", "T2_US_Nebraska", "T2_US_Purdue",
+    "T2_US_UCSD", "T2_US_Wisconsin", "T3_US_NERSC", "T3_US_OSG", "T1_US_FNAL_Disk",
+]
+USERS = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi", "ivan", "judy"]
+PRIMARY_DATASETS = ["JetMET", "Muon", "EGamma", "ZeroBias", "TTToSemiLeptonic_TuneCP5_13TeV-powheg-pythia8",
+                    "DYJetsToLL_M-50_TuneCP5_13TeV-amcatnloFXFX-pythia8", "WJetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8"]
+DATA_TIERS = ["AOD", "MINIAOD", "NANOAOD", "AODSIM", "MINIAODSIM", "GEN-SIM", "RAW"]
+CAMPAIGNS = [
+    ("HIG", "RunIISummer20UL18wmLHEGEN"), ("SMP", "RunIISummer20UL17MiniAODv2"),
+    ("TOP", "Run3Summer22EEGS"), ("EXO", "Run3Summer23DRPremix"),
+    ("BPH", "Phase2Fall22DRMiniAOD"), ("TSG", "SnowmassWinter21wmLHEGEN"),
+    ("PPD", "RunIISpring16DR80"), ("B2G", "RunIIFall17NanoAODv7"),
+]
+PRODUCTION_TASKS = [
+    "{prep}_0", "{prep}_1", "StepOneProc", "{prep}_0MergeRAWSIMoutput",
+    "{prep}_0CleanupUnmergedRAWSIMoutput", "LogCollectForMerge", "MonteCarloFromGEN",
+]
+CMSSW_VERSIONS = ["CMSSW_10_6_30", "CMSSW_12_4_14", "CMSSW_13_0_17", "CMSSW_13_3_1", "CMSSW_14_0_7"]
+CPU_MODELS = ["AMD EPYC 7763 64-Core Processor", "Intel(R) Xeon(R) Gold 6326 CPU @ 2.90GHz",
+              "Intel(R) Xeon(R) CPU E5-2650 v4 @ 2.20GHz", "AMD EPYC 9654 96-Core Processor"]
+EXIT_CODES = [0] * 90 + [1, 8001, 8020, 8021, 8028, 50660, 50664, 60307, 60311, 84]
+EXCEPTION_MESSAGES = [
+    "An exception of category 'FileOpenError' occurred while\n   [0] Constructing the EventProcessor\n"
+    "   [1] Constructing input source of type PoolSource\n   [2] Calling RootFileSequenceBase::initTheFile()\n"
+    "Exception Message:\nFailed to open the file 'root://cms-xrd-global.cern.ch//store/mc/{campaign}/file.root'",
+    "An exception of category 'ProductNotFound' occurred while\n   [0] Processing Event run: 1 lumi: {lumi}\n"
+    "Exception Message:\nPrincipal::getByToken: Found zero products matching all criteria",
+    "An exception of category 'StdException' occurred while\n   [0] Processing global begin Run\n"
+    "Exception Message:\nA std::exception was thrown.\nstd::bad_alloc",
+]
+
+# Fields of the documents, computed by the converter, that never come from the schedds
+_DERIVED = {
+    "AffiliationCountry", "AffiliationInstitute", "Campaign", "CMSPrimaryDataTier",
+    "CMSPrimaryPrimaryDataset", "CMSPrimaryProcessedDataset", "CMSSWMajorVersion",
+    "CMSSWReleaseSeries", "CMSSWVersion", "Country", "CPUModel", "CPUModelName",
+    "DataCollectionDate", "DataLocations", "DataLocationsCount", "DesiredSiteCount",
+    "FormattedCrabId", "InputData", "Original_DESIRED_Sites", "OverflowType", "Processor",
+    "RecordTime", "ScheddName", "Site", "Status", "TaskType", "Tier", "Universe",
+    "WMAgent_TaskType", "Workflow", "CMSSWDone",
+}
+# Attributes set by the generator itself, or only meaningful in some ads
+_GENERATED_PREFIXES = ("MATCH_EXP_JOB_", "CRAB_", "WMAgent_", "Chirp", "DESIRED_", "MachineAttr", "x509")
+_NOT_FILLED = {"ExitReason", "GlobusRSL", "LastHoldReason", "NordugridRSL", "RemoveReason"}
+# Number of pre-formatted values of each filler attribute
+_FILLER_VARIANTS = 64
+
+
+class Expr(str):
+    """A ClassAd expression, written as it is"""
+
+
+def quote(value):
+    if "\\" in value or '"' in value or "\n" in value:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return '"%s"' % value
+
+
+def format_value(value):
+    value_type = type(value)
+    if value_type is int or value_type is float:
+        return repr(value)
+    if value_type is str:
+        return quote(value)
+    if value_type is Expr:
+        return value
+    if value_type is bool:
+        return "true" if value else "false"
+    if value_type is list or value_type is tuple:
+        return "{ %s }" % ",".join(format_value(item) for item in value)
+    raise TypeError("Cannot write %r in a ClassAd" % (value,))
+
+
+def format_attributes(ad):
+    return "".join(["%s = %s\n" % (key, format_value(value)) for key, value in ad.items()])
+
+
+def compress(message):
+    return base64.b64encode(zlib.compress(message.encode("utf-8"))).decode("ascii")
+
+
+class AdGenerator:
+    """
+    Generates the job ads of --n_tasks tasks (CRAB tasks or WMAgent
+    requests), the jobs of a task sharing its task level attributes.
+    """
+
+    def __init__(self, args):
+        self.rnd = random.Random(args.seed)
+        self.end_time = args.end_time or int(time.time())
+        self.window = args.window_hours * 3600
+        self.mode = args.mode
+        self.statuses, self.status_weights = zip(*sorted(STATUS_MIX[args.mode].items()))
+        self.analysis_fraction = args.analysis_fraction
+        self.schedds = ["vocms%04d.cern.ch" % (100 + i) for i in range(args.n_schedds)]
+        self.tasks = [self.make_task(i) for i in range(args.n_tasks)]
+        # Few tasks have most of the jobs
+        self.task_weights = [1.0 / (i + 1) for i in range(args.n_tasks)]
+        self.filler = self.make_filler()
+        self.n_filled = int(round(len(self.filler) * args.fill_fraction))
+        self.next_cluster = {schedd: 1000000 for schedd in self.schedds}
+
+    def make_filler(self):
+        """
+        The other attributes of the vocabulary, as (name, formatted lines) with
+        a few pre-formatted values each, or (name, None) for the dates which
+        are set relative to the QDate of the job.
+        """
+        task_attributes = set()
+        for task in self.tasks:
+            task_attributes.update(task)
+        filler = []
+        for names, kind in (
+            (string_vals, "string"),
+            (int_vals, "int"),
+            (date_vals, "date"),
+            (bool_vals, "bool"),
+            ({name for name in ignore if not name.startswith("MATCH_")}, "string"),
+        ):
+            for name in sorted(names):
+                if (
+                    name in _DERIVED
+                    or name in _NOT_FILLED
+                    or name in task_attributes
+                    or name.startswith(_GENERATED_PREFIXES)
+                ):
+                    continue
+                if kind == "date":
+                    filler.append((name, None))
+                    continue
+                lines = [
+                    "%s = %s\n" % (name, format_value(self.filler_value(name, kind)))
+                    for _ in range(_FILLER_VARIANTS)
+                ]
+                filler.append((name, lines))
+        return filler
+
+    def make_task(self, index):
+        rnd = self.rnd
+        created = self.end_time - rnd.randint(self.window, self.window + 7 * 86400)
+        created_str = time.strftime("%y%m%d_%H%M%S", time.gmtime(created))
+        dataset = "/%s/%s/%s" % (
+            rnd.choice(PRIMARY_DATASETS),
+            "Run2022%s-PromptReco-v%d" % (rnd.choice("CDEFG"), rnd.randint(1, 3)),
+            rnd.choice(DATA_TIERS),
+        )
+        sites = rnd.sample(SITES, rnd.randint(1, 12))
+        task = {
+            "schedd": rnd.choice(self.schedds),
+            "DESIRED_Sites": ",".join(sites),
+            "DESIRED_CMSDataLocations": ",".join(rnd.sample(sites, min(len(sites), 3))),
+            "RequestMemory_base": rnd.choice([2000, 2500, 4000, 8000, 15900]),
+            "RequestCpus": rnd.choice([1, 1, 1, 4, 8]),
+            "MaxWallTimeMins_RAW": rnd.choice([1250, 2750, 1440, 2880]),
+        }
+        if rnd.random() < self.analysis_fraction:
+            user = rnd.choice(USERS)
+            task.update({
+                "analysis": True,
+                "CMS_Type": "analysis",
+                "CMS_JobType": "Analysis",
+                "CMS_WMTool": "CRAB",
+                "CMS_SubmissionTool": "CRAB",
+                "CRAB_UserHN": user,
+                "CRAB_Workflow": "%s:%s_crab_task%05d" % (created_str, user, index),
+                "CRAB_ReqName": "%s:%s_crab_task%05d" % (created_str, user, index),
+                "CRAB_JobSW": rnd.choice(CMSSW_VERSIONS),
+                "CRAB_JobArch": "el8_amd64_gcc11",
+                "CRAB_JobType": "analysis",
+                "CRAB_SplitAlgo": rnd.choice(["Automatic", "FileBased", "LumiBased", "EventAwareLumiBased"]),
+                "CRAB_AsyncDest": rnd.choice(SITES),
+                "CRAB_UserGroup": "undefined",
+                "CRAB_UserRole": "undefined",
+                "CRAB_TaskWorker": "crab-prod-tw01",
+                "CRAB_DBSURL": "https://cmsweb.cern.ch/dbs/prod/global/DBSReader",
+                "CRAB_TaskCreationDate": created,
+                "CRAB_JobCount": rnd.randint(1, 5000),
+                "CRAB_SaveLogsFlag": rnd.random() < 0.3,
+                "CRAB_TransferOutputs": True,
+                "CRAB_Publish": rnd.random() < 0.2,
+                "CRAB_EDMOutputFiles": ["output.root"] if rnd.random() < 0.5 else [],
+                "CRAB_TFileOutputFiles": ["histos.root"] if rnd.random() < 0.5 else [],
+                "DESIRED_CMSDataset": dataset,
+                "CMSGroups": "/cms,/cms/%s" % rnd.choice(["escms", "dcms", "uscms", "itcms"]),
+                "x509UserProxyVOName": "cms",
+                "x509UserProxyFirstFQAN": "/cms/Role=NULL/Capability=NULL",
+                "x509UserProxyFQAN": "/DC=ch/DC=cern/OU=Users/CN=%s,/cms/Role=NULL/Capability=NULL" % user,
+                "x509userproxysubject": "/DC=ch/DC=cern/OU=Users/CN=%s" % user,
+                "AccountingGroup": "analysis.%s" % user,
+            })
+        else:
+            group, campaign = rnd.choice(CAMPAIGNS)
+            prep = "%s-%s-%05d" % (group, campaign, rnd.randint(1, 9999))
+            request = "pdmvserv_task_%s__v1_T_%s_%04d" % (prep, created_str, index % 10000)
+            subtask = rnd.choice(PRODUCTION_TASKS).format(prep=prep)
+            job_type = "Production"
+            if "Merge" in subtask:
+                job_type = "Merge"
+            elif "Cleanup" in subtask:
+                job_type = "Cleanup"
+            elif "LogCollect" in subtask:
+                job_type = "LogCollect"
+            elif rnd.random() < 0.2:
+                job_type = "Processing"
+            task.update({
+                "analysis": False,
+                "CMS_Type": "production",
+                "CMS_JobType": job_type,
+                "CMS_WMTool": "WMAgent",
+                "CMS_SubmissionTool": "WMAgent",
+                "WMAgent_AgentName": "vocms%04d.cern.ch" % rnd.randint(200, 300),
+                "WMAgent_RequestName": request,
+                "WMAgent_SubTaskName": "/%s/%s" % (request, subtask),
+                "CMS_CampaignName": campaign if rnd.random() < 0.5 else "",
+                "CMSPrimaryPrimaryDataset": dataset.split("/")[1],
+                "CMS_extendedJobType": "UNKNOWN",
+                "DESIRED_CMSDataset": dataset,
+                "CMSGroups": "/cms",
+                "x509UserProxyVOName": "cms",
+                "x509UserProxyFirstFQAN": "/cms/Role=production/Capability=NULL",
+                "AccountingGroup": "production.cmsdataops",
+            })
+        # The task level attributes are the same in all the ads of the task
+        task["text"] = format_attributes({
+            key: value
+            for key, value in task.items()
+            if key[0].isupper() and key not in ("RequestCpus", "RequestMemory_base", "MaxWallTimeMins_RAW")
+        })
+        return task
+
+    def ads(self, n_ads, chunk_size=10000):
+        """Yields the job ads in the old ClassAd format"""
+        rnd = self.rnd
+        for start in range(0, n_ads, chunk_size):
+            count = min(chunk_size, n_ads - start)
+            tasks = rnd.choices(self.tasks, weights=self.task_weights, k=count)
+            statuses = rnd.choices(self.statuses, weights=self.status_weights, k=count)
+            for task, job_status in zip(tasks, statuses):
+                ad = self.make_ad(task, job_status)
+                yield task["text"] + format_attributes(ad) + self.filler_text(ad) + "\n"
+
+    def filler_text(self, ad):
+        rnd = self.rnd
+        qdate = ad["QDate"]
+        chunks = []
+        for name, lines in rnd.sample(self.filler, self.n_filled):
+            if name in ad:
+                continue
+            if lines is None:
+                chunks.append("%s = %d\n" % (name, qdate + rnd.randint(0, 86400)))
+            else:
+                chunks.append(lines[rnd.getrandbits(6)])
+        return "".join(chunks)
+
+    def make_ad(self, task, job_status):
+        rnd = self.rnd
+        analysis = task["analysis"]
+        schedd = task["schedd"]
+        cluster = self.next_cluster[schedd]
+        self.next_cluster[schedd] += 1
+        qdate = self.end_time - rnd.randint(0, self.window + 86400)
+        ad = {}
+        ad["MyType"] = "Job"
+        ad["ClusterId"] = cluster
+        ad["ProcId"] = 0
+        ad["GlobalJobId"] = "%s#%d.0#%d" % (schedd, cluster, qdate)
+        ad["QDate"] = qdate
+        ad["JobStatus"] = job_status
+        ad["LastJobStatus"] = 2 if job_status in (3, 4) else 1
+        ad["JobUniverse"] = 5
+        ad["JobPrio"] = rnd.randint(0, 100000)
+        ad["Owner"] = task.get("CRAB_UserHN", "cmsdataops")
+        ad["User"] = "%s@cms" % ad["Owner"]
+        ad["RequestCpus"] = task["RequestCpus"]
+        ad["RequestMemory"] = Expr(
+            "ifthenelse(MemoryUsage =!= undefined,MAX({ %d,MemoryUsage }),%d)"
+            % (task["RequestMemory_base"], task["RequestMemory_base"])
+        )
+        ad["RequestDisk_RAW"] = rnd.randint(10 ** 6, 2 * 10 ** 7)
+        ad["MaxWallTimeMins_RAW"] = task["MaxWallTimeMins_RAW"]
+        ad["ExtDESIRED_Sites"] = task["DESIRED_Sites"]
+
+        matched = job_status != 1 or rnd.random() < 0.1
+        started = qdate + rnd.randint(60, 6 * 3600)
+        if matched:
+            wall_time = rnd.randint(60, 48 * 3600)
+            finished = min(started + wall_time, self.end_time)
+            if job_status == 2:
+                finished = self.end_time - rnd.randint(0, 3600)
+                wall_time = max(finished - started, 0)
+            ad["JobStartDate"] = started
+            ad["JobCurrentStartDate"] = started
+            ad["JobLastStartDate"] = started
+            ad["JobCurrentStartExecutingDate"] = started + rnd.randint(1, 300)
+            ad["LastMatchTime"] = started - rnd.randint(1, 30)
+            ad["NumJobStarts"] = rnd.choice([1, 1, 1, 2, 3])
+            ad["JobRunCount"] = ad["NumJobStarts"]
+            ad["RemoteWallClockTime"] = float(wall_time)
+            ad["CumulativeSlotTime"] = float(wall_time * ad["RequestCpus"])
+            ad["CommittedTime"] = wall_time if job_status != 3 else 0
+            ad["CommittedSlotTime"] = ad["CommittedTime"] * ad["RequestCpus"]
+            cpu = wall_time * ad["RequestCpus"] * rnd.uniform(0.05, 1.0)
+            ad["RemoteUserCpu"] = float(int(cpu * 0.95))
+            ad["RemoteSysCpu"] = float(int(cpu * 0.05))
+            ad["MemoryUsage"] = Expr("( ( ResidentSetSize + 1023 ) / 1024 )")
+            ad["ResidentSetSize_RAW"] = rnd.randint(10 ** 5, task["RequestMemory_base"] * 1100)
+            ad["ResidentSetSize"] = ad["ResidentSetSize_RAW"]
+            ad["DiskUsage_RAW"] = rnd.randint(10 ** 4, 10 ** 7)
+            ad["DiskUsage"] = ad["DiskUsage_RAW"]
+            ad["BytesRecvd"] = float(rnd.randint(10 ** 4, 10 ** 8))
+            ad["BytesSent"] = float(rnd.randint(10 ** 3, 10 ** 8))
+            ad["EnteredCurrentStatus"] = finished
+            self.add_glidein(ad, task)
+            self.add_chirp(ad, task, job_status, started, finished)
+        else:
+            ad["EnteredCurrentStatus"] = qdate
+            ad["RemoteWallClockTime"] = 0.0
+            ad["CommittedTime"] = 0
+        if job_status == 4:
+            ad["CompletionDate"] = ad["EnteredCurrentStatus"]
+            ad["JobFinishedHookDone"] = ad["EnteredCurrentStatus"] + rnd.randint(1, 60)
+            exit_code = rnd.choice(EXIT_CODES)
+            ad["ExitCode"] = exit_code if exit_code < 256 else 1
+            ad["ExitBySignal"] = False
+            if analysis:
+                ad["Chirp_CRAB3_Job_ExitCode"] = exit_code
+                ad["CRAB_PostJobStatus"] = "FINISHED" if exit_code == 0 else "FAILED"
+            else:
+                ad["Chirp_WMCore_cmsRun_ExitCode"] = exit_code
+                if exit_code:
+                    ad["Chirp_WMCore_cmsRun1_Exception_Message"] = compress(
+                        rnd.choice(EXCEPTION_MESSAGES).format(
+                            campaign=task.get("CMS_CampaignName") or "RunIII", lumi=rnd.randint(1, 5000)
+                        )
+                    )
+        elif job_status == 3:
+            ad["JobFinishedHookDone"] = ad["EnteredCurrentStatus"] + rnd.randint(1, 60)
+            ad["RemoveReason"] = "via condor_rm (by user %s)" % ad["Owner"]
+            if analysis:
+                ad["CRAB_PostJobStatus"] = rnd.choice(["NOT RUN", "FAILED"])
+        elif job_status == 5:
+            ad["LastHoldReason"] = "Error from slot1@glidein: Job has gone over memory limit"
+            ad["HoldReasonCode"] = 34
+        elif analysis:
+            ad["CRAB_PostJobStatus"] = "NOT RUN"
+        if analysis:
+            ad["CRAB_Id"] = str(rnd.randint(1, task["CRAB_JobCount"]))
+            ad["CRAB_Retry"] = rnd.choice([0, 0, 0, 1, 2])
+        else:
+            ad["WMAgent_JobID"] = rnd.randint(1, 10 ** 7)
+        return ad
+
+    def add_glidein(self, ad, task):
+        rnd = self.rnd
+        site = rnd.choice(task["DESIRED_Sites"].split(",") if rnd.random() < 0.9 else SITES)
+        entry = "CMSHTPC_%s_ce%02d" % (site, rnd.randint(1, 9))
+        to_die = ad["JobCurrentStartDate"] + rnd.randint(3600, 48 * 3600)
+        ad["MATCH_EXP_JOB_GLIDEIN_CMSSite"] = site
+        ad["MATCH_EXP_JOB_GLIDEIN_Site"] = site.split("_", 2)[-1]
+        ad["MATCH_EXP_JOB_GLIDEIN_Entry_Name"] = entry
+        ad["MATCH_EXP_JOB_GLIDEIN_Factory"] = rnd.choice(["OSG", "CERN", "UCSD", "FNAL"])
+        ad["MATCH_EXP_JOB_GLIDEIN_Name"] = "gfactory_instance"
+        ad["MATCH_EXP_JOB_GLIDECLIENT_Name"] = "CMSG-ITB_gWMSFrontend-v1_0.main"
+        ad["MATCH_EXP_JOB_GLIDEIN_ClusterId"] = str(rnd.randint(10 ** 5, 10 ** 7))
+        ad["MATCH_EXP_JOB_GLIDEIN_ProcId"] = str(rnd.randint(0, 20))
+        ad["MATCH_EXP_JOB_GLIDEIN_Schedd"] = "schedd_glideins%d@gfactory-2.opensciencegrid.org" % rnd.randint(1, 9)
+        ad["MATCH_EXP_JOB_GLIDEIN_SiteWMS"] = rnd.choice(["HTCondor", "SLURM", "LSF", "PBS"])
+        ad["MATCH_EXP_JOB_GLIDEIN_SiteWMS_JobId"] = "%d.0" % rnd.randint(10 ** 5, 10 ** 8)
+        ad["MATCH_EXP_JOB_GLIDEIN_SiteWMS_Queue"] = "%s.cern.ch" % entry.lower()
+        ad["MATCH_EXP_JOB_GLIDEIN_SiteWMS_Slot"] = "slot1_%d@wn%04d" % (rnd.randint(1, 64), rnd.randint(1, 9999))
+        ad["MATCH_EXP_JOB_GLIDEIN_SEs"] = "srm.%s.example" % site.lower()
+        ad["MATCH_EXP_JOB_GLIDEIN_MaxMemMBs"] = str(rnd.choice([2500, 10000, 20000]))
+        ad["MATCH_EXP_JOB_GLIDEIN_Memory"] = str(rnd.choice([2500, 10000, 20000]))
+        ad["MATCH_EXP_JOB_GLIDEIN_Max_Walltime"] = str(rnd.choice([172800, 259200]))
+        ad["MATCH_EXP_JOB_GLIDEIN_Job_Max_Time"] = str(rnd.choice([34800, 122400]))
+        ad["MATCH_EXP_JOB_GLIDEIN_ToDie"] = str(to_die)
+        ad["MATCH_EXP_JOB_GLIDEIN_ToRetire"] = str(to_die - 3600)
+        ad["MATCH_GLIDEIN_ToDie"] = to_die
+        ad["MATCH_GLIDEIN_ToRetire"] = to_die - 3600
+        ad["MachineAttrGLIDEIN_CMSSite0"] = site
+        ad["MachineAttrCMSSubSiteName0"] = site
+        ad["MachineAttrCpus0"] = rnd.choice([1, 4, 8, 16])
+        ad["MachineAttrSlotWeight0"] = ad["MachineAttrCpus0"]
+        ad["MachineAttrCPUModel0"] = rnd.choice(CPU_MODELS)
+        ad["MachineAttrHAS_SINGULARITY0"] = rnd.random() < 0.95
+        if rnd.random() < 0.6:
+            ad["MachineAttrMJF_JOB_HS06_JOB0"] = round(rnd.uniform(8.0, 20.0), 2)
+        if rnd.random() < 0.6:
+            ad["MachineAttrDIRACBenchmark0"] = round(rnd.uniform(8.0, 30.0), 3)
+        ad["RemoteHost"] = "glidein_%d_%d@wn%04d.%s.example" % (
+            rnd.randint(1, 10 ** 5), rnd.randint(1, 10 ** 6), rnd.randint(1, 9999), site.lower())
+        ad["LastRemoteHost"] = ad["RemoteHost"]
+        ad["StartdPrincipal"] = "execute-side@matchsession/192.168.%d.%d" % (rnd.randint(0, 255), rnd.randint(0, 255))
+
+    def add_chirp(self, ad, task, job_status, started, finished):
+        rnd = self.rnd
+        if rnd.random() < 0.1:
+            return
+        steps = ["cmsRun1"] if task["analysis"] else ["cmsRun%d" % i for i in range(1, rnd.randint(1, 3) + 1)]
+        for step in steps:
+            events = rnd.randint(0, 100000)
+            prefix = "ChirpCMSSW_%s_" % step
+            ad[prefix + "Events"] = events
+            ad[prefix + "Files"] = rnd.randint(0, 20)
+            ad[prefix + "Lumis"] = rnd.randint(0, 2000)
+            ad[prefix + "ReadBytes"] = rnd.randint(0, 10 ** 10)
+            ad[prefix + "ReadTimeMsecs"] = rnd.randint(0, 10 ** 7)
+            ad[prefix + "WriteBytes"] = rnd.randint(0, 10 ** 9)
+            ad[prefix + "Elapsed"] = max(finished - started, 0)
+            ad[prefix + "LastUpdate"] = finished - rnd.randint(0, 600)
+            ad[prefix + "MaxEvents"] = -1 if rnd.random() < 0.5 else events
+            ad[prefix + "MaxFiles"] = -1
+            ad[prefix + "MaxLumis"] = -1
+            ad[prefix + "Done"] = int(job_status == 4)
+            for site in rnd.sample(SITES, rnd.randint(0, 3)):
+                keybase = "ChirpCMSSW%sIOSite_%s_%s" % (
+                    step, site, rnd.choice(["cms-xrd-global.cern.ch", "xrootd-local.example", "eoscms.cern.ch"]))
+                ad[keybase + "_ReadBytes"] = rnd.randint(0, 10 ** 10)
+                ad[keybase + "_ReadTimeMS"] = rnd.randint(0, 10 ** 7)
+        ad["ChirpCMSSWCPUModels"] = rnd.choice(CPU_MODELS)
+
+    def filler_value(self, name, kind):
+        rnd = self.rnd
+        if kind == "int":
+            return rnd.randint(0, 10 ** 6)
+        if kind == "bool":
+            return rnd.random() < 0.5
+        return "%s_%d" % (name.lower(), rnd.randint(0, 1000))
+
+
+def open_output(filename, compresslevel):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wt", compresslevel=compresslevel)
+    return open(filename, "w")
+
+
+def main(args):
+    generator = AdGenerator(args)
+    print(
+        "...writing %d %s job ads of %d tasks to %s"
+        % (args.n_ads, args.mode, args.n_tasks, args.filename)
+    )
+    start = time.time()
+    with open_output(args.filename, args.compresslevel) as fd:
+        for count, ad in enumerate(generator.ads(args.n_ads), 1):
+            fd.write(ad)
+            if count % args.progress == 0:
+                print("   %d ads, %.0f ads/sec" % (count, count / (time.time() - start)))
+    print("   ...done in %.1f s, %.1f MB" % (time.time() - start, os.path.getsize(args.filename) / 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "filename",
+        type=str,
+        help="Write the ads to this file, gzip compressed if it ends with .gz",
+    )
+    parser.add_argument(
+        "--n_ads",
+        default=100000,
+        type=int,
+        dest="n_ads",
+        help="Number of job ads to generate [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--n_tasks",
+        default=5000,
+        type=int,
+        dest="n_tasks",
+        help="Number of CRAB tasks and WMAgent requests the jobs belong to [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--n_schedds",
+        default=50,
+        type=int,
+        dest="n_schedds",
+        help="Number of schedds the jobs are spread over [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--mode",
+        default="history",
+        choices=sorted(STATUS_MIX),
+        dest="mode",
+        help="Status distribution of the history or of the queues [default: %(default)s]",
+    )
+    parser.add_argument(
+        "--analysis_fraction",
+        default=0.5,
+        type=float,
+        dest="analysis_fraction",
+        help="Fraction of the tasks that are CRAB tasks [default: %(default).2f]",
+    )
+    parser.add_argument(
+        "--fill_fraction",
+        default=0.3,
+        type=float,
+        dest="fill_fraction",
+        help="Fraction of the remaining converter vocabulary set in each ad [default: %(default).2f]",
+    )
+    parser.add_argument(
+        "--window_hours",
+        default=12,
+        type=int,
+        dest="window_hours",
+        help="The jobs end during the last N hours [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--end_time",
+        default=0,
+        type=int,
+        dest="end_time",
+        help="Epoch of the end of the time window [default: now]",
+    )
+    parser.add_argument(
+        "--seed",
+        default=42,
+        type=int,
+        dest="seed",
+        help="Random seed, the same seed, --end_time and options give the same corpus "
+             "[default: %(default)d]",
+    )
+    parser.add_argument(
+        "--compresslevel",
+        default=6,
+        type=int,
+        dest="compresslevel",
+        help="gzip compression level [default: %(default)d]",
+    )
+    parser.add_argument(
+        "--progress",
+        default=100000,
+        type=int,
+        dest="progress",
+        help="Print the progress every N ads [default: %(default)d]",
+    )
+
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,78 @@
+"""
+Checkpoint database: the round trips of the checkpoint, of the shipped
+job keys and of the since bounds, and the import of checkpoint.json.
+"""
+
+import json
+import os
+
+import pytest
+
+from htcondor_es import checkpoint
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint, "_CHECKPOINT_DB", str(tmp_path / "checkpoint.db"))
+    monkeypatch.setattr(checkpoint, "_CHECKPOINT_JSON", str(tmp_path / "checkpoint.json"))
+    return tmp_path
+
+
+def test_upsert():
+    assert checkpoint.load() == {}
+    checkpoint.update("schedd1", 1000)
+    checkpoint.update("schedd2", 2000.5)
+    checkpoint.update("schedd1", 1500)
+    assert checkpoint.load() == {"schedd1": 1500, "schedd2": 2000.5}
+
+
+def test_since():
+    checkpoint.update("schedd1", 1000)
+    assert checkpoint.load_since() == {}
+    checkpoint.update("schedd1", 1100, since="12.0")
+    checkpoint.update("schedd2", 1100, since="7.3")
+    checkpoint.update("schedd1", 1200, since="15.1")
+    # Kept when not given
+    checkpoint.update("schedd2", 1300)
+    assert checkpoint.load_since() == {"schedd1": "15.1", "schedd2": "7.3"}
+
+
+def test_shipped():
+    checkpoint.update("schedd1", 1000, [(1, 900), (2, 990), (-3, 1000)], expire_before=950)
+    checkpoint.update("schedd2", 1000, [(4, 990)], expire_before=950)
+    assert checkpoint.load_shipped("schedd1") == {2, -3}
+    # Without expire_before the records are left as they are
+    checkpoint.update("schedd1", 1100, [(5, 1090)])
+    assert checkpoint.load_shipped("schedd1") == {2, -3}
+    # The records older than expire_before are dropped
+    checkpoint.update("schedd1", 1100, [(5, 1090)], expire_before=995)
+    assert checkpoint.load_shipped("schedd1") == {-3, 5}
+    assert checkpoint.load_shipped("schedd2") == {4}
+    assert checkpoint.load_shipped("schedd3") == set()
+
+
+def test_json_import_and_export(workdir):
+    with open(str(workdir / "checkpoint.json"), "w") as fd:
+        json.dump({"schedd1": 1000, "schedd2": 2000}, fd)
+    assert checkpoint.load() == {"schedd1": 1000, "schedd2": 2000}
+    checkpoint.update("schedd1", 3000)
+    checkpoint.export_json()
+    with open(str(workdir / "checkpoint.json")) as fd:
+        assert json.load(fd) == {"schedd1": 3000, "schedd2": 2000}
+    assert not os.path.exists(str(workdir / "checkpoint.json.tmp"))
+
+
+def test_corrupt_database(workdir):
+    checkpoint.update("schedd1", 1000)
+    checkpoint.update("schedd2", 2000)
+    checkpoint.export_json()
+    checkpoint.update("schedd1", 3000)
+    with open(str(workdir / "checkpoint.db"), "wb") as fd:
+        fd.write(b"not a database" * 1024)
+    # The dates of the last export
+    assert checkpoint.load() == {"schedd1": 1000, "schedd2": 2000}
+    # Which is not overwritten
+    checkpoint.export_json()
+    with open(str(workdir / "checkpoint.json")) as fd:
+        assert json.load(fd) == {"schedd1": 1000, "schedd2": 2000}
+    assert checkpoint.load_since() == {}
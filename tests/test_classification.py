@@ -0,0 +1,47 @@
+"""
+Classification rules: the templated values, and the rules rejected when loaded.
+"""
+
+import json
+
+import pytest
+
+from htcondor_es.classification import RuleMatcher, load_rules
+
+
+def test_templated_values():
+    matcher = RuleMatcher(
+        "Field",
+        [
+            {"pattern": "Prompt(Reco)", "value": "{1}-{0}"},
+            {"pattern": "Repack", "value": "{0}ing"},
+            {"pattern": "Express", "value": "Fixed"},
+        ],
+        default="UNKNOWN",
+    )
+    assert matcher.classify("PromptReco_Run2023") == "Reco-PromptReco"
+    assert matcher.classify("Repack_Run2023") == "Repacking"
+    assert matcher.classify("Express_Run2023") == "Fixed"
+    assert matcher.classify("Other") == "UNKNOWN"
+
+
+@pytest.mark.parametrize(
+    "value",
+    ["{1}", "{2}Reprocessing", "{}", "{name}", "{1"],
+    ids=["no-group", "out-of-range", "auto-numbering", "named", "malformed"],
+)
+def test_bad_templates_are_rejected(value):
+    pattern = "Run20([0-9]+)" if value != "{1}" else "Run20[0-9]+"
+    with pytest.raises(ValueError):
+        RuleMatcher("Field", [{"pattern": pattern, "value": value}])
+
+
+def test_load_rules_rejects_bad_rule_files(tmp_path):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"Campaign": {"rules": [{"pattern": "PromptReco", "value": "{1}"}]}}))
+    with pytest.raises(ValueError):
+        load_rules(str(path))
+
+
+def test_shipped_rules_load():
+    assert set(load_rules()) >= {"Campaign", "Workflow", "TaskType", "CMS_CampaignType"}
@@ -0,0 +1,78 @@
+"""
+Delivery of the ES bulks to several clusters: the all and quorum modes, and
+the bulks left to the lagging clusters.
+"""
+
+import argparse
+import threading
+import types
+
+import pytest
+
+from htcondor_es import es
+
+
+class FakeCluster(object):
+    """Stand-in of a cluster client, fails or answers once released"""
+
+    def __init__(self, name, fail=False, release=True):
+        self.transport = types.SimpleNamespace(hosts=[{"host": name}])
+        self.fail = fail
+        self.released = threading.Event()
+        if release:
+            self.released.set()
+        self.started = 0
+        self.bulks = 0
+
+    def bulk(self, body, index, request_timeout):
+        self.started += 1
+        self.released.wait(10)
+        self.bulks += 1
+        if self.fail:
+            raise RuntimeError("%s failed" % self.transport.hosts[0]["host"])
+        return {}
+
+
+@pytest.fixture
+def clusters(monkeypatch):
+    monkeypatch.setattr(es, "_laggards", [])
+    monkeypatch.setattr(es, "_bulk_executor", None)
+    monkeypatch.setattr(es, "_LAGGARD_RETRIES", 0)
+
+    def set_clusters(*handles):
+        monkeypatch.setattr(es, "_es_clients", types.SimpleNamespace(handles=set(handles)))
+
+    return set_clusters
+
+
+def post(delivery):
+    args = argparse.Namespace(es_delivery=delivery, mock_cern_domain=True)
+    return es.post_ads(args, "cms-test", [("id1", {"A": 1})])
+
+
+def test_no_clusters(clusters):
+    clusters()
+    assert post("all") == 0
+    assert es._bulk_executor is None
+
+
+def test_all_failed(clusters):
+    slow = FakeCluster("slow", release=False)
+    clusters(FakeCluster("failing", fail=True), slow)
+    threading.Timer(0.2, slow.released.set).start()
+    with pytest.raises(RuntimeError):
+        post("all")
+    # Nothing left for the next posts, nor in flight: cancelled or awaited
+    assert es._laggards == []
+    assert slow.bulks == slow.started
+
+
+def test_quorum_laggard(clusters):
+    slow = FakeCluster("slow", release=False)
+    clusters(FakeCluster("one"), FakeCluster("two"), slow)
+    assert post("quorum") == 0
+    assert len(es._laggards) == 1
+    slow.released.set()
+    es.flush()
+    assert es._laggards == []
+    assert slow.bulks == 1
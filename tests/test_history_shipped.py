@@ -0,0 +1,56 @@
+"""
+History crawl of a schedd with --skip_shipped when the checkpoint database
+is not usable: the crawl goes on without skipping anything.
+"""
+
+import argparse
+import sqlite3
+import time
+
+from htcondor_es import checkpoint
+from htcondor_es import history
+from htcondor_es import utils
+
+
+class FakeSchedd(object):
+    def __init__(self):
+        self.queries = []
+
+    def history(self, constraint, projection, match=-1, since=None):
+        self.queries.append(constraint)
+        return iter([])
+
+
+def locked(*args, **kwargs):
+    raise sqlite3.OperationalError("database is locked")
+
+
+def test_skip_shipped_without_database(monkeypatch):
+    schedd = FakeSchedd()
+    monkeypatch.setattr(utils, "get_schedd", lambda schedd_ad: schedd)
+    monkeypatch.setattr(checkpoint, "_connect", locked)
+    args = argparse.Namespace(
+        dry_run=False,
+        email_alerts=[],
+        es_bunch_size=250,
+        es_index_template=None,
+        feed_amq=False,
+        feed_es=False,
+        history_progress_secs=0,
+        history_since=False,
+        learn_projection_attrs=False,
+        materialize_ads=False,
+        max_documents_to_process=0,
+        read_only=True,
+        skip_shipped=True,
+        stage_timing=False,
+        task_cache=False,
+        upload_queue_size=0,
+        attribute_projection="full",
+    )
+    now = time.time()
+    result = history.process_schedd(now, now - 3600, {"Name": "schedd1"}, args)
+    assert len(schedd.queries) == 1
+    assert result["count"] == 0
+    # Nor checkpointed
+    assert not result["complete"]
@@ -0,0 +1,76 @@
+"""
+History windows: the sub-windows of a split schedd, and the progress
+sub-windows of a query, have to cover their window without gaps or overlaps.
+"""
+
+import argparse
+
+import pytest
+
+from htcondor_es.history import MAX_PROGRESS_WINDOWS, progress_windows, split_windows
+
+NOW = 1700000000
+
+
+def make_args(**kwargs):
+    defaults = dict(history_split_ads=0, history_progress_secs=0, query_pool_size=8)
+    defaults.update(kwargs)
+    return argparse.Namespace(**defaults)
+
+
+def assert_contiguous(windows, begin, end):
+    assert windows[0][0] == begin
+    assert windows[-1][1] == end
+    for (_, prev_end), (next_begin, _) in zip(windows, windows[1:]):
+        assert prev_end == next_begin
+    for sub_begin, sub_end in windows[:-1]:
+        assert sub_begin < sub_end
+
+
+def test_split_disabled_by_default():
+    stats = {"schedd": {"ads": 10 ** 7, "window_secs": 720}}
+    assert split_windows("schedd", NOW - 3600, NOW, stats, make_args()) == [None]
+
+
+@pytest.mark.parametrize("ads,n_windows", [(50000, 1), (250000, 3), (10 ** 7, 8)])
+def test_split_windows(ads, n_windows):
+    begin = NOW - 3600
+    stats = {"schedd": {"ads": ads, "window_secs": 3600}}
+    split = split_windows("schedd", begin, NOW, stats, make_args(history_split_ads=100000))
+    if n_windows == 1:
+        assert split == [None]
+        return
+    assert len(split) == n_windows
+    assert [window[0] for window in split] == list(range(n_windows))
+    assert all(window[1] == n_windows for window in split)
+    assert_contiguous([window[2:] for window in split], begin, None)
+
+
+def test_split_without_stats():
+    args = make_args(history_split_ads=100000)
+    assert split_windows("schedd", NOW - 3600, NOW, {}, args) == [None]
+
+
+def test_progress_disabled_by_default():
+    assert progress_windows(NOW - 7200, None, NOW, make_args()) == [(NOW - 7200, None)]
+
+
+@pytest.mark.parametrize("end", [None, NOW - 600])
+@pytest.mark.parametrize("window_secs", [1800, 3600, 3601, 7 * 3600])
+def test_progress_windows(window_secs, end):
+    begin = NOW - window_secs
+    windows = progress_windows(begin, end, NOW, make_args(history_progress_secs=900))
+    assert_contiguous(windows, begin, end)
+    assert len(windows) <= MAX_PROGRESS_WINDOWS
+    # Longer sub-windows beyond the cap
+    step = max(900, -(-((end or NOW) - begin) // MAX_PROGRESS_WINDOWS))
+    for sub_begin, sub_end in windows[:-1]:
+        assert sub_end - sub_begin == step
+    assert windows[-1][0] < (end if end is not None else NOW)
+
+
+def test_progress_windows_capped():
+    begin = NOW - 30 * 24 * 3600
+    windows = progress_windows(begin, None, NOW, make_args(history_progress_secs=3600))
+    assert len(windows) <= MAX_PROGRESS_WINDOWS
+    assert_contiguous(windows, begin, None)
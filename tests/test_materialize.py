@@ -0,0 +1,96 @@
+"""
+The conversion of materialized ads (--materialize_ads) gives the same
+documents as the conversion of the ClassAds themselves.
+"""
+
+import time
+
+import classad
+import pytest
+
+from htcondor_es.convert_to_json import MaterializedAd, convert_to_json, materialize_ad
+
+# Completed production and analysis jobs, some attributes in the casing the schedds use
+_ADS = [
+    """
+    [
+        GlobalJobId = "vocms0250.cern.ch#1234.0#1700000000";
+        ClusterId = 1234; ProcId = 0;
+        JobUniverse = 5; JobStatus = 4;
+        QDate = 1700000000; JobStartDate = 1700000100; EnteredCurrentStatus = 1700003700;
+        CompletionDate = 1700003700; RemoteWallClockTime = 3600.0; CommittedTime = 3600;
+        RemoteUserCpu = 3000.0; RemoteSysCpu = 100.0;
+        RequestCpus = 4; RequestMemory = ifThenElse(MemoryUsage isnt undefined, MemoryUsage, 2000);
+        MemoryUsage = 1800;
+        DESIRED_SITES = "T1_US_FNAL,T2_CH_CERN";
+        DESIRED_CMSDataLocations = "T1_US_FNAL";
+        WMAgent_RequestName = "pdmvserv_task_HIG-RunIISummer20UL18wmLHEGEN-00001__v1_T_201015_000000_1234";
+        WMAgent_SubTaskName = "/pdmvserv_task_HIG-RunIISummer20UL18wmLHEGEN-00001/HIG-RunIISummer20UL18wmLHEGEN-00001_0";
+        CMS_JobType = "Production"; CMS_CampaignName = "RunIISummer20UL18wmLHEGEN";
+        MATCH_EXP_JOBGLIDEIN_CMSSite = "T1_US_FNAL"; MATCH_GLIDEIN_CMSSite = "T1_US_FNAL";
+        MachineAttrGLIDEIN_CMSSite0 = "T1_US_FNAL"; MachineAttrCMSProcessingSiteName0 = "T1_US_FNAL";
+        ExitCode = 0; JobExitCode = 0;
+        Owner = "cmsdataops"; x509UserProxyVOName = "cms";
+    ]
+    """,
+    """
+    [
+        GlobalJobId = "crab3@vocms0199.cern.ch#5678.3#1700000000";
+        ClusterId = 5678; ProcId = 3;
+        JobUniverse = 5; JobStatus = 3;
+        QDate = 1700000000; JobStartDate = 1700000200; EnteredCurrentStatus = 1700002000;
+        RemoteWallClockTime = 1800.0; CommittedTime = 0;
+        RemoteUserCpu = 900.0; RemoteSysCpu = 20.0; RequestCpus = 1; RequestMemory = 2500;
+        DESIRED_Sites = "T2_IT_Pisa,T2_DE_DESY,T2_US_MIT";
+        EXTDESIRED_SITES = "T2_IT_Pisa";
+        CRAB_Workflow = "231114_000000:someuser_crab_analysis";
+        CRAB_UserHN = "someuser"; CRAB_Id = "4"; CRAB_Retry = 0;
+        CRAB_DataBlock = "/Prim/Proc-v1/MINIAODSIM#abc";
+        CMS_JobType = "Analysis"; CMS_Type = "analysis";
+        MATCH_EXP_JOBGLIDEIN_CMSSite = "T2_US_MIT"; MATCH_GLIDEIN_CMSSite = "T2_US_MIT";
+        MachineAttrGLIDEIN_CMSSite0 = "T2_US_MIT";
+        Chirp_CRAB3_Job_ExitCode = 8021; ExitCode = 8021;
+        Owner = "cms1234";
+    ]
+    """,
+]
+
+
+def _convert(text, materialize):
+    # The conversion writes to the ad, each one gets a fresh copy
+    return convert_to_json(
+        classad.parseOne(text), return_dict=True, pool_name="Global", materialize=materialize
+    )
+
+
+@pytest.fixture(autouse=True)
+def frozen_time(monkeypatch):
+    # The queue times of the jobs not started yet count up to now
+    monkeypatch.setattr(time, "time", lambda: 1700010000.0)
+
+
+@pytest.mark.parametrize("text", _ADS, ids=["production", "analysis"])
+def test_materialized_conversion_matches_classad_conversion(text):
+    baseline = _convert(text, materialize=False)
+    assert baseline
+    assert _convert(text, materialize=True) == baseline
+
+
+@pytest.mark.parametrize("text", _ADS, ids=["production", "analysis"])
+def test_schedd_casing_is_looked_up(text):
+    doc = _convert(text, materialize=True)
+    assert doc["DESIRED_Sites"] != ["UNKNOWN"]
+    assert doc["DesiredSiteCount"] == len(doc["DESIRED_Sites"])
+
+
+def test_materialized_ad_is_case_insensitive():
+    ad = materialize_ad(classad.ClassAd({"DESIRED_SITES": "T2_CH_CERN", "RequestCpus": 2}))
+    assert isinstance(ad, MaterializedAd)
+    assert ad["DESIRED_Sites"] == ad.eval("desired_sites") == "T2_CH_CERN"
+    assert "Desired_Sites" in ad
+    assert ad.get("DESIRED_Sites") == "T2_CH_CERN"
+    assert ad.get("Missing", 0) == 0
+    # Writes go to the original name, like on a ClassAd
+    ad["requestcpus"] = 4
+    ad.setdefault("REQUESTCPUS", 1)
+    assert dict(ad) == {"DESIRED_SITES": "T2_CH_CERN", "RequestCpus": 4}
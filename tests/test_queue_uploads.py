@@ -0,0 +1,101 @@
+"""
+Completion protocol of the queue uploads: the start/docs/end messages of the
+schedds relayed by the uploaders, and the counts they send when they close.
+"""
+
+import argparse
+import multiprocessing
+import queue
+import time
+
+import pytest
+
+from htcondor_es import queues
+
+
+class FakeUploader(object):
+    def join(self):
+        pass
+
+    def terminate(self):
+        pass
+
+
+@pytest.fixture
+def doc_queue():
+    doc_queue = multiprocessing.Queue()
+    queues.set_doc_queue(doc_queue)
+    yield doc_queue
+    queues.set_doc_queue(None)
+
+
+def drain(doc_queue):
+    items = []
+    while True:
+        try:
+            items.append(doc_queue.get(timeout=0.5))
+        except queue.Empty:
+            return items
+
+
+def counts(received, sent=None, upload_secs=1.0):
+    return {"received": received, "sent": received if sent is None else sent, "upload_secs": upload_secs}
+
+
+def test_collect_uploads(doc_queue):
+    results = queue.Queue()
+    for message in [
+        ("start", "schedd1"),
+        ("start", "schedd2"),
+        ("docs", "schedd1", 50),
+        ("end", "schedd2", 0),
+        ("docs", "schedd1", 20),
+        ("end", "schedd1", 70),
+        counts(30, 25),
+        counts(40),
+    ]:
+        results.put(message)
+    totals = queues.collect_uploads(results, 2, [FakeUploader(), FakeUploader()], time.time())
+    assert totals == (70, 65, 2.0)
+    assert drain(doc_queue) == [None, None]
+
+
+def test_collect_uploads_closed_uploader(doc_queue):
+    # The first uploader gave up waiting for docs before the schedds were done
+    results = queue.Queue()
+    for message in [
+        ("start", "schedd1"),
+        ("docs", "schedd1", 50),
+        counts(50),
+        ("docs", "schedd1", 20),
+        ("end", "schedd1", 70),
+        counts(20),
+    ]:
+        results.put(message)
+    totals = queues.collect_uploads(results, 1, [FakeUploader(), FakeUploader()], time.time())
+    assert totals == (70, 70, 2.0)
+    # No pill for the closed uploader
+    assert drain(doc_queue) == [None]
+
+
+def test_queue_uploaders(doc_queue):
+    args = argparse.Namespace(read_only=True, feed_es_for_queues=False, feed_amq=False)
+    starttime = time.time()
+    results = multiprocessing.Queue()
+    uploaders = [
+        queues.QueueUploader(doc_queue, results, starttime, args, {}, bunch_size=25)
+        for _ in range(3)
+    ]
+    n_docs = 0
+    for i in range(4):
+        name = "schedd%d" % i
+        queues.put_start(name, starttime)
+        count = 0
+        for size in range(i * 5):
+            batch = [("%s#%d#%d" % (name, size, j), {"Size": size}) for j in range(size)]
+            queues.put_batch(name, batch, starttime)
+            count += len(batch)
+        queues.put_end(name, count, starttime)
+        n_docs += count
+    assert queues.collect_uploads(results, 4, uploaders, starttime)[:2] == (n_docs, 0)
+    assert not any(uploader.is_alive() for uploader in uploaders)